@@ -0,0 +1,257 @@
+'''
+Created on 19/10/2026
+
+Synthesis of the spectra of the spaxels of an IFU cube from one line list. The spectra of the reference
+lines (bases) are computed once per kinematic bin; each spaxel is then a linear combination of the bases of
+its bin, reddened and scaled, so that no spectrum object is built per spaxel.
+'''
+
+import os
+import numpy as np
+
+from pyssn import log_, config
+if config.INSTALLED['PyNeb']:
+    import pyneb as pn
+
+from ..utils.physics import CST
+from ..utils.misc import convol, rebin, is_absorb, fork_pool
+from ..core.spectrum import fits_wavelengths
+
+# Cube evaluated by the processes of SpectrumCube.run (inherited from the parent process)
+_cube = None
+
+def _run_cube_row(y):
+    _cube.run_row(y)
+    return y
+
+class SpectrumCube(object):
+
+    def __init__(self, sp, cube_file, flux_ext=None, var_ext=None, mask_ext=None, obj_velo=0., e_bv=0., norm=1.,
+                 velo_bin=None, fit=None, out_dir=None):
+        """
+        sp: spectrum object whose line lists have been read (run with do_read_liste=True). Its configuration
+            (profiles, resol, limit_sp, sp_norm, reddening law...) is used for all the spaxels.
+        cube_file: FITS file of the cube, memory-mapped, the wavelength being the 3rd axis (NAXIS3).
+        flux_ext, var_ext, mask_ext: extensions (index or name) of the flux, variance and mask (non-zero for the bad
+            pixels), see fits_flux_ext. By default the flux is in the first HDU having data.
+        obj_velo, e_bv, norm: velocity (km/s), reddening and intensity scaling of the spaxels, numbers or (ny, nx) maps.
+        velo_bin: width (km/s) of the kinematic bins: the bases are computed once per bin, at its velocity.
+            Default: cube_velo_bin.
+        fit: if True, the scalings of the bases (one per reference line, plus the continuum) are fitted on each
+            spaxel by least squares (weighted by the variance if var_ext is given); otherwise they are all set
+            to norm. Default: cube_fit.
+        out_dir: directory of the result cubes (see run). Default: cube_out_dir, or the directory of cube_file.
+        """
+        self.calling = 'SpectrumCube'
+        self.sp = sp
+        self.cube_file = cube_file
+        self.flux_ext = flux_ext
+        self.var_ext = var_ext
+        self.mask_ext = mask_ext
+        if velo_bin is None:
+            velo_bin = sp.get_conf('cube_velo_bin', 10.)
+        self.velo_bin = velo_bin
+        if fit is None:
+            fit = sp.get_conf('cube_fit', True)
+        self.fit = bool(fit)
+        if out_dir is None:
+            out_dir = sp.get_conf('cube_out_dir', None)
+        if out_dir is None:
+            out_dir = os.path.dirname(os.path.abspath(cube_file))
+        self.out_dir = out_dir
+        self.sp_norm = sp.get_conf('sp_norm', 1.)
+        self.read_cube()
+        shape = (self.ny, self.nx)
+        self.obj_velo = np.nan_to_num(np.broadcast_to(np.asarray(obj_velo, dtype=float), shape))
+        self.e_bv = np.nan_to_num(np.broadcast_to(np.asarray(e_bv, dtype=float), shape))
+        self.norm = np.broadcast_to(np.asarray(norm, dtype=float), shape)
+        self.bases = None
+
+    def read_cube(self):
+        """
+        Open the cube, memory-mapped (the file remains open until close is called).
+        """
+        from astropy.io import fits
+        self.hdul = fits.open(self.cube_file, memmap=True)
+        if self.flux_ext is None:
+            self.flux_ext = [i for i, hdu in enumerate(self.hdul) if hdu.header.get('NAXIS', 0) > 0][0]
+        header = self.hdul[self.flux_ext].header
+        if header['NAXIS'] != 3:
+            log_.error('{0} is not a cube (NAXIS = {1})'.format(self.cube_file, header['NAXIS']), calling=self.calling)
+        self.flux = self.hdul[self.flux_ext].data
+        self.var = None if self.var_ext is None else self.hdul[self.var_ext].data
+        self.mask = None if self.mask_ext is None else self.hdul[self.mask_ext].data
+        n_w, self.ny, self.nx = self.flux.shape
+        self.w_obs = fits_wavelengths(header, np.arange(n_w), axis=3)
+        log_.message('Cube of {0} x {1} spaxels and {2} pixels opened from {3}'.format(self.nx, self.ny, n_w, self.cube_file),
+                     calling=self.calling)
+
+    def close(self):
+        self.hdul.close()
+
+    def make_bases(self):
+        """
+        Compute the bases of each kinematic bin: the spectra of the reference lines and of the continuum, without
+        reddening, on the synthesis grid. The bins are synthesized by spectrum.run_segments, from one restriction
+        of the line list and in parallel if multiprocessing is used. The lines not corrected for reddening
+        (see no_red_corr) are kept apart. The bases are reddened, absorbed and convolved by get_bases.
+        """
+        sp = self.sp
+        v_light = CST.CLIGHT / 1e5
+        self.bins_velo, self.bins = np.unique(np.round(self.obj_velo / self.velo_bin) * self.velo_bin, return_inverse=True)
+        self.bins = self.bins.reshape(self.ny, self.nx)
+        # Pixels within limit_sp for all the velocities
+        in_lims = np.ones(len(self.w_obs), dtype=bool)
+        for velo in self.bins_velo:
+            w = self.w_obs * (1 - velo / v_light)
+            in_lims &= (w >= sp.limit_sp[0]) & (w <= sp.limit_sp[1])
+        pix = np.flatnonzero(in_lims)
+        if len(pix) == 0:
+            log_.error('No pixel of the cube within limit_sp', calling=self.calling)
+        self.i1, self.i2 = pix[0], pix[-1] + 1
+        self.w = self.w_obs[self.i1:self.i2]
+
+        segments = []
+        for velo in self.bins_velo:
+            # The bases are scaled by the fit, the automatic continuum of the observations of sp is not used
+            seg = sp.copy_segment({'obj_velo': velo, 'e_bv': 0., 'cont_auto': False})
+            seg.cont_auto = None
+            seg.cont_auto_state = None
+            seg.obj_velo = velo
+            seg.w = self.w * (1 - velo / v_light)
+            seg.f = np.zeros_like(seg.w)
+            seg.tab_pix = np.arange(len(seg.w))
+            seg.obs_var = None
+            seg.obs_mask = None
+            seg.make_obs_grid()
+            seg.init_red_corr()
+            seg.make_continuum()
+            segments.append(seg)
+        sp_segments = sp.segments
+        sp.segments = segments
+        try:
+            sp.run_segments()
+        finally:
+            sp.segments = sp_segments
+
+        self.ref_nums = np.unique(np.concatenate([seg.sp_theo['raie_ref']['num'] for seg in segments]))
+        n_ref = len(self.ref_nums)
+        self.bases = []
+        self.bases_cache = {}
+        for i, seg in enumerate(segments):
+            # The segments are synthesized without reddening: the spectra of the reference lines are the sums
+            # of the lines corrected for reddening (red) and of the ones not corrected (nored)
+            red = np.zeros((n_ref, len(seg.w)))
+            nored = np.zeros((n_ref, len(seg.w)))
+            rows = np.searchsorted(self.ref_nums, seg.sp_theo['raie_ref']['num'])
+            red[rows] = seg.sp_theo['spectr']
+            nored_rows = rows[seg.sp_theo['nored_rows']]
+            nored[nored_rows] = seg.sp_theo['nored_spectr']
+            red[nored_rows] -= nored[nored_rows]
+            absorb = rows[is_absorb(seg.sp_theo['raie_ref'])]
+            red[absorb] = 0.
+            nored[absorb] = 0.
+            logcorr = np.zeros(len(seg.w))
+            if config.INSTALLED['PyNeb']:
+                RC = pn.RedCorr(E_BV=1., law=sp.get_conf('red_corr_law', message='error'), R_V=sp.get_conf('r_v', 3.1))
+                logcorr = np.log10(RC.getCorr(seg.w, sp.get_conf('lambda_ref_rougi', message='error')))
+            elif np.any(self.e_bv[self.bins == i] != 0):
+                log_.warn('PyNeb not available, no reddening applied', calling=self.calling)
+            self.bases.append({'red': red, 'nored': nored, 'cont': seg.cont, 'sp_abs': seg.sp_abs, 'logcorr': logcorr,
+                               'kernel': np.ones(1) if seg.filter_ is None else seg.filter_, 'resol': seg.resol})
+        log_.message('Bases of {0} reference lines computed for {1} velocity bins'.format(n_ref, len(segments)),
+                     calling=self.calling)
+
+    def get_bases(self, i, e_bv, total=False):
+        """
+        Bases of the kinematic bin i for the reddening e_bv, on the observed pixels: the spectra of the reference
+        lines and of the continuum (last row) reddened, absorbed and convolved by the instrumental profile, as
+        in spectrum.make_synth and convol_synth. If total, only their sum. The last bases computed are cached.
+        With adaptive_grid, the reddening is applied on the observed pixels instead of the refined grid.
+        """
+        key = (i, e_bv, total)
+        if key not in self.bases_cache:
+            if len(self.bases_cache) >= 64:
+                self.bases_cache.clear()
+            b = self.bases[i]
+            red_corr = 10.**(e_bv * b['logcorr'])
+            spectr = np.vstack((b['red'] / red_corr + b['nored'], b['cont'] / red_corr))
+            if total:
+                spectr = spectr.sum(axis=0)[np.newaxis]
+            self.bases_cache[key] = np.array([rebin(convol(row * b['sp_abs'], b['kernel']), b['resol'])
+                                              for row in spectr])
+        return self.bases_cache[key]
+
+    def out_file(self, key):
+        return os.path.join(self.out_dir, '{0}_{1}.npy'.format(os.path.splitext(os.path.basename(self.cube_file))[0], key))
+
+    def run_row(self, y):
+        """
+        Evaluate the spaxels of the row y and write them in the result cubes.
+        """
+        n_pix = len(self.w)
+        flux = np.array(self.flux[self.i1:self.i2, y, :], dtype=float) * self.sp_norm
+        good = np.isfinite(flux)
+        weights = np.ones_like(flux)
+        if self.var is not None:
+            var = np.array(self.var[self.i1:self.i2, y, :], dtype=float) * self.sp_norm**2
+            good &= np.isfinite(var) & (var > 0)
+            weights[good] = 1. / np.sqrt(var[good])
+        if self.mask is not None:
+            good &= (np.asarray(self.mask[self.i1:self.i2, y, :]) == 0)
+        synth = np.zeros((n_pix, self.nx))
+        scal = np.zeros((len(self.ref_nums) + 1, self.nx))
+        for x in range(self.nx):
+            if self.fit:
+                basis = self.get_bases(self.bins[y, x], self.e_bv[y, x])
+                ok = good[:, x]
+                cols = np.flatnonzero(np.any(basis[:, ok] != 0, axis=1))
+                if len(cols) == 0:
+                    scal[:, x] = np.nan
+                    continue
+                a = basis[cols][:, ok].T * weights[ok, x][:, np.newaxis]
+                scal[cols, x] = np.linalg.lstsq(a, flux[ok, x] * weights[ok, x], rcond=None)[0]
+                synth[:, x] = scal[:, x].dot(basis)
+            else:
+                scal[:, x] = self.norm[y, x]
+                synth[:, x] = self.norm[y, x] * self.get_bases(self.bins[y, x], self.e_bv[y, x], total=True)[0]
+        for key, value in (('synth', synth), ('resid', flux - synth), ('scal', scal)):
+            out = np.lib.format.open_memmap(self.out_file(key), mode='r+')
+            out[:, y, :] = value
+            out.flush()
+            del out
+
+    def run(self):
+        """
+        Evaluate all the spaxels. The results are written in memory-mapped .npy cubes in out_dir, named after
+        cube_file: _synth (synthetic spectra), _resid (observations - synthesis), both of shape (n_pix, ny, nx),
+        and _scal (scalings of the bases, the last one being the continuum), of shape (n_ref + 1, ny, nx).
+        The wavelengths of the pixels and the codes of the reference lines are in self.w and self.ref_nums,
+        also saved in the _axes.npz file. The results are then available, read-only, in self.synth, self.resid
+        and self.scal.
+        """
+        global _cube
+        if self.bases is None:
+            self.make_bases()
+        shapes = {'synth': (len(self.w), self.ny, self.nx), 'resid': (len(self.w), self.ny, self.nx),
+                  'scal': (len(self.ref_nums) + 1, self.ny, self.nx)}
+        for key in shapes:
+            out = np.lib.format.open_memmap(self.out_file(key), mode='w+', dtype=np.float64, shape=shapes[key])
+            del out
+        np.savez(self.out_file('axes')[:-4] + '.npz', w=self.w, ref_nums=self.ref_nums)
+
+        if config.INSTALLED['mp'] and config._use_mp and self.ny > 1 and hasattr(os, 'fork'):
+            _cube = self
+            pool = fork_pool(config.Nprocs)
+            try:
+                pool.map(_run_cube_row, range(self.ny))
+            finally:
+                pool.close()
+                pool.join()
+                _cube = None
+        else:
+            for y in range(self.ny):
+                self.run_row(y)
+        for key in shapes:
+            setattr(self, key, np.load(self.out_file(key), mmap_mode='r'))
+        log_.message('{0} spaxels synthesized, results in {1}'.format(self.nx * self.ny, self.out_dir), calling=self.calling)
@@ -26,6 +26,26 @@ log_level = 2
 # If set to None, limit_sp must be given.
 spectr_obs = None 
 
+# FITS observations: extensions (index or name) of the flux, variance and mask. If fits_flux_ext is None, 
+# the flux is read from the first HDU having data. The variance and mask are kept in obs_var and obs_mask.
+# The dispersion can be linear or log-linear (DC-FLAG = 1 or CTYPE1 = 'WAVE-LOG'). If limit_sp is defined,
+# only the pixels covering it are read.
+fits_flux_ext = None
+fits_var_ext = None
+fits_mask_ext = None
+
+# Several observations (e.g. the arms of a spectrograph) synthesized from the same line list: list of dicts,
+# each of them overriding some of the options of this file for one segment (spectr_obs, limit_sp, prof,
+# sp_norm, obj_velo, resol...). Used by spectrum.run_segments and merge_segments.
+obs_segments = None
+
+# IFU cubes (see core.cube.SpectrumCube): the spectra of the reference lines are computed once per bin of
+# cube_velo_bin km/s of the velocity map. If cube_fit, their scalings are fitted on each spaxel. The result
+# cubes are written in cube_out_dir (if None, the directory of the cube).
+cube_velo_bin = 10. # km/s
+cube_fit = True
+cube_out_dir = None
+
 # Factor applied to the observations
 sp_norm = 1.0 #  
 # Not sure it works... Better use obj_velo
@@ -51,6 +71,13 @@ reverse_spectra = False
 # Nouveau mode.
 resol = 1  # Resol must be small if the obs resol is large
 
+# If True (and resol > 1), the observations are not oversampled as a whole: only the pixels
+# close to the lines are split into resol sub-pixels to compute the line profiles, which are then
+# rebinned (conserving the flux) onto the observed pixels.
+adaptive_grid = False
+# Half-size of the refined windows around each line, in units of the line width.
+adaptive_grid_width = 10.
+
 #-------------------------------------------------------------------
 #   Synthesis
 #-------------------------------------------------------------------
@@ -84,6 +111,34 @@ do_cosmetik = True
 # Note that if do_synth = False, the following flag has no meaning. 
 do_read_liste = True
 
+# Satellites sharing the same reference line, profile and width, and closer than blend_tolerance
+# pixel from each other, are merged into one line before the synthesis. Set to 0 to disable.
+blend_tolerance = 0.
+
+# If True, the line lists are read without their comments, which are read from the files
+# only when they are printed. Reduces the memory used by the line lists by half.
+lazy_comments = False
+
+# If True, the parsed phyat, model and cosmetik files (and the .spr observations) are saved in binary (.npy) 
+# files, reused as long as the text files are unchanged. data_cache_dir is the directory of these files
+# (if None, the per-user cache directory $XDG_CACHE_HOME/pyssn or ~/.cache/pyssn).
+data_cache = False
+data_cache_dir = None
+
+# If True, only the lines of the atomic database within the synthesis range (increased by the largest
+# l_shift of the cosmetik file and by phyat_lazy_margin % at each side) are read, with their chains of 
+# reference lines and the 999 lines. An index of the database is built at the first use, saved with the 
+# data_cache files if data_cache is True, kept in memory otherwise.
+# Note that the lines outside the range are then unknown to the cosmetic file checks.
+phyat_lazy_load = False
+phyat_lazy_margin = 1. # %
+
+# SQLite database file (created if needed) in which the phyat, model and cosmetik files are imported
+# (and imported again when they change), to be read and queried from there instead of parsing the text files.
+# It can be shared by several pySSN sessions. The synthesized lines are also loaded in a temporary table,
+# queried by get_nearby_lines and line_info. If None, the text files are parsed.
+line_db = None
+
 warn_on_no_cosmetik = True
 warn_on_no_reference = True
 
@@ -126,6 +181,16 @@ cont_hei_t = 1e4
 cont_heii_t = 1e4
 cont_edens = 1e3
 
+# Automatic continuum, added to the other components so that the total continuum fits the observations
+# outside the lines (pixels where the synthesized lines are weaker than cont_auto_cut times the strongest one).
+# Sigma-clipped (cont_auto_clip sigmas, cont_auto_niter iterations) medians of the observations in bins of
+# cont_auto_width (w units) are interpolated. It is fitted again after each synthesis.
+cont_auto = False
+cont_auto_cut = 1e-3
+cont_auto_width = 50.
+cont_auto_clip = 3.
+cont_auto_niter = 3
+
 # Wavelength of the reference line for the reddening.
 lambda_ref_rougi = 4861.3
 red_corr_law = 'S79 H83 CCM89'
@@ -225,6 +290,8 @@ line_saved_header = True
 line_saved_ordered_by = 0
 
 line_saved_format = 'tex' # tex or csv
+# The format of the saved lines is given by the extension of line_saved_filename: .tex, .csv, .npz (numpy
+# arrays of the line_field_print fields) or text otherwise.
 line_saved_filename = 'lines.dat'
 
 plot_filename = 'plot.pdf'
@@ -0,0 +1,353 @@
+'''
+Created on 19/10/2026
+
+SQLite database of line lists (phyat, model and cosmetik files), used instead of parsing the text files
+when the line_db option is set. Each file is imported once (and again when its size or modification time
+change), with indexes on num, ref, id and the wavelengths; the database can be shared by several processes.
+The text of each line is kept, so that export writes back the exact file.
+The list of the synthesized lines of a session (liste_raies) can also be loaded in a temporary table of 
+the connection (set_synth_list), to query it on the wavelengths and the reference lines.
+'''
+
+import os
+import sqlite3
+import numpy as np
+from pyssn import log_
+from ..utils.misc import read_bytes, parse_line_bytes, line_widths
+
+FIELDS = ['num', 'id', 'lambda', 'l_shift', 'i_rel', 'i_cor', 'ref', 'profile', 'vitesse', 'comment']
+
+DTYPES = {'num': np.int64, 'id': 'S9', 'lambda': np.float64, 'l_shift': np.float64, 'i_rel': np.float64,
+          'i_cor': np.float64, 'ref': np.int64, 'profile': np.int32, 'vitesse': np.float32, 'comment': 'S100'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (file_id INTEGER PRIMARY KEY, filename TEXT UNIQUE, NF INTEGER,
+                                  size INTEGER, mtime REAL, eol INTEGER);
+CREATE TABLE IF NOT EXISTS lines (file_id INTEGER, row INTEGER, num INTEGER, id BLOB, lambda REAL,
+                                  l_shift REAL, i_rel REAL, i_cor REAL, ref INTEGER, profile INTEGER,
+                                  vitesse REAL, comment BLOB, text BLOB);
+CREATE INDEX IF NOT EXISTS lines_row ON lines (file_id, row);
+CREATE INDEX IF NOT EXISTS lines_num ON lines (file_id, num);
+CREATE INDEX IF NOT EXISTS lines_ref ON lines (file_id, ref);
+CREATE INDEX IF NOT EXISTS lines_id ON lines (file_id, id);
+CREATE INDEX IF NOT EXISTS lines_lambda ON lines (file_id, lambda);
+CREATE INDEX IF NOT EXISTS lines_l_tot ON lines (file_id, lambda + l_shift);
+"""
+
+SYNTH_SCHEMA = """
+DROP TABLE IF EXISTS temp.synth;
+CREATE TEMP TABLE synth (row INTEGER PRIMARY KEY, num INTEGER, ref INTEGER, lambda REAL, l_shift REAL);
+CREATE INDEX temp.synth_num ON synth (num);
+CREATE INDEX temp.synth_ref ON synth (ref);
+CREATE INDEX temp.synth_l_tot ON synth (lambda + l_shift);
+"""
+
+def _to_str(b):
+    """
+    Text of a line stored as bytes, as read from a file opened in text mode.
+    """
+    b = bytes(b).rstrip(b'\r')
+    if str is bytes:
+        return b
+    return b.decode('utf-8', 'replace')
+
+def _to_bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+class LineDB(object):
+
+    def __init__(self, db_file):
+        """
+        Open (and create if needed) the SQLite database db_file.
+        """
+        self.db_file = os.path.abspath(db_file)
+        self.calling = 'LineDB'
+        self.conn = sqlite3.connect(self.db_file, timeout=60)
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+        self.synth_arr = None
+
+    def close(self):
+        self.conn.close()
+
+    def _stamp(self, filename):
+        stat = os.stat(filename)
+        return stat.st_size, stat.st_mtime
+
+    def file_id(self, filename, NF=True):
+        """
+        Id of filename in the database, after importing it if it is not in the database or if it changed since.
+        """
+        filename = os.path.abspath(filename)
+        size, mtime = self._stamp(filename)
+        row = self.conn.execute('SELECT file_id, NF, size, mtime FROM files WHERE filename = ?',
+                                (filename,)).fetchone()
+        if row is not None and row[1:] == (int(NF), size, mtime):
+            return row[0]
+        return self.import_file(filename, NF=NF)
+
+    def import_file(self, filename, NF=True):
+        """
+        (Re)import the lines of filename, in one transaction. Return the id of the file.
+        """
+        filename = os.path.abspath(filename)
+        size, mtime = self._stamp(filename)
+        lines = read_bytes(filename).split(b'\n')
+        # Whether the last line ends with an end of line
+        eol = lines[-1] == b''
+        if eol:
+            del lines[-1]
+        # Same lines as parse_line_bytes: the ones starting with # are not data
+        is_data = [not line.startswith(b'#') for line in lines]
+        data = [line for line, d in zip(lines, is_data) if d]
+        if len(data) > 0:
+            dd = parse_line_bytes(b'\n'.join(data) + b'\n', NF=NF, comments=True)
+        else:
+            dd = np.zeros(0, dtype=[(field, DTYPES[field]) for field in FIELDS])
+        values = []
+        i_data = 0
+        for row, (line, d) in enumerate(zip(lines, is_data)):
+            if d:
+                rec = dd[i_data]
+                i_data += 1
+                values.append((row, int(rec['num']), sqlite3.Binary(rec['id']), float(rec['lambda']),
+                               float(rec['l_shift']), float(rec['i_rel']), float(rec['i_cor']), int(rec['ref']),
+                               int(rec['profile']), float(rec['vitesse']), sqlite3.Binary(rec['comment']),
+                               sqlite3.Binary(line)))
+            else:
+                values.append((row, None, None, None, None, None, None, None, None, None, None,
+                               sqlite3.Binary(line)))
+        with self.conn:
+            self.conn.execute('DELETE FROM lines WHERE file_id IN (SELECT file_id FROM files WHERE filename = ?)',
+                              (filename,))
+            self.conn.execute('INSERT OR REPLACE INTO files (filename, NF, size, mtime, eol) VALUES (?, ?, ?, ?, ?)',
+                              (filename, int(NF), size, mtime, int(eol)))
+            file_id = self.conn.execute('SELECT file_id FROM files WHERE filename = ?', (filename,)).fetchone()[0]
+            self.conn.executemany('INSERT INTO lines VALUES ({0}, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(file_id),
+                                  values)
+        log_.message('{0} lines of {1} imported in {2}'.format(len(data), filename, self.db_file),
+                     calling=self.calling)
+        return file_id
+
+    def _to_array(self, rows, comments=True):
+        fields = FIELDS if comments else FIELDS[:-1]
+        dd = np.zeros(len(rows), dtype=[(field, DTYPES[field]) for field in fields])
+        if len(rows) > 0:
+            cols = list(zip(*rows))
+            for i, field in enumerate(fields):
+                if field in ('id', 'comment'):
+                    dd[field] = [bytes(v) for v in cols[i]]
+                else:
+                    dd[field] = cols[i]
+        return dd
+
+    def _select(self, comments):
+        fields = FIELDS if comments else FIELDS[:-1]
+        return 'SELECT {0} FROM lines'.format(', '.join(fields))
+
+    def read_list(self, filename, NF=True, comments=True):
+        """
+        Same array as parse_line_file(filename, NF, comments).
+        """
+        file_id = self.file_id(filename, NF=NF)
+        rows = self.conn.execute(self._select(comments) + ' WHERE file_id = ? AND num IS NOT NULL ORDER BY row',
+                                 (file_id,)).fetchall()
+        return self._to_array(rows, comments)
+
+    def read_range(self, filename, w_min, w_max, NF=True, comments=True):
+        """
+        Same lines as read_data_range: the lines with w_min <= lambda <= w_max, their chains of reference lines
+        and the lines with ref = 999, in the order of the file.
+        """
+        file_id = self.file_id(filename, NF=NF)
+        query = """WITH RECURSIVE sel(rid, ref) AS (
+                       SELECT rowid, ref FROM lines WHERE file_id = :f AND num IS NOT NULL
+                                                    AND (lambda BETWEEN :w1 AND :w2 OR ref = 999)
+                       UNION
+                       SELECT p.rowid, p.ref FROM sel JOIN lines p ON p.file_id = :f AND p.num = sel.ref
+                       WHERE sel.ref NOT IN (0, -1, 999))
+                   {0} WHERE rowid IN (SELECT rid FROM sel) ORDER BY row""".format(self._select(comments))
+        rows = self.conn.execute(query, {'f': file_id, 'w1': w_min, 'w2': w_max}).fetchall()
+        return self._to_array(rows, comments)
+
+    def lines_in(self, filename, w1, w2, NF=True, comments=True):
+        """
+        Lines with w1 < lambda + l_shift < w2, in the order of the file.
+        """
+        file_id = self.file_id(filename, NF=NF)
+        rows = self.conn.execute(self._select(comments) +
+                                 ' WHERE file_id = ? AND lambda + l_shift > ? AND lambda + l_shift < ? ORDER BY row',
+                                 (file_id, w1, w2)).fetchall()
+        return self._to_array(rows, comments)
+
+    def lines_of_ion(self, filename, ion, NF=True, comments=True):
+        """
+        Lines whose (stripped) id is ion, in the order of the file.
+        """
+        file_id = self.file_id(filename, NF=NF)
+        ion = sqlite3.Binary(_to_bytes(ion.strip()).ljust(9))
+        rows = self.conn.execute(self._select(comments) + ' WHERE file_id = ? AND id = ? ORDER BY row',
+                                 (file_id, ion)).fetchall()
+        return self._to_array(rows, comments)
+
+    def read_comments(self, filename, NF=True, num_offset=0):
+        """
+        Same dictionary {line code: comment} as read_comments.
+        """
+        file_id = self.file_id(filename, NF=NF)
+        i_comment = sum(line_widths(NF)[:-1])
+        rows = self.conn.execute('SELECT num, text FROM lines WHERE file_id = ? AND num IS NOT NULL ORDER BY row',
+                                 (file_id,))
+        return dict((num + num_offset, _to_str(text)[i_comment:].rstrip('\r\n')) for num, text in rows)
+
+    def _reduced_codes(self, line_num, n_num):
+        codes = [int(line_num)]
+        while codes[0] != 0 and abs(codes[-1]) < 10**n_num:
+            codes.append(codes[-1] * 10)
+        return codes
+
+    def _find_row(self, file_id, line_num, NF=True):
+        codes = self._reduced_codes(line_num, line_widths(NF)[0])
+        return self.conn.execute('SELECT rowid, text FROM lines WHERE file_id = ? AND num IN ({0}) ORDER BY row LIMIT 1'.format(
+                                 ', '.join('?' * len(codes))), [file_id] + codes).fetchone()
+
+    def read_line(self, filename, line_num, NF=True):
+        """
+        Same as LineFile.read_line: first line whose code is line_num (or line_num followed by zeros).
+        """
+        row = self._find_row(self.file_id(filename, NF=NF), line_num, NF=NF)
+        if row is None:
+            return None
+        return _to_str(row[1]) + '\n'
+
+    def read_satellites(self, filename, refline_num, NF=True):
+        """
+        Lines whose reference is refline_num, in the order of the file.
+        """
+        file_id = self.file_id(filename, NF=NF)
+        rows = self.conn.execute('SELECT text FROM lines WHERE file_id = ? AND ref = ? ORDER BY row',
+                                 (file_id, int(refline_num))).fetchall()
+        return [_to_str(row[0]) + '\n' for row in rows]
+
+    def _set_stamp(self, file_id, filename):
+        """
+        Record that the lines of file_id are the ones of the current version of filename.
+        """
+        if os.path.isfile(filename):
+            size, mtime = self._stamp(filename)
+            self.conn.execute('UPDATE files SET size = ?, mtime = ? WHERE file_id = ?', (size, mtime, file_id))
+
+    def replace_line(self, filename, line, NF=True, file_written=True):
+        """
+        Same as LineFile.replace_line, in one transaction. If file_written, the text file is supposed to have
+        been edited the same way, and is not imported again.
+        """
+        file_id = self.file_id(filename, NF=NF) if not file_written else self._file_id_no_check(filename, NF)
+        if file_id is None:
+            return
+        line = _to_bytes(line.rstrip('\n'))
+        rec = parse_line_bytes(line + b'\n', NF=NF, comments=True)[0]
+        values = (int(rec['num']), sqlite3.Binary(rec['id']), float(rec['lambda']), float(rec['l_shift']),
+                  float(rec['i_rel']), float(rec['i_cor']), int(rec['ref']), int(rec['profile']),
+                  float(rec['vitesse']), sqlite3.Binary(rec['comment']), sqlite3.Binary(line))
+        with self.conn:
+            cur = self.conn.execute('''UPDATE lines SET num = ?, id = ?, lambda = ?, l_shift = ?, i_rel = ?,
+                                       i_cor = ?, ref = ?, profile = ?, vitesse = ?, comment = ?, text = ?
+                                       WHERE file_id = ? AND num = ?''', values + (file_id, int(rec['num'])))
+            if cur.rowcount == 0:
+                last = self.conn.execute('SELECT MAX(row) FROM lines WHERE file_id = ?', (file_id,)).fetchone()[0]
+                self.conn.execute('INSERT INTO lines VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                  (file_id, 0 if last is None else last + 1) + values)
+                self.conn.execute('UPDATE files SET eol = 1 WHERE file_id = ?', (file_id,))
+            if file_written:
+                self._set_stamp(file_id, filename)
+
+    def remove_line(self, filename, line_num, NF=True, file_written=True):
+        """
+        Same as LineFile.remove_line, in one transaction. Return False if the line is not found.
+        """
+        file_id = self.file_id(filename, NF=NF) if not file_written else self._file_id_no_check(filename, NF)
+        if file_id is None:
+            return False
+        with self.conn:
+            row = self._find_row(file_id, line_num, NF=NF)
+            if row is None:
+                return False
+            self.conn.execute('DELETE FROM lines WHERE rowid = ?', (row[0],))
+            if file_written:
+                self._set_stamp(file_id, filename)
+        return True
+
+    def _file_id_no_check(self, filename, NF):
+        row = self.conn.execute('SELECT file_id, NF FROM files WHERE filename = ?',
+                                (os.path.abspath(filename),)).fetchone()
+        if row is None or row[1] != int(NF):
+            return None
+        return row[0]
+
+    def export(self, filename, out_filename=None, NF=True):
+        """
+        Write the lines of filename, as stored in the database, in out_filename (default: filename) in the
+        text format. The file is written under a temporary name and then renamed.
+        """
+        file_id = self._file_id_no_check(filename, NF)
+        if file_id is None:
+            file_id = self.file_id(filename, NF=NF)
+        if out_filename is None:
+            out_filename = filename
+        eol = self.conn.execute('SELECT eol FROM files WHERE file_id = ?', (file_id,)).fetchone()[0]
+        texts = [bytes(row[0]) for row in 
+                 self.conn.execute('SELECT text FROM lines WHERE file_id = ? ORDER BY row', (file_id,))]
+        tmp_file = '{0}.{1}.tmp'.format(out_filename, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            f.write(b'\n'.join(texts))
+            if eol and len(texts) > 0:
+                f.write(b'\n')
+        try:
+            os.rename(tmp_file, out_filename)
+        except OSError:
+            # Windows does not rename onto an existing file
+            os.remove(out_filename)
+            os.rename(tmp_file, out_filename)
+        if os.path.abspath(out_filename) == os.path.abspath(filename):
+            with self.conn:
+                self._set_stamp(file_id, filename)
+
+    def set_synth_list(self, arr):
+        """
+        Load the line list arr (liste_raies) in the temporary table synth, replacing the previous one.
+        The table is private to the connection and must be loaded again each time the list changes.
+        """
+        with self.conn:
+            self.conn.executescript(SYNTH_SCHEMA)
+            self.conn.executemany('INSERT INTO synth VALUES (?, ?, ?, ?, ?)',
+                                  zip(range(len(arr)), arr['num'].tolist(), arr['ref'].tolist(), 
+                                      arr['lambda'].tolist(), arr['l_shift'].tolist()))
+        self.synth_arr = arr
+
+    def _synth_rows(self, where, params):
+        rows = self.conn.execute('SELECT row FROM synth WHERE {0} ORDER BY row'.format(where), params).fetchall()
+        return np.array([row[0] for row in rows], dtype=int)
+
+    def synth_rows_in(self, w1, w2, lambda_shift=0.):
+        """
+        Same rows of the synth table as WavelengthIndex.rows_in: w1 < lambda + l_shift + lambda_shift < w2.
+        """
+        # The range on lambda + l_shift, slightly increased, uses the index; the exact test is done on the result
+        eps = 1e-6 * (abs(w1) + abs(w2) + abs(lambda_shift) + 1.)
+        return self._synth_rows('lambda + l_shift BETWEEN ? AND ? AND lambda + l_shift + ? > ? AND lambda + l_shift + ? < ?',
+                                (w1 - lambda_shift - eps, w2 - lambda_shift + eps, lambda_shift, w1, lambda_shift, w2))
+
+    def synth_rows_of(self, line_num):
+        """
+        Rows of the synth table whose code is line_num.
+        """
+        return self._synth_rows('num = ?', (int(line_num),))
+
+    def synth_children(self, ref_num):
+        """
+        Rows of the synth table whose reference is ref_num.
+        """
+        return self._synth_rows('ref = ?', (int(ref_num),))
@@ -0,0 +1,217 @@
+'''
+Created on 19/10/2026
+
+In-memory copy of a text file in the line list format (phyat, model or cosmetik file), indexed on the
+line codes and on the reference codes, to replace the scans and rewrites of the whole file made for each
+line read or edited.
+'''
+
+import os
+import bisect
+from contextlib import contextmanager
+from pyssn import log_
+
+class LineFile(object):
+
+    def __init__(self, filename, num_pos=0, num_width=14, ref_pos=59, ref_width=14):
+        """
+        The file is read at the first access and read again when its size or modification time changes.
+        The edits (replace_line, remove_line, remove_lines, set_lines) are applied in memory and written back
+        at once, in a temporary file renamed to filename, or at the end of a batch() block.
+        """
+        self.filename = os.path.abspath(filename)
+        self.num_slice = slice(num_pos, num_pos + num_width)
+        self.ref_slice = slice(ref_pos, ref_pos + ref_width)
+        self.calling = 'LineFile'
+        self.lines = None
+        self.stamp = None
+        self.num_rows = None
+        self.ref_rows = None
+        self.n_batch = 0
+        self.modified = False
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime)
+
+    def _load(self):
+        """
+        Read the file if it was not read yet or if it changed since (unless edits are pending).
+        """
+        if self.modified:
+            return
+        stamp = self._stat()
+        if self.lines is not None and stamp == self.stamp:
+            return
+        if stamp is None:
+            self.lines = []
+        else:
+            with open(self.filename, 'r') as f:
+                self.lines = f.read().splitlines()
+            log_.debug('{0} lines read from {1}'.format(len(self.lines), self.filename), calling=self.calling)
+        self.stamp = stamp
+        self.num_rows = None
+
+    def _code(self, line, field_slice):
+        try:
+            return int(line[field_slice])
+        except ValueError:
+            return None
+
+    def _index(self):
+        """
+        Build (if needed) the dictionaries code -> rows and ref -> rows, the rows being in increasing order.
+        """
+        self._load()
+        if self.num_rows is None:
+            self.num_rows = {}
+            self.ref_rows = {}
+            for i, line in enumerate(self.lines):
+                num = self._code(line, self.num_slice)
+                if num is None:
+                    continue
+                self.num_rows.setdefault(num, []).append(i)
+                ref = self._code(line, self.ref_slice)
+                if ref is not None:
+                    self.ref_rows.setdefault(ref, []).append(i)
+
+    def exists(self):
+        return self._stat() is not None or self.modified
+
+    def get_lines(self):
+        """
+        Lines of the file, without the end of line characters.
+        """
+        self._load()
+        return list(self.lines)
+
+    def find_row(self, line_num):
+        """
+        Row of the first line whose code is line_num or line_num followed by zeros (reduced codes), None if there is none.
+        """
+        self._index()
+        line_num = int(line_num)
+        codes = [line_num]
+        while line_num != 0 and abs(codes[-1]) < 10**(self.num_slice.stop - self.num_slice.start):
+            codes.append(codes[-1] * 10)
+        rows = [self.num_rows[code][0] for code in codes if code in self.num_rows]
+        if len(rows) == 0:
+            return None
+        return min(rows)
+
+    def read_line(self, line_num):
+        """
+        First line whose code is line_num (or line_num followed by zeros), with its end of line. None if not found.
+        """
+        row = self.find_row(line_num)
+        if row is None:
+            return None
+        return self.lines[row] + '\n'
+
+    def read_satellites(self, refline_num):
+        """
+        Lines whose reference is refline_num, in the order of the file, with their ends of line.
+        """
+        self._index()
+        return [self.lines[i] + '\n' for i in self.ref_rows.get(int(refline_num), [])]
+
+    def replace_line(self, line):
+        """
+        Replace all the lines having the code of line by line, or append it if there is none.
+        """
+        self._index()
+        line = line.rstrip('\n')
+        num = self._code(line, self.num_slice)
+        ref = self._code(line, self.ref_slice)
+        rows = self.num_rows.get(num, [])
+        for i in rows:
+            old_ref = self._code(self.lines[i], self.ref_slice)
+            if old_ref != ref:
+                if old_ref is not None:
+                    self.ref_rows[old_ref].remove(i)
+                if ref is not None:
+                    bisect.insort(self.ref_rows.setdefault(ref, []), i)
+            self.lines[i] = line
+        if len(rows) == 0:
+            self.lines.append(line)
+            i = len(self.lines) - 1
+            self.num_rows[num] = [i]
+            if ref is not None:
+                self.ref_rows.setdefault(ref, []).append(i)
+        self._modified()
+
+    def remove_line(self, line_num):
+        """
+        Remove the line found by read_line(line_num). Return False if there is none.
+        """
+        row = self.find_row(line_num)
+        if row is None:
+            return False
+        del self.lines[row]
+        self.num_rows = None
+        self._modified()
+        return True
+
+    def remove_lines(self, line_nums):
+        """
+        Remove the lines found by read_line for each code of line_nums, in one pass. Return the number of lines removed.
+        """
+        rows = set()
+        for line_num in line_nums:
+            row = self.find_row(line_num)
+            if row is not None:
+                rows.add(row)
+        if len(rows) > 0:
+            self.lines = [line for i, line in enumerate(self.lines) if i not in rows]
+            self.num_rows = None
+            self._modified()
+        return len(rows)
+
+    def set_lines(self, lines):
+        """
+        Replace the whole content of the file by lines (with or without their ends of line).
+        """
+        self._load()
+        self.lines = [line.rstrip('\n') for line in lines]
+        self.num_rows = None
+        self._modified()
+
+    def _modified(self):
+        self.modified = True
+        if self.n_batch == 0:
+            self.flush()
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager deferring the writing of the edits to the end of the block.
+        """
+        self.n_batch += 1
+        try:
+            yield self
+        finally:
+            self.n_batch -= 1
+            if self.n_batch == 0:
+                self.flush()
+
+    def flush(self):
+        """
+        Write the pending edits in a temporary file, then renamed to the file name.
+        """
+        if not self.modified:
+            return
+        tmp_file = '{0}.{1}.tmp'.format(self.filename, os.getpid())
+        with open(tmp_file, 'w') as f:
+            f.writelines(line + '\n' for line in self.lines)
+        try:
+            os.rename(tmp_file, self.filename)
+        except OSError:
+            # Windows does not rename onto an existing file
+            os.remove(self.filename)
+            os.rename(tmp_file, self.filename)
+        self.modified = False
+        self.stamp = self._stat()
+        log_.debug('{0} lines written to {1}'.format(len(self.lines), self.filename), calling=self.calling)
@@ -0,0 +1,166 @@
+'''
+Created on 19/10/2026
+
+Index on the line codes of a line list, to replace the linear scans used to find a line,
+its reference line or its satellites.
+'''
+
+import numpy as np
+from ..utils.misc import find_rows
+
+class LineIndex(object):
+
+    def __init__(self, arr):
+        """
+        Index on the 'num' and 'ref' fields of arr (a line list as produced by read_data).
+        The sort orders are computed once; the index remains valid as long as the 'num' and 'ref'
+        fields of arr are not modified (the other fields can be changed in place).
+        """
+        self.arr = arr
+        self.num_order = np.argsort(arr['num'], kind='mergesort')
+        self.sorted_num = arr['num'][self.num_order]
+        self.ref_order = np.argsort(arr['ref'], kind='mergesort')
+        self.sorted_ref = arr['ref'][self.ref_order]
+
+    def __len__(self):
+        return len(self.arr)
+
+    def rows_of(self, line_num):
+        """
+        Rows (in increasing order) of the lines whose code is line_num.
+        """
+        i1 = np.searchsorted(self.sorted_num, line_num, side='left')
+        i2 = np.searchsorted(self.sorted_num, line_num, side='right')
+        return self.num_order[i1:i2]
+
+    def rows(self, line_nums):
+        """
+        For each code of line_nums, the row of the line, -1 if undefined and -2 if multiply defined.
+        """
+        return find_rows(self.arr['num'], line_nums, order=self.num_order)
+
+    def get(self, line_num):
+        """
+        The line whose code is line_num, None if it is undefined or multiply defined.
+        """
+        rows = self.rows_of(int(line_num))
+        if len(rows) == 1:
+            return self.arr[rows[0]]
+        else:
+            return None
+
+    def children(self, ref_num):
+        """
+        Rows (in increasing order) of the lines whose reference is ref_num.
+        """
+        i1 = np.searchsorted(self.sorted_ref, ref_num, side='left')
+        i2 = np.searchsorted(self.sorted_ref, ref_num, side='right')
+        return self.ref_order[i1:i2]
+
+    def ancestors(self, line_num):
+        """
+        Rows of the successive reference lines of line_num, up to the line having
+        no reference (ref 0 or -1) or to a reference undefined in the list.
+        """
+        rows = []
+        row = self.rows_of(int(line_num))
+        while len(row) == 1 and len(rows) <= len(self.arr):
+            ref = self.arr['ref'][row[0]]
+            if ref in (0, -1):
+                break
+            row = self.rows_of(ref)
+            if len(row) == 1:
+                rows.append(int(row[0]))
+        return rows
+
+class WavelengthIndex(object):
+
+    def __init__(self, arr, lambda_shift=0.):
+        """
+        Index on the observed wavelengths (lambda + l_shift + lambda_shift) of the lines of arr.
+        It must be rebuilt when arr, the l_shift of its lines or lambda_shift change.
+        """
+        self.arr = arr
+        self.lambda_shift = lambda_shift
+        self.wl = arr['lambda'] + arr['l_shift'] + lambda_shift
+        self.order = np.argsort(self.wl, kind='mergesort')
+        self.sorted_wl = self.wl[self.order]
+
+    def __len__(self):
+        return len(self.arr)
+
+    def rows_in(self, w1, w2, cut=None, cut_on='i_tot', ions=None):
+        """
+        Rows (in increasing order) of the lines with w1 < wavelength < w2.
+        If cut is not None, only the lines with abs(cut_on) > cut are kept, cut_on being 'i_rel' or 
+        'i_tot' (i_rel * i_cor). If ions is not None, only the lines whose id (stripped) is in ions are kept.
+        """
+        i1 = np.searchsorted(self.sorted_wl, w1, side='right')
+        i2 = np.searchsorted(self.sorted_wl, w2, side='left')
+        rows = np.sort(self.order[i1:max(i1, i2)])
+        if cut is not None:
+            intens = self.arr['i_rel'][rows]
+            if cut_on == 'i_tot':
+                intens = intens * self.arr['i_cor'][rows]
+            rows = rows[np.abs(intens) > cut]
+        if ions is not None:
+            rows = rows[np.isin(np.char.strip(self.arr['id'][rows]), list(ions))]
+        return rows
+
+class IonIndex(object):
+
+    def __init__(self, liste_raies, raie_ref):
+        """
+        Group-by of the lines of liste_raies and of the reference lines raie_ref on their (stripped) id.
+        The groups are computed once with np.unique; the index must be rebuilt when one of the lists changes.
+        """
+        self.liste_raies = liste_raies
+        self.raie_ref = raie_ref
+        self.sat_groups = self._group(liste_raies['id'])
+        self.ref_groups = self._group(raie_ref['id'])
+        self.ions = sorted(self.sat_groups)
+        self.elements = {}
+        for ion in self.ions:
+            k = ion.find('_')
+            if k > -1:
+                element = ion[:k]
+            else:
+                element = ion
+            self.elements.setdefault(element, []).append(ion)
+
+    def _group(self, ids):
+        if len(ids) == 0:
+            return {}
+        ids = np.char.strip(ids)
+        if ids.dtype.kind == 'S' and str is not bytes:
+            # The ions are given as str
+            ids = np.char.decode(ids, 'ascii')
+        ions, inverse = np.unique(ids, return_inverse=True)
+        order = np.argsort(inverse, kind='mergesort')
+        bounds = np.searchsorted(inverse[order], np.arange(len(ions) + 1))
+        return dict((ion, order[bounds[i]:bounds[i+1]]) for i, ion in enumerate(ions.tolist()))
+
+    def sat_rows(self, ion):
+        """
+        Rows (in increasing order) of the lines of liste_raies whose id is ion.
+        """
+        return self.sat_groups.get(ion.strip(), np.zeros(0, dtype=int))
+
+    def ref_rows(self, ion):
+        """
+        Rows (in increasing order) of the reference lines whose id is ion.
+        """
+        return self.ref_groups.get(ion.strip(), np.zeros(0, dtype=int))
+
+    def ions_of_element(self, element):
+        """
+        Ids of the lines of liste_raies of the element (part of the id before the '_').
+        """
+        return list(self.elements.get(element, []))
+
+    def ions_starting_with(self, ion):
+        """
+        Ids of the lines of liste_raies starting with ion and not followed by a roman numeral, e.g. O_I and O_I_rec, but not O_II.
+        """
+        k = len(ion)
+        return [s for s in self.ions if len(s) > k and s[:k] == ion and s[k] not in [ 'I', 'V', 'X' ]]
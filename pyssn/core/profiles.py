@@ -9,7 +9,7 @@ from ..utils.physics import CST
 from ..utils.misc import convolgauss
 
 
-def profil_emis(w, raie, lambda_shift=0.):
+def profil_emis(w, raie, lambda_shift=0., adaptive=False):
 
     """
     raie = {'lambda' : 6200,
@@ -17,6 +17,7 @@ def profil_emis(w, raie, lambda_shift=0.):
             'vitesse' : 5.,
             'profile' : 1,
             'num' : 101000001010}
+    adaptive: w is the grid of make_adaptive_grid (see convolgauss)
     """
 
     lambda_0 = raie['lambda'] + raie['l_shift'] + lambda_shift
@@ -40,7 +41,7 @@ def profil_emis(w, raie, lambda_shift=0.):
 
     if T4 > 0.0:
         fwhm_therm = 21.4721 * np.sqrt(T4 / masse) * lambda_0 / 299792.50 #km/s
-        profil = convolgauss(profil, w, lambda_0, fwhm_therm)
+        profil = convolgauss(profil, w, lambda_0, fwhm_therm, adaptive=adaptive)
     
     profil[~np.isfinite(profil)] = 0.0
 
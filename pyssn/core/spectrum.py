@@ -7,6 +7,10 @@ pySSN is available under the GNU licence providing you cite the developpers name
 """
 import time
 import os
+import copy
+import json
+import hashlib
+import mmap
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.widgets import Button
@@ -19,8 +23,14 @@ if config.INSTALLED['PyNeb']:
 
 from ..utils.physics import CST, Planck, make_cont_Ercolano, gff
 from ..utils.misc import execution_path, change_size, convol, rebin, is_absorb, no_red_corr, gauss, carre, lorentz, convolgauss 
+from ..utils.misc import make_adaptive_grid, rebin_adaptive, find_rows, last_occurrences, fork_pool, grid_hash
+from ..utils.misc import clipped_medians
 from ..utils.misc import vactoair, airtovac, clean_label,  get_parser, read_data, my_execfile as execfile
+from ..utils.misc import parse_line_file, parse_line_bytes, read_bytes, printf_format, parse_columns_bytes, line_widths
 from ..core.profiles import profil_instr
+from ..core.line_index import LineIndex, WavelengthIndex, IonIndex
+from ..core.line_file import LineFile
+from ..core.line_db import LineDB
 
 """
 ToDo:
@@ -30,7 +40,14 @@ ToDo:
 # mvfc: 'save_data' removed because it is never used (and it is similar to 'print_data' in misc.py).
 
 # mvfc: changed to capture the error message  
-def read_data(filename, NF=True):
+def read_data(filename, NF=True, comments=True):
+    # The comments (a100, more than half of the size of a record) can be left in the file, see read_comments
+    return check_data(parse_line_file(filename, NF=NF, comments=comments))
+
+def check_data(dd):
+    """
+    Check the array read from a line file. Return it as a recarray (empty if there is an error) and the error message.
+    """
 
     def rows(mask):
         nMax = 5
@@ -40,20 +57,6 @@ def read_data(filename, NF=True):
             rows = rows + ', ...'
         return rows
     
-    dtype = 'i8, a1, a9, float64, float64, float64, float64, a1, i8, i4, f, a100'
-    if NF:
-        delimiter = [14, 1, 9, 11, 6, 10, 7, 1, 14, 4, 7, 100]
-    else:
-        delimiter = [ 9, 1, 9, 11, 6, 10, 7, 1,  9, 4, 7, 100]
-    names = ['num', 'foo', 'id', 'lambda','l_shift', 'i_rel', 'i_cor', 'foo2', 'ref', 'profile', 
-             'vitesse', 'comment']
-    usecols = (0, 2, 3, 4, 5, 6, 8, 9, 10, 11)
-    dd = np.genfromtxt(filename, dtype=dtype, delimiter=delimiter, names = names, usecols = usecols)
-
-    #mvfc: this is needed to avoid the problem of a cosmetic file with only one line            
-    if dd.size == 1:
-        dd = np.atleast_1d(dd)
-
     msg = ''
     if (dd['num'] == -1).sum() > 0:
         msg = msg + '\nInvalid line number at row: {}'.format(rows([dd['num'] == -1]))
@@ -77,6 +80,339 @@ def read_data(filename, NF=True):
 
     return dd.view(np.recarray), msg
 
+def read_comments(filename, NF=True, num_offset=0):
+    """
+    Return a dictionary {line code: comment} of the comments of a file in the read_data format.
+    num_offset is added to the line codes.
+    """
+    widths = line_widths(NF)
+    n_num, i_comment = widths[0], sum(widths[:-1])
+    comments = {}
+    with open(filename, 'r') as f:
+        for eachline in f:
+            try:
+                num = int(eachline[:n_num]) + num_offset
+            except ValueError:
+                continue
+            comments[num] = eachline[i_comment:].rstrip('\r\n')
+    return comments
+
+def file_hash(filename):
+    """
+    MD5 hexdigest of the content of a file.
+    """
+    h = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+# Version of the format of the cache files, part of their names: to be increased each time the parsers
+# (parse_line_bytes, parse_columns_bytes, read_line_index) or the arrays they return are changed.
+CACHE_VERSION = 3
+
+def default_cache_dir():
+    """
+    Per-user directory of the cache files: $XDG_CACHE_HOME/pyssn, by default ~/.cache/pyssn.
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'pyssn')
+
+def _cache_file(filename, cache_dir, tag):
+    """
+    Name (without extension) of a cache file of filename, in cache_dir (default: default_cache_dir()).
+    """
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    key = hashlib.md5('{0}|{1}|{2}'.format(filename, tag, CACHE_VERSION).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache_dir, '{0}.{1}'.format(os.path.basename(filename), key))
+
+def _cache_is_valid(cache_file, filename):
+    """
+    Whether the cache file was made from the current content of filename: same size and modification time,
+    or same size and content (the modification time is then updated in the cache metadata).
+    """
+    stat = os.stat(filename)
+    try:
+        with open(cache_file + '.json', 'r') as f:
+            meta = json.load(f)
+    except (IOError, OSError, ValueError):
+        return False
+    if meta['size'] != stat.st_size:
+        return False
+    if meta['mtime'] != stat.st_mtime:
+        if meta['hash'] != file_hash(filename):
+            return False
+        meta['mtime'] = stat.st_mtime
+        _write_cache_meta(cache_file, meta)
+    return True
+
+def _cache_meta(filename):
+    """
+    Metadata of a cache file of filename: size, modification time and hash of filename.
+    To be taken before reading filename, so that a cache file is never stamped with the metadata 
+    of a content it was not made from.
+    """
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': file_hash(filename)}
+
+def _write_cache(cache_file, filename, ext, save, meta):
+    """
+    Write a cache file of filename with save(f), f being a file object, and its metadata meta (see _cache_meta).
+    Nothing is written if filename was changed since meta was taken.
+    The files are written under temporary names and then renamed.
+    """
+    try:
+        stat = os.stat(filename)
+        if (stat.st_size, stat.st_mtime) != (meta['size'], meta['mtime']):
+            log_.debug('{0} changed while read, not cached'.format(filename), calling='_write_cache')
+            return
+        if not os.path.isdir(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+        tmp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            save(f)
+        os.rename(tmp_file, cache_file + ext)
+        _write_cache_meta(cache_file, meta)
+    except (IOError, OSError) as e:
+        log_.debug('Unable to write cache of {0}: {1}'.format(filename, e), calling='_write_cache')
+
+def _write_cache_meta(cache_file, meta):
+    try:
+        tmp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp_file, cache_file + '.json')
+    except (IOError, OSError):
+        pass
+
+def read_data_cached(filename, NF=True, comments=True, cache_dir=None):
+    """
+    Same as read_data, but the parsed array is saved in a .npy file (in cache_dir, default: default_cache_dir())
+    and reused as long as the file has the same size and modification time,
+    or the same content. The cached array is memory-mapped in copy-on-write mode.
+    """
+    filename = os.path.abspath(filename)
+    cache_file = _cache_file(filename, cache_dir, '{0}|{1}'.format(NF, comments))
+    if _cache_is_valid(cache_file, filename):
+        try:
+            dd = np.load(cache_file + '.npy', mmap_mode='c')
+            log_.debug('{0} read from cache {1}.npy'.format(filename, cache_file), calling='read_data_cached')
+            return dd.view(np.recarray), ''
+        except (IOError, OSError, ValueError):
+            pass
+    meta = _cache_meta(filename)
+    dd, msg = read_data(filename, NF=NF, comments=comments)
+    if msg == '' and len(dd) > 0:
+        _write_cache(cache_file, filename, '.npy', lambda f: np.save(f, np.asarray(dd)), meta)
+    return dd, msg
+
+# Last index built by read_line_index without disk cache: {(file name, NF): ((size, mtime), index)}
+_index_cache = {}
+
+def read_line_index(filename, NF=True, disk_cache=True, cache_dir=None):
+    """
+    Index of a line file, built at the first call. If disk_cache, it is saved in a .npz file next to 
+    the .npy cache files (see read_data_cached), otherwise the index of the last file is kept in memory 
+    as long as the file has the same size and modification time.
+    It is a dictionary of arrays (one element per line of data of the file): 
+    start and end (byte offsets of the line in the uncompressed file), num, ref, 
+    lambda_order (the rows sorted by wavelength) and lambda_sorted (the sorted wavelengths).
+    """
+    filename = os.path.abspath(filename)
+    if disk_cache:
+        cache_file = _cache_file(filename, cache_dir, '{0}|index'.format(NF))
+        if _cache_is_valid(cache_file, filename):
+            try:
+                with np.load(cache_file + '.npz') as f:
+                    return dict((key, f[key]) for key in f.files)
+            except (IOError, OSError, ValueError):
+                pass
+        meta = _cache_meta(filename)
+    else:
+        stat = os.stat(filename)
+        stamp = (stat.st_size, stat.st_mtime)
+        if (filename, NF) in _index_cache and _index_cache[(filename, NF)][0] == stamp:
+            return _index_cache[(filename, NF)][1]
+    content = read_bytes(filename)
+    raw = np.frombuffer(content, dtype=np.uint8)
+    start = np.append(0, np.flatnonzero(raw == 10) + 1)
+    end = np.append(start[1:], len(content))
+    # Same lines as parse_line_bytes: the empty ones and the ones starting with # are not data
+    data = end > start
+    data[data] = raw[start[data]] != ord('#')
+    start, end = start[data], end[data]
+    dd = parse_line_bytes(content, NF=NF, comments=False)
+    if len(dd) != len(start):
+        raise ValueError('Unable to index {0}'.format(filename))
+    lambda_order = np.argsort(dd['lambda'], kind='mergesort')
+    index = {'start': start, 'end': end, 'num': dd['num'], 'ref': dd['ref'], 
+             'lambda_order': lambda_order, 'lambda_sorted': dd['lambda'][lambda_order]}
+    if disk_cache:
+        _write_cache(cache_file, filename, '.npz', lambda f: np.savez(f, **index), meta)
+    else:
+        _index_cache.clear()
+        _index_cache[(filename, NF)] = (stamp, index)
+    return index
+
+def read_data_range(filename, w_min, w_max, NF=True, comments=True, disk_cache=True, cache_dir=None):
+    """
+    Same as read_data, but only the lines with w_min <= lambda <= w_max are read, with their reference lines 
+    (up to the end of their chains of references) and the lines with ref = 999, using the index of 
+    read_line_index to parse only these lines. The lines are in the same order as in the file.
+    """
+    index = read_line_index(filename, NF=NF, disk_cache=disk_cache, cache_dir=cache_dir)
+    num_order = np.argsort(index['num'], kind='mergesort')
+    sorted_num = index['num'][num_order]
+    i1 = np.searchsorted(index['lambda_sorted'], w_min, side='left')
+    i2 = np.searchsorted(index['lambda_sorted'], w_max, side='right')
+    selected = np.zeros(len(index['num']), dtype=bool)
+    selected[index['lambda_order'][i1:i2]] = True
+    selected[index['ref'] == 999] = True
+    new_rows = np.flatnonzero(selected)
+    while len(new_rows) > 0:
+        refs = np.unique(index['ref'][new_rows])
+        refs = refs[(refs != 0) & (refs != -1) & (refs != 999)]
+        left = np.searchsorted(sorted_num, refs, side='left')
+        right = np.searchsorted(sorted_num, refs, side='right')
+        parents = num_order[np.concatenate([np.arange(l, r) for l, r in zip(left, right)] + [np.zeros(0, dtype=int)])]
+        new_rows = parents[~selected[parents]]
+        selected[new_rows] = True
+    rows = np.flatnonzero(selected)
+    if filename.endswith('.gz') or len(rows) == 0:
+        content = read_bytes(filename)
+        lines = [content[s:e] for s, e in zip(index['start'][rows], index['end'][rows])]
+    else:
+        # Only the pages of the file holding the selected lines are read
+        with open(filename, 'rb') as f:
+            content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                lines = [content[s:e] for s, e in zip(index['start'][rows], index['end'][rows])]
+            finally:
+                content.close()
+    if len(lines) > 0 and not lines[-1].endswith(b'\n'):
+        lines[-1] = lines[-1] + b'\n'
+    log_.debug('{0} lines of {1} read from {2}'.format(len(rows), len(selected), filename), calling='read_data_range')
+    return check_data(parse_line_bytes(b''.join(lines), NF=NF, comments=comments))
+
+# Segments synthesized by the processes of spectrum.run_segments (inherited from the parent process)
+_segments = None
+
+# Attributes of a segment not sent back from the processes of spectrum.run_segments: the handles (database
+# connection, line files, figures) and the line lists, set by run_segments and only read by the segments.
+# All the other attributes (synthesis, continua, cont_auto, caches...) are sent back.
+_segment_unsent = ('line_db', 'line_files', 'segments', 'fig1', 'fig2', 'fig3', 'ax1', 'ax2', 'ax3', 'cursor',
+                   'phyat_arr', 'model_arr', 'cosmetik_arr', 'liste_totale', 'liste_raies', 'restric_rows')
+
+def _run_segment(i):
+    seg = _segments[i]
+    seg.run(do_read_liste=False, do_profiles=False)
+    return dict((key, value) for key, value in seg.__dict__.items() if key not in _segment_unsent)
+
+# Last observation file read: {file name: ((size, mtime), array)}
+_obs_cache = {}
+
+def read_obs_data(filename, disk_cache=True, cache_dir=None):
+    """
+    Content of an observation file in the .spr or .spr.gz format (one or more columns of numbers), same as
+    np.loadtxt(filename). The array of the last file read is kept in memory and reused as long as the file has
+    the same size and modification time. If disk_cache, it is also saved in a .npy file (see read_data_cached), memory-mapped 
+    when read again. The returned array must not be modified in place.
+    """
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    stamp = (stat.st_size, stat.st_mtime)
+    if filename in _obs_cache and _obs_cache[filename][0] == stamp:
+        return _obs_cache[filename][1]
+    obs = None
+    if disk_cache:
+        cache_file = _cache_file(filename, cache_dir, 'obs')
+        if _cache_is_valid(cache_file, filename):
+            try:
+                obs = np.load(cache_file + '.npy', mmap_mode='r')
+                log_.debug('{0} read from cache {1}.npy'.format(filename, cache_file), calling='read_obs_data')
+            except (IOError, OSError, ValueError):
+                obs = None
+    if obs is None:
+        if disk_cache:
+            meta = _cache_meta(filename)
+        obs = parse_columns_bytes(read_bytes(filename))
+        if disk_cache:
+            _write_cache(cache_file, filename, '.npy', lambda f: np.save(f, obs), meta)
+    _obs_cache.clear()
+    _obs_cache[filename] = (stamp, obs)
+    return obs
+
+def _fits_dispersion(header, axis):
+    n = str(axis)
+    return (header['CRVAL'+n], header.get('CRPIX'+n, 1.), header.get('CDELT'+n, header.get('CD{0}_{0}'.format(n))), 
+            str(header.get('CTYPE'+n, '')).strip().upper())
+
+def fits_wavelengths(header, pixels, axis=1):
+    """
+    Wavelengths of the (0-based) pixels of a 1D spectrum, from the CRVAL1, CRPIX1 and CDELT1 (or CD1_1) keywords
+    of its header (CRVAL3... for axis=3, e.g. the spectral axis of a cube). The dispersion is log-linear if 
+    DC-FLAG = 1 (IRAF convention, CRVAL1 and CDELT1 in log10 of the wavelength) or if CTYPE1 = 'WAVE-LOG' 
+    (FITS WCS convention).
+    """
+    crval, crpix, cdelt, ctype = _fits_dispersion(header, axis)
+    x = np.asarray(pixels) + 1. - crpix
+    if header.get('DC-FLAG', 0) == 1:
+        return 10.**(crval + x * cdelt)
+    elif ctype == 'WAVE-LOG':
+        return crval * np.exp(x * cdelt / crval)
+    else:
+        return crval + x * cdelt
+
+def fits_pixels(header, wavelengths, axis=1):
+    """
+    Inverse of fits_wavelengths: (fractional, 0-based) pixels of the wavelengths.
+    """
+    crval, crpix, cdelt, ctype = _fits_dispersion(header, axis)
+    w = np.asarray(wavelengths, dtype=float)
+    if header.get('DC-FLAG', 0) == 1:
+        x = (np.log10(w) - crval) / cdelt
+    elif ctype == 'WAVE-LOG':
+        x = crval * np.log(w / crval) / cdelt
+    else:
+        x = (w - crval) / cdelt
+    return x + crpix - 1.
+
+def read_fits_obs(filename, w_lims=None, flux_ext=None, var_ext=None, mask_ext=None):
+    """
+    Read a 1D spectrum from a FITS file, memory-mapped. Return w, f, var and mask (None if var_ext or
+    mask_ext is None). flux_ext, var_ext and mask_ext are the extensions (index or name) of the flux, variance 
+    and mask; by default the flux is in the first HDU having data.
+    If w_lims = (w_min, w_max) is given, only the section of the pixels covering it (plus one pixel at each 
+    side) is read.
+    """
+    from astropy.io import fits
+    with fits.open(filename, memmap=True) as hdul:
+        if flux_ext is None:
+            flux_ext = [i for i, hdu in enumerate(hdul) if hdu.header.get('NAXIS', 0) > 0][0]
+        header = hdul[flux_ext].header
+        n_pix = header['NAXIS1']
+        i1, i2 = 0, n_pix
+        if w_lims is not None and header['NAXIS'] == 1:
+            p = fits_pixels(header, w_lims)
+            i1 = int(max(0, np.floor(np.min(p)) - 1))
+            i2 = int(min(n_pix, np.ceil(np.max(p)) + 2))
+            i2 = max(i1, i2)
+
+        def read_ext(ext):
+            hdu = hdul[ext]
+            if hdu.header['NAXIS'] == 1:
+                return np.array(hdu.section[i1:i2])
+            else:
+                return np.squeeze(np.array(hdu.data))[i1:i2]
+
+        f = read_ext(flux_ext)
+        var = None if var_ext is None else read_ext(var_ext)
+        mask = None if mask_ext is None else read_ext(mask_ext)
+    w = fits_wavelengths(header, np.arange(i1, i2))
+    log_.message('Pixels {0} to {1} of {2} read from {3}'.format(i1, i2, n_pix, filename), calling='read_fits_obs')
+    return w, f, var, mask
+
 class spectrum(object):
     
     def __init__(self, config_file=None, phyat_file=None, profil_instr=profil_instr, 
@@ -257,6 +593,25 @@ class spectrum(object):
         self.y3_plot_lims = None
         
         self.read_obs_error = ''
+        
+        self.w_synth = None
+        self.synth_starts = None
+        self.blend_map = {}
+        self.cosmetik_report = None
+        self.line_indexes = {}
+        self.wl_index = None
+        self.ion_index = None
+        self.comment_files = {}
+        self.comment_tables = {}
+        self.line_files = {}
+        self.line_db = None
+        self.segments = None
+        self.obs_raw = None
+        self.phyat_range = None
+        self.cont_cache = {}
+        self.red_corr_cache = {}
+        self.cont_auto = None
+        self.cont_auto_state = None
  
     def init_obs(self, spectr_obs=None, sp_norm=None, obj_velo=None, limit_sp=None):
         
@@ -278,20 +633,31 @@ class spectrum(object):
         if do_profiles:
             self.do_profile_dict()
         
+        if do_synth and not do_read_liste and not self.phyat_range_covers():
+            log_.warn('The synthesis range is outside the range of the atomic data read (phyat_lazy_load), '
+                      'the line lists are read again', calling=self.calling)
+            do_read_liste = True
         if do_synth:
             if do_read_liste:
                 self.fic_model = self.get_conf('fic_modele', message='error')
+                self.comment_tables = {}
                 self.model_arr = self.read_model(self.fic_model)
-                self.phyat_arr, self.n_data = self.read_phyat(self.phyat_file)
-                self.n_models = len(self.model_arr)
                 # mvfc: 'if self.fic_cosmetik is None' tested inside read_cosmetik
+                # The cosmetik lines are read first, their shifts are needed by phyat_lazy_load
                 self.cosmetik_arr, errorMsg = self.read_cosmetik()
                 self.n_cosmetik = len(self.cosmetik_arr)
+                self.phyat_arr, self.n_data = self.read_phyat(self.phyat_file)
+                self.n_models = len(self.model_arr)
 
                 self.sp_theo, self.liste_totale, self.liste_raies = \
                     self.append_lists(self.phyat_arr, self.model_arr, self.cosmetik_arr)
+                self.line_indexes = {}
+                self.wl_index = None
+                self.ion_index = None
         
-            self.sp_theo, self.sp_synth = self.make_synth(self.liste_raies, self.sp_theo)
+            self.liste_synth, self.blend_map = self.merge_blends(self.liste_raies)
+            self.make_synth_grid(self.liste_raies)
+            self.sp_theo, self.sp_synth = self.make_synth(self.liste_synth, self.sp_theo)
             self.n_sp_theo = len(self.sp_theo['spectr'])
         else:
             self.sp_theo = None
@@ -305,7 +671,112 @@ class spectrum(object):
         self.make_filter_instr()
         self.sp_synth_tot = self.convol_synth(self.cont, self.sp_synth)
         self.cont_lr, self.sp_synth_lr = self.rebin_on_obs()
+        self.update_cont_auto()
                 
+    def init_segments(self):
+        """
+        Create a spectrum object for each segment of obs_segments (a list of dictionaries of configuration 
+        parameters, e.g. spectr_obs, limit_sp, prof, sp_norm, obj_velo, resol, overriding the ones of self)
+        and read its observations (see copy_segment).
+        """
+        self.segments = []
+        for seg_conf in self.get_conf('obs_segments', None) or []:
+            seg = self.copy_segment(seg_conf)
+            seg.init_obs()
+            seg.init_red_corr()
+            seg.make_continuum()
+            self.segments.append(seg)
+        log_.message('{0} segments initialized'.format(len(self.segments)), calling=self.calling)
+
+    def copy_segment(self, seg_conf):
+        """
+        Copy of self whose configuration parameters are overridden by the ones of the dictionary seg_conf.
+        The copy shares the line lists and the profiles of self, and has its own caches and its own connection
+        to the line_db database.
+        """
+        seg = copy.copy(self)
+        seg.conf = dict(self.conf)
+        seg.conf.update(seg_conf)
+        seg.conf['limit_sp'] = list(seg.conf['limit_sp'])
+        seg.segments = None
+        seg.cont_cache = {}
+        seg.red_corr_cache = {}
+        seg.line_indexes = {}
+        seg.comment_tables = {}
+        seg.line_files = {}
+        seg.line_db = None
+        return seg
+
+    def run_segments(self):
+        """
+        Synthesis of all the segments (see init_segments) from one line list, restricted once to the union
+        of their wavelength ranges. The segments are synthesized in parallel processes if multiprocessing is
+        enabled (config.use_multiprocs()). The lists must have been read (run with do_read_liste=True).
+        With phyat_lazy_load, the atomic data are read again if they do not cover all the segments.
+        """
+        if self.segments is None:
+            self.init_segments()
+        if len(self.segments) == 0:
+            return
+        w_lims = (min([np.min(seg.w) for seg in self.segments]), max([np.max(seg.w) for seg in self.segments]))
+        if not self.phyat_range_covers(w_lims):
+            log_.message('The segments are outside the range of the atomic data read (phyat_lazy_load), '
+                         'the atomic data are read again', calling=self.calling)
+            self.phyat_arr, self.n_data = self.read_phyat(self.phyat_file, w_lims=w_lims)
+        restric_rows = getattr(self, 'restric_rows', None)
+        sp_theo, liste_totale, liste_raies = self.append_lists(self.phyat_arr, self.model_arr, self.cosmetik_arr, 
+                                                               w_lims=w_lims)
+        rows = self.restric_rows
+        self.restric_rows = restric_rows
+        # Wavelengths on which the restriction is done, before the shifts of the reference lines are applied
+        w_restr = liste_totale['lambda'][rows] + liste_totale['l_shift'][rows]
+        n_models = len(sp_theo['correc'])
+        for seg in self.segments:
+            in_seg = (w_restr < np.max(seg.w)) & (w_restr > np.min(seg.w))
+            seg.liste_totale = liste_totale
+            seg.liste_raies = liste_raies[in_seg]
+            seg.restric_rows = rows[in_seg]
+            seg.sp_theo = {'raie_ref': sp_theo['raie_ref'], 'correc': np.zeros(n_models), 
+                           'spectr': np.zeros((n_models, len(seg.w)))}
+            seg.line_indexes = {}
+            seg.wl_index = None
+            seg.ion_index = None
+            # The line lists of the segments are the ones of self, never read again by the segments
+            seg.phyat_range = None
+        
+        global _segments
+        if config.INSTALLED['mp'] and config._use_mp and len(self.segments) > 1 and hasattr(os, 'fork'):
+            _segments = self.segments
+            pool = fork_pool(min(config.Nprocs, len(self.segments)))
+            try:
+                results = pool.map(_run_segment, range(len(self.segments)))
+            finally:
+                pool.close()
+                pool.join()
+                _segments = None
+            for seg, res in zip(self.segments, results):
+                seg.__dict__.update(res)
+        else:
+            for seg in self.segments:
+                seg.run(do_read_liste=False, do_profiles=False)
+        log_.message('{0} segments synthesized from {1} lines'.format(len(self.segments), len(liste_raies)), 
+                     calling=self.calling)
+
+    def merge_segments(self):
+        """
+        Merged view of the segments: wavelengths, observations, continuum and synthesis (at the resolution 
+        of the observations) of all the segments, sorted by wavelength. In the overlaps, the pixels of all
+        the segments are kept.
+        """
+        if not self.segments:
+            return None
+        w = np.concatenate([seg.w_ori for seg in self.segments])
+        order = np.argsort(w, kind='mergesort')
+        res = [w[order]]
+        for key in ('f_ori', 'cont_lr', 'sp_synth_lr'):
+            res.append(np.concatenate([getattr(seg, key) for seg in self.segments])[order])
+        return res
+
     def do_profile_dict(self, return_res=False):
         
         self.fic_profs = self.get_conf('fic_profile', None)
@@ -385,8 +856,12 @@ class spectrum(object):
         return np.unique(ref_diff)
 
                 
-    def get_profile(self, raie):
-        
+    def get_profile(self, raie, w=None, adaptive=False):
+        """
+        Profile of the line raie on w (default: self.w). adaptive: w is the grid of make_adaptive_grid.
+        """
+        if w is None:
+            w = self.w
         basic_profiles_dic = {'G': (3, gauss),
                               'C': (3, carre),
                               'L': (3, lorentz)}
@@ -400,9 +875,9 @@ class spectrum(object):
         params_str = self.emis_profiles[profile_key]['params']
 
         lambda_0 = raie['lambda'] + raie['l_shift'] + self.get_conf('lambda_shift', 0.0) 
-        w_norm = self.w - lambda_0 - vel * lambda_0 / CST.CLIGHT * 1e5
+        w_norm = w - lambda_0 - vel * lambda_0 / CST.CLIGHT * 1e5
         
-        profile = np.zeros_like(self.w)
+        profile = np.zeros_like(w)
         largeur = raie['vitesse'] * lambda_0 / CST.CLIGHT * 1e5
         masse =  2 * (raie['num'] - raie['num'] % 100000000000)/100000000000
         if (masse == 2 and (raie['num'] - raie['num'] % 101000000000)/100000000 == 1010) : 
@@ -418,7 +893,7 @@ class spectrum(object):
             profile += basic_profiles_dic[profile_type][1](w_norm, params[0], params[1]*largeur, params[2]*largeur)
         if T4 > 0.0:
             fwhm_therm = 21.4721 * np.sqrt(T4 / masse) * lambda_0 / CST.CLIGHT * 1e5 #km/s
-            profile = convolgauss(profile, self.w, lambda_0, fwhm_therm)
+            profile = convolgauss(profile, w, lambda_0, fwhm_therm, adaptive=adaptive)
         profile[~np.isfinite(profile)] = 0.0
         return profile
                     
@@ -502,13 +977,32 @@ class spectrum(object):
         """
         self.conf[key] = value
                     
-    def read_phyat(self, phyat_file):
-        
+    def read_phyat(self, phyat_file, w_lims=None):
+        """
+        Read the atomic database. With phyat_lazy_load, only the lines needed for a synthesis on w_lims 
+        (default: the range of self.w) are read, see get_phyat_range.
+        """
         self.phyat_file = phyat_file
         phyat_arr = []
         for dir_ in config.DataPaths:
             try:
-                phyat_arr, msg = read_data('{0}/{1}'.format(dir_, self.phyat_file))
+                self.phyat_range = None
+                if self.get_conf('phyat_lazy_load', False) and getattr(self, 'w', None) is not None:
+                    w_min, w_max = self.get_phyat_range(w_lims)
+                    margin = self.get_conf('phyat_lazy_margin', 1.) / 100.
+                    w_min, w_max = w_min * (1. - margin), w_max * (1. + margin)
+                    self.phyat_range = (w_min, w_max)
+                    if self.get_line_db() is not None:
+                        phyat_arr, msg = check_data(self.get_line_db().read_range('{0}/{1}'.format(dir_, self.phyat_file), 
+                                                    w_min, w_max, comments=self.comments_in_lists()))
+                    else:
+                        phyat_arr, msg = read_data_range('{0}/{1}'.format(dir_, self.phyat_file), w_min, w_max,
+                                                         comments=self.comments_in_lists(), 
+                                                         disk_cache=self.get_conf('data_cache', False),
+                                                         cache_dir=self.get_conf('data_cache_dir', None))
+                else:
+                    phyat_arr, msg = self.read_line_list('{0}/{1}'.format(dir_, self.phyat_file))
+                self.comment_files['phyat'] = ('{0}/{1}'.format(dir_, self.phyat_file), 0)
                 log_.message('phyat data read from {0}/{1}'.format(dir_, self.phyat_file),
                                 calling = self.calling)
                 break
@@ -520,19 +1014,110 @@ class spectrum(object):
             return None
         return phyat_arr, len(phyat_arr)
         
+    def get_phyat_range(self, w_lims=None):
+        """
+        Range of the wavelengths of the atomic data needed for a synthesis on w_lims (default: the range of self.w):
+        w_lims increased at each side by the largest shift of the cosmetik lines, which can move lines into w_lims.
+        """
+        if w_lims is None:
+            w_lims = (np.min(self.w), np.max(self.w))
+        shift = 0.
+        cosmetik_arr = getattr(self, 'cosmetik_arr', None)
+        if getattr(self, 'do_cosmetik', False) and cosmetik_arr is not None and len(cosmetik_arr) > 0:
+            shift = np.max(np.abs(cosmetik_arr['l_shift']))
+        return (w_lims[0] - shift, w_lims[1] + shift)
+    
+    def phyat_range_covers(self, w_lims=None):
+        """
+        Whether the atomic data read with phyat_lazy_load hold all the lines needed for a synthesis on w_lims
+        (default: the range of self.w). Always True if all the atomic data were read.
+        """
+        if self.phyat_range is None:
+            return True
+        w_min, w_max = self.get_phyat_range(w_lims)
+        return w_min >= self.phyat_range[0] and w_max <= self.phyat_range[1]
+
+    def read_line_list(self, filename):
+        """
+        Read a file in the line list format, from the line_db database if it is set, 
+        or using the binary cache if data_cache is set.
+        """
+        if self.get_line_db() is not None:
+            return check_data(self.get_line_db().read_list(filename, comments=self.comments_in_lists()))
+        elif self.get_conf('data_cache', False):
+            return read_data_cached(filename, comments=self.comments_in_lists(), 
+                                    cache_dir=self.get_conf('data_cache_dir', None))
+        else:
+            return read_data(filename, comments=self.comments_in_lists())
+
+    def get_line_db(self):
+        """
+        The LineDB of the line_db option, None if it is not set.
+        """
+        db_file = self.get_conf('line_db', None)
+        if db_file is None:
+            return None
+        if self.line_db is None or self.line_db.db_file != os.path.abspath(db_file):
+            self.line_db = LineDB(db_file)
+        return self.line_db
+
+    def get_synth_db(self):
+        """
+        The LineDB of the line_db option, with liste_raies loaded in its synth table (again each time
+        liste_raies is rebuilt), None if line_db is not set.
+        """
+        line_db = self.get_line_db()
+        if line_db is not None and line_db.synth_arr is not self.liste_raies:
+            line_db.set_synth_list(self.liste_raies)
+        return line_db
+
+    def comments_in_lists(self):
+        """
+        Whether the comments are kept in the line lists or read from the files only when needed (get_comment).
+        """
+        return not self.get_conf('lazy_comments', False)
+
+    def get_comment(self, line):
+        """
+        Comment of a line (a record of one of the line lists).
+        If the lists are read without their comments, they are taken from the phyat or model files, which
+        are read the first time a comment is needed.
+        """
+        if 'comment' in line.dtype.names:
+            return line['comment']
+        for key in ('model', 'phyat'):
+            if key not in self.comment_files:
+                continue
+            if key not in self.comment_tables:
+                filename, num_offset = self.comment_files[key]
+                try:
+                    if self.get_line_db() is not None:
+                        self.comment_tables[key] = self.get_line_db().read_comments(filename, num_offset=num_offset)
+                    else:
+                        self.comment_tables[key] = read_comments(filename, num_offset=num_offset)
+                except IOError:
+                    log_.warn('unable to read comments from {0}'.format(filename), calling = self.calling)
+                    self.comment_tables[key] = {}
+            if int(line['num']) in self.comment_tables[key]:
+                return self.comment_tables[key][int(line['num'])]
+        return ''
+
     def read_model(self, model_file):
         
         model_arr = []
         if model_file == 'from phyat':
             mask = self.phyat_arr['ref'] == 999
-            model_arr = self.phyat_arr.copy()[mask]
+            model_arr = self.phyat_arr[mask]
             model_arr['num'] -= 90000000000000
+            if 'phyat' in self.comment_files:
+                self.comment_files['model'] = (self.comment_files['phyat'][0], -90000000000000)
             model_arr['vitesse'] = 10
             log_.message('data initialized from phyat',
                                 calling = self.calling) 
         else:
             try:
-                model_arr, msg = read_data('{0}'.format(self.directory + model_file))
+                model_arr, msg = self.read_line_list('{0}'.format(self.directory + model_file))
+                self.comment_files['model'] = ('{0}'.format(self.directory + model_file), 0)
                 log_.message('data read from {0}'.format(self.directory + model_file),
                                     calling = self.calling)
             except:
@@ -569,7 +1154,7 @@ class spectrum(object):
                 path = self.directory + self.fic_cosmetik
             if os.path.isfile(path):
                 if os.path.getsize(path) > 0:
-                    cosmetik_arr, ErrorMsg = read_data(path)
+                    cosmetik_arr, ErrorMsg = self.read_line_list(path)
                     if ErrorMsg == '':
                         log_.message('cosmetik read from {0}'.format(path), calling = self.calling)
                     else:
@@ -584,9 +1169,27 @@ class spectrum(object):
             
         return cosmetik_arr, ErrorMsg
 
+    def get_obs_w_lims(self):
+        """
+        Range of the wavelengths of the observations (before the velocity correction) needed to cover limit_sp,
+        None if limit_sp is not defined.
+        """
+        if self.limit_sp[0] < 0.01 or self.limit_sp[1] > 0.9e10:
+            return None
+        velo = self.get_conf('obj_velo', 0.)
+        if type(velo) is list:
+            velo = max([abs(v[1]) for v in velo])
+        velo_fact = abs(velo) / (CST.CLIGHT/1e5)
+        w_lims = np.array([self.limit_sp[0] / (1. + velo_fact), self.limit_sp[1] / (1. - velo_fact)])
+        if self.get_conf('wave_unit') == 'mu':
+            w_lims /= 10000.
+        return w_lims
+
     def read_obs(self, k_spline = 1):
 
         self.read_obs_error = ''
+        self.obs_var = None
+        self.obs_mask = None
         if self.get_conf('spectr_obs') is not None:
             s = self.conf['spectr_obs'].split('.')
             if len(s) == 1:
@@ -605,17 +1208,20 @@ class spectrum(object):
                 log_.warn(self.read_obs_error, calling = self.calling)
             else:
                 if obs_file.split('.')[-1] == 'fits':
-                    from astropy.io import fits
                     try:
-                        self.f, header = fits.getdata(obs_file, header=True)
-                        dispersion_start = header['CRVAL1'] - (header['CRPIX1'] - 1) * header['CDELT1']
-                        self.w = dispersion_start + np.arange(len(self.f)) * header['CDELT1']
+                        self.w, self.f, self.obs_var, self.obs_mask = read_fits_obs(obs_file, 
+                                                   w_lims=self.get_obs_w_lims(),
+                                                   flux_ext=self.get_conf('fits_flux_ext', None),
+                                                   var_ext=self.get_conf('fits_var_ext', None),
+                                                   mask_ext=self.get_conf('fits_mask_ext', None))
                     except:
                         self.read_obs_error = 'Observations NOT read from {0}'.format(obs_file)
                         log_.warn(self.read_obs_error, calling = self.calling)
                 else:
                     try:                
-                        self.obs = np.loadtxt(obs_file)
+                        # The cached array is copied, as self.w and self.f are modified in place
+                        self.obs = np.array(read_obs_data(obs_file, disk_cache=self.get_conf('data_cache', False), 
+                                                          cache_dir=self.get_conf('data_cache_dir', None)))
                         log_.message('Observations read from {0}'.format(obs_file),
                                             calling = self.calling)
                         if bool(self.get_conf('data_incl_w', undefined = False)):
@@ -674,6 +1280,15 @@ class spectrum(object):
                 self.set_conf('obj_velo', 0.0)
                 log_.warn('Error interpolating radial velocity; set to 0.0', calling = self.calling)
             
+        # Observations before the Doppler correction and the resizing, used by change_velo
+        if self.get_conf('spectr_obs') is not None and len(self.read_obs_error) == 0:
+            order = np.argsort(self.w, kind='mergesort')
+            self.obs_raw = {'w': self.w[order], 'f': self.f[order], 
+                            'var': None if self.obs_var is None else self.obs_var[order],
+                            'mask': None if self.obs_mask is None else self.obs_mask[order]}
+        else:
+            self.obs_raw = None
+            
         self.obj_velo = self.get_conf("obj_velo", undefined=0.)
         self.w *= 1 - self.obj_velo/(CST.CLIGHT/1e5)
         log_.message('Wavelenghts shifted by Vel = {} km/s'.format(self.conf["obj_velo"]),
@@ -684,11 +1299,30 @@ class spectrum(object):
 
         self.w = self.w[lims]
         self.f = self.f[lims]
+        if self.obs_var is not None:
+            self.obs_var = self.obs_var[lims]
+        if self.obs_mask is not None:
+            self.obs_mask = self.obs_mask[lims]
 
+        self.make_obs_grid()
+        
+    def make_obs_grid(self):
+        """
+        Define the synthesis grid from the observations self.w, self.f and the pixels self.tab_pix: they are 
+        oversampled by a factor of resol, unless adaptive_grid is set. The observations are kept in w_ori and f_ori.
+        """
         self.w_ori = self.w.copy()
         self.f_ori = self.f.copy()
         
         resol = self.get_conf('resol', undefined = 1, message=None)
+        if bool(self.get_conf('adaptive_grid', False)) and resol > 1:
+            self.adaptive_resol = resol
+            resol = 1
+            log_.message('Adaptive synthesis grid, refined by a factor of {0} around the lines'.format(self.adaptive_resol), 
+                         calling=self.calling)
+        else:
+            self.adaptive_resol = 1
+        self.resol = resol
         log_.message('Observations resized from {0} by a factor of {1}'.format(len(self.w), resol), 
                            calling=self.calling)
         self.w = change_size(self.w, resol)
@@ -700,123 +1334,232 @@ class spectrum(object):
                    calling = self.calling)
         
     def renorm(self, new_norm):
+        old_norm = self.get_conf('sp_norm', undefined = 1.)
         self.f /= self.get_conf('sp_norm', undefined = 1.)
         self.f_ori /= self.get_conf('sp_norm', undefined = 1.)
         self.set_conf('sp_norm', new_norm)
         self.f *= self.get_conf('sp_norm', undefined = 1.)
         self.f_ori *= self.get_conf('sp_norm', undefined = 1.)
+        if self.obs_raw is not None:
+            self.obs_raw['f'] = self.obs_raw['f'] * new_norm / old_norm
 
+    def change_velo(self, obj_velo):
+        """
+        Change the velocity of the object without reading the observations nor running the synthesis again:
+        the observations (kept in obs_raw by read_obs) are shifted to the new velocity and linearly interpolated 
+        on the pixels w_ori, on which the synthesis is unchanged, and the automatic continuum is fitted again.
+        If the shifted observations do not cover w_ori (e.g. a section of a FITS file read for limit_sp), they
+        are read again (init_obs) and the synthesis is run again on the new pixels. The spectrum limits are not 
+        redefined; init_obs and run must be called for that.
+        """
+        self.set_conf('obj_velo', obj_velo)
+        self.obj_velo = obj_velo
+        if self.obs_raw is None:
+            return
+        w = self.obs_raw['w'] * (1 - obj_velo/(CST.CLIGHT/1e5))
+        if np.min(self.w_ori) < w[0] or np.max(self.w_ori) > w[-1]:
+            log_.message('Observations not covering the spectrum at Vel = {0} km/s, read again'.format(obj_velo), 
+                         calling = self.calling)
+            self.init_obs()
+            self.init_red_corr()
+            self.make_continuum()
+            self.run(do_synth = self.do_synth, do_read_liste = True, do_profiles=False)
+            return
+        self.f_ori = np.interp(self.w_ori, w, self.obs_raw['f'])
+        self.f = change_size(self.f_ori, self.resol)
+        self.f *= self.aire_ref
+        if self.obs_raw['var'] is not None:
+            self.obs_var = np.interp(self.w_ori, w, self.obs_raw['var'])
+        if self.obs_raw['mask'] is not None:
+            i_nearest = np.clip(np.searchsorted(w, self.w_ori), 1, len(w) - 1)
+            i_nearest -= (self.w_ori - w[i_nearest - 1]) < (w[i_nearest] - self.w_ori)
+            self.obs_mask = self.obs_raw['mask'][i_nearest]
+        self.update_cont_auto()
+        log_.message('Observations shifted by Vel = {0} km/s'.format(obj_velo), calling = self.calling)
+        
+    def change_ebv(self, e_bv):
+        """
+        Apply a new E(B-V) without computing the line profiles again: the theoretical spectra of the reddened 
+        lines and the reddened part of the synthesis are multiplied by the ratio of the old and new corrections,
+        the continuum is summed again from its cached components, then the synthesis is convolved and rebinned.
+        A full synthesis is run if a reference line has satellites both corrected and not corrected for reddening,
+        or with adaptive_grid (the lines are computed on the refined grid, where the correction is not constant
+        over an observed pixel).
+        """
+        self.set_conf('e_bv', e_bv)
+        if self.sp_synth is None or 'red' not in self.sp_theo or self.sp_theo['red_mixed'] or \
+                self.synth_starts is not None:
+            self.init_red_corr()
+            self.make_continuum()
+            self.run(do_synth = self.do_synth, do_read_liste = False, do_profiles=False)
+            return
+        old_red_corr = self.red_corr
+        self.init_red_corr()
+        self.make_continuum()
+        ratio = old_red_corr / self.red_corr
+        self.sp_theo['spectr'][self.sp_theo['red']] *= ratio
+        nored_synth = self.sp_theo['nored_synth']
+        self.sp_synth = (self.sp_synth - nored_synth) * ratio + nored_synth
+        self.make_filter_instr()
+        self.sp_synth_tot = self.convol_synth(self.cont, self.sp_synth)
+        self.cont_lr, self.sp_synth_lr = self.rebin_on_obs()
+        self.update_cont_auto()
+        
     def init_red_corr(self):
         self.E_BV = self.get_conf('e_bv', 0.)
         self.R_V = self.get_conf('r_v', 3.1)
         if self.E_BV > 0:
-            RC = pn.RedCorr(E_BV = self.E_BV, law=self.get_conf('red_corr_law', message='error'), R_V=self.R_V)
-            self.red_corr = RC.getCorr(self.w, self.get_conf('lambda_ref_rougi', message='error'))
+            law = self.get_conf('red_corr_law', message='error')
+            lambda_ref = self.get_conf('lambda_ref_rougi', message='error')
+            key = (law, self.E_BV, self.R_V, lambda_ref, grid_hash(self.w))
+            if key not in self.red_corr_cache:
+                if len(self.red_corr_cache) >= 16:
+                    self.red_corr_cache.clear()
+                RC = pn.RedCorr(E_BV = self.E_BV, law=law, R_V=self.R_V)
+                self.red_corr_cache[key] = RC.getCorr(self.w, lambda_ref)
+            self.red_corr = self.red_corr_cache[key]
             log_.message('Reddening correction set to {0}'.format(self.E_BV), calling=self.calling)
         else:
             self.red_corr = np.ones_like(self.w)
         
     def make_continuum(self):
+        """
+        Continuum: sum of the components in self.conts (user, bb, pl, H, He1, He2, FF, 2photons), reddened.
+        Each component is kept in cont_cache with the parameters it depends on and the grid, and computed
+        again only when they change.
+        """
         
-        self.conts = {}
-        
-        user_cont = np.zeros_like(self.w)
-        if bool(self.get_conf("cont_in_lambda", False)):
-            user_cont_int = interpolate.interp1d(self.conf["cont_lambda"], self.conf["cont_intens"])
-            user_cont = user_cont_int(self.w)
-        
-        cont_pix = self.get_conf("cont_pix", 0.)
-        if cont_pix != 0:
-            arg_sort = np.array(cont_pix).argsort()
-            user_cont_int = interpolate.interp1d(np.array(cont_pix)[arg_sort], 
-                                                         np.array(self.get_conf("cont_intens", message='error'))[arg_sort])
-            user_cont = user_cont_int(self.tab_pix)    
-        self.conts['user'] = user_cont
-        
-        bb_cont = np.zeros_like(self.w)        
-        if "cont_bb_t" in self.conf:
-            if np.ndim(self.conf["cont_bb_t"]) == 0:
-                tab_T = np.array([self.conf["cont_bb_t"]])
-                tab_I = np.array([self.conf["cont_bb_i"]])
-            else:
-                tab_T = np.array(self.conf["cont_bb_t"])
-                tab_I = np.array(self.conf["cont_bb_i"])
-            for I, T in zip(tab_I, tab_T):
-                bb_cont += I * Planck(self.w, T) / T**4
-        self.conts['bb'] = bb_cont
+        def user_cont():
+            user_cont = np.zeros_like(self.w)
+            if bool(self.get_conf("cont_in_lambda", False)):
+                user_cont_int = interpolate.interp1d(self.conf["cont_lambda"], self.conf["cont_intens"])
+                user_cont = user_cont_int(self.w)
+            
+            cont_pix = self.get_conf("cont_pix", 0.)
+            if cont_pix != 0:
+                arg_sort = np.array(cont_pix).argsort()
+                user_cont_int = interpolate.interp1d(np.array(cont_pix)[arg_sort], 
+                                                             np.array(self.get_conf("cont_intens", message='error'))[arg_sort])
+                user_cont = user_cont_int(self.tab_pix)    
+            return user_cont
+        
+        def bb_cont():
+            bb_cont = np.zeros_like(self.w)        
+            if "cont_bb_t" in self.conf:
+                if np.ndim(self.conf["cont_bb_t"]) == 0:
+                    tab_T = np.array([self.conf["cont_bb_t"]])
+                    tab_I = np.array([self.conf["cont_bb_i"]])
+                else:
+                    tab_T = np.array(self.conf["cont_bb_t"])
+                    tab_I = np.array(self.conf["cont_bb_i"])
+                for I, T in zip(tab_I, tab_T):
+                    bb_cont += I * Planck(self.w, T) / T**4
+            return bb_cont
            
-        pl_cont = np.zeros_like(self.w)  # Power law
-        if "cont_pl_alpha" in self.conf:
-            if np.ndim(self.conf["cont_pl_alpha"]) == 0:
-                tab_alpha = np.array([self.conf["cont_pl_alpha"]])
-                tab_I = np.array([self.conf["cont_pl_i"]])
-            else:
-                tab_alpha = np.array(self.conf["cont_pl_alpha"])
-                tab_I = np.array(self.conf["cont_pl_i"])
-            for I, alpha in zip(tab_I, tab_alpha):
-                pl_cont += I * (self.w / 5000.)**alpha
-        self.conts['pl'] = pl_cont
+        def pl_cont():
+            pl_cont = np.zeros_like(self.w)  # Power law
+            if "cont_pl_alpha" in self.conf:
+                if np.ndim(self.conf["cont_pl_alpha"]) == 0:
+                    tab_alpha = np.array([self.conf["cont_pl_alpha"]])
+                    tab_I = np.array([self.conf["cont_pl_i"]])
+                else:
+                    tab_alpha = np.array(self.conf["cont_pl_alpha"])
+                    tab_I = np.array(self.conf["cont_pl_i"])
+                for I, alpha in zip(tab_I, tab_alpha):
+                    pl_cont += I * (self.w / 5000.)**alpha
+            return pl_cont
         
-        if self.conf["cont_hi_i"]  != 0.:
+        def emis_Hi():
             alfa = 1e-13 * 0.668 * (self.conf["cont_hi_t"]/1e4)**(-0.507) / \
                 (1. + 1.221*(self.conf["cont_hi_t"]/1e4)**(0.653)) * 1.000 
-            emis_Hi = alfa * CST.HPLANCK * CST.CLIGHT * 1e8 / 4861.3 # erg/s.cm3
-            H_cont = self.conf["cont_hi_i"] * make_cont_Ercolano(self.conf["cont_hi_t"],'H',airtovac(self.w)) / emis_Hi 
-            H_cont[~np.isfinite(H_cont)] = 0.
-            self.conts['H'] = H_cont
-        else:
-            self.conts['H'] = np.zeros_like(self.w)
+            return alfa * CST.HPLANCK * CST.CLIGHT * 1e8 / 4861.3 # erg/s.cm3
         
-        if self.conf["cont_hei_i"] != 0.0:
+        def emis_Hei():
             alfa = 1e-13 * 0.331 * (self.conf["cont_hei_t"]/1e4)**(-0.615) / \
                 (1. + 0.910*(self.conf["cont_hei_t"]/1e4)**(0.780)) * 0.7986
-            emis_Hei = alfa * CST.HPLANCK * CST.CLIGHT * 1e8 / 4471.5
-            He1_cont = self.conf["cont_hei_i"] * make_cont_Ercolano(self.conf["cont_hei_t"],'He1',airtovac(self.w)) / emis_Hei 
-            He1_cont[~np.isfinite(He1_cont)] = 0.
-            self.conts['He1'] = He1_cont
-        else:
-            self.conts['He1'] = np.zeros_like(self.w)
-
-        if self.conf["cont_heii_i"] != 0.0:
+            return alfa * CST.HPLANCK * CST.CLIGHT * 1e8 / 4471.5
+        
+        def emis_Heii():
             alfa = 2. * 1e-13 * 1.549 * (self.conf["cont_heii_t"]/1e4/4.)**(-0.693) / \
                 (1. + 2.884*(self.conf["cont_heii_t"]/1e4/4.)**(0.609))*1.000
-            emis_Heii = alfa * CST.HPLANCK * CST.CLIGHT * 1e8 / 4685.8
-            He2_cont = self.conf["cont_heii_i"] * make_cont_Ercolano(self.conf["cont_heii_t"],'He2',airtovac(self.w)) / emis_Heii 
-            He2_cont[~np.isfinite(He2_cont)] = 0.
-            self.conts['He2'] = He2_cont
-        else:
-            self.conts['He2'] = np.zeros_like(self.w)
-                
-        gff_HI = gff(1., self.conf["cont_hi_t"], self.w)
-        gff_HeI = gff(1., self.conf["cont_hei_t"], self.w)
-        gff_HeII = gff(4., self.conf["cont_heii_t"], self.w)
+            return alfa * CST.HPLANCK * CST.CLIGHT * 1e8 / 4685.8
         
+        def H_cont():
+            if self.conf["cont_hi_i"]  != 0.:
+                H_cont = self.conf["cont_hi_i"] * make_cont_Ercolano(self.conf["cont_hi_t"],'H',airtovac(self.w)) / emis_Hi() 
+                H_cont[~np.isfinite(H_cont)] = 0.
+                return H_cont
+            else:
+                return np.zeros_like(self.w)
+        
+        def He1_cont():
+            if self.conf["cont_hei_i"] != 0.0:
+                He1_cont = self.conf["cont_hei_i"] * make_cont_Ercolano(self.conf["cont_hei_t"],'He1',airtovac(self.w)) / emis_Hei() 
+                He1_cont[~np.isfinite(He1_cont)] = 0.
+                return He1_cont
+            else:
+                return np.zeros_like(self.w)
+
+        def He2_cont():
+            if self.conf["cont_heii_i"] != 0.0:
+                He2_cont = self.conf["cont_heii_i"] * make_cont_Ercolano(self.conf["cont_heii_t"],'He2',airtovac(self.w)) / emis_Heii() 
+                He2_cont[~np.isfinite(He2_cont)] = 0.
+                return He2_cont
+            else:
+                return np.zeros_like(self.w)
+                
         #32.d0*!phy.e^4.*!phy.h/3./!phy.m_e^2./!phy.c^3.*sqrt(!dpi*13.6*!phy.erg_s_ev/3./!phy.k)= 6.8391014e-38
 
-        if self.conf["cont_hi_i"] != 0 and self.conf["cont_hei_i"] != 0 and self.conf["cont_heii_i"] != 0 :
-            FF_cont = (6.8391014e-38 * CST.CLIGHT * 1e8 / self.w**2. * (
-                        self.conf["cont_hi_i"] * 1.0**2. / np.sqrt(self.conf["cont_hi_t"]) * np.exp(-CST.HPLANCK*CST.CLIGHT*1e8/self.w/CST.BOLTZMANN/self.conf["cont_hi_t"]) * gff_HI/emis_Hi + 
-                        self.conf["cont_hei_i"] * 1.0**2./ np.sqrt(self.conf["cont_hei_t"]) * np.exp(-CST.HPLANCK*CST.CLIGHT*1e8/self.w/CST.BOLTZMANN/self.conf["cont_hei_t"]) * gff_HeI/emis_Hei  + 
-                        self.conf["cont_heii_i"] * 2.0**2. / np.sqrt(self.conf["cont_heii_t"]) * np.exp(-CST.HPLANCK*CST.CLIGHT*1e8/self.w/CST.BOLTZMANN/self.conf["cont_heii_t"]) * gff_HeII / emis_Heii))
-            FF_cont[~np.isfinite(FF_cont)] = 0.
-            self.conts['FF'] = FF_cont
-        else:
-            self.conts['FF'] = np.zeros_like(self.w)
+        def FF_cont():
+            if self.conf["cont_hi_i"] != 0 and self.conf["cont_hei_i"] != 0 and self.conf["cont_heii_i"] != 0 :
+                gff_HI = gff(1., self.conf["cont_hi_t"], self.w)
+                gff_HeI = gff(1., self.conf["cont_hei_t"], self.w)
+                gff_HeII = gff(4., self.conf["cont_heii_t"], self.w)
+                FF_cont = (6.8391014e-38 * CST.CLIGHT * 1e8 / self.w**2. * (
+                            self.conf["cont_hi_i"] * 1.0**2. / np.sqrt(self.conf["cont_hi_t"]) * np.exp(-CST.HPLANCK*CST.CLIGHT*1e8/self.w/CST.BOLTZMANN/self.conf["cont_hi_t"]) * gff_HI/emis_Hi() + 
+                            self.conf["cont_hei_i"] * 1.0**2./ np.sqrt(self.conf["cont_hei_t"]) * np.exp(-CST.HPLANCK*CST.CLIGHT*1e8/self.w/CST.BOLTZMANN/self.conf["cont_hei_t"]) * gff_HeI/emis_Hei()  + 
+                            self.conf["cont_heii_i"] * 2.0**2. / np.sqrt(self.conf["cont_heii_t"]) * np.exp(-CST.HPLANCK*CST.CLIGHT*1e8/self.w/CST.BOLTZMANN/self.conf["cont_heii_t"]) * gff_HeII / emis_Heii()))
+                FF_cont[~np.isfinite(FF_cont)] = 0.
+                return FF_cont
+            else:
+                return np.zeros_like(self.w)
 
-        
         # 2-photons
         #http://adsabs.harvard.edu/abs/1984A%26A...138..495N
-        if self.conf["cont_hi_i"] != 0:
-            y = 1215.7 / self.w
-            A = 202.0 * (y * (1. - y) * (1. -(4. * y * (1 - y))**0.8) + 0.88 * ( y * (1 - y))**1.53 * (4. * y * (1 - y))**0.8)
-            alfa_eff = 0.838e-13 * (self.conf["cont_hi_t"] / 1e4)**(-0.728) # fit DP de Osterbrock
-            q = 5.31e-4 * (self.conf["cont_hi_t"] / 1e4)**(-0.17) # fit DP de Osterbrock
-            n_crit = 8.226 / q
-            twophot_cont = self.conf["cont_hi_i"] * CST.HPLANCK * CST.CLIGHT * 1e8 / self.w**3. * 1215.7 * A / 8.226 * alfa_eff / (1. + self.conf["cont_edens"]/n_crit) / emis_Hi
-            twophot_cont[~np.isfinite(twophot_cont)] = 0.
-            self.conts['2photons'] = twophot_cont
-        else:
-            self.conts['2photons'] = np.zeros_like(self.w)
+        def twophot_cont():
+            if self.conf["cont_hi_i"] != 0:
+                y = 1215.7 / self.w
+                A = 202.0 * (y * (1. - y) * (1. -(4. * y * (1 - y))**0.8) + 0.88 * ( y * (1 - y))**1.53 * (4. * y * (1 - y))**0.8)
+                alfa_eff = 0.838e-13 * (self.conf["cont_hi_t"] / 1e4)**(-0.728) # fit DP de Osterbrock
+                q = 5.31e-4 * (self.conf["cont_hi_t"] / 1e4)**(-0.17) # fit DP de Osterbrock
+                n_crit = 8.226 / q
+                twophot_cont = self.conf["cont_hi_i"] * CST.HPLANCK * CST.CLIGHT * 1e8 / self.w**3. * 1215.7 * A / 8.226 * alfa_eff / (1. + self.conf["cont_edens"]/n_crit) / emis_Hi()
+                twophot_cont[~np.isfinite(twophot_cont)] = 0.
+                return twophot_cont
+            else:
+                return np.zeros_like(self.w)
+        
+        components = (('user', ('cont_in_lambda', 'cont_lambda', 'cont_intens', 'cont_pix'), user_cont),
+                      ('bb', ('cont_bb_t', 'cont_bb_i'), bb_cont),
+                      ('pl', ('cont_pl_alpha', 'cont_pl_i'), pl_cont),
+                      ('H', ('cont_hi_i', 'cont_hi_t'), H_cont),
+                      ('He1', ('cont_hei_i', 'cont_hei_t'), He1_cont),
+                      ('He2', ('cont_heii_i', 'cont_heii_t'), He2_cont),
+                      ('FF', ('cont_hi_i', 'cont_hi_t', 'cont_hei_i', 'cont_hei_t', 'cont_heii_i', 'cont_heii_t'), FF_cont),
+                      ('2photons', ('cont_hi_i', 'cont_hi_t', 'cont_edens'), twophot_cont))
+        grid_key = (grid_hash(self.w), grid_hash(self.tab_pix))
+        n_computed = 0
+        self.conts = {}
+        for name, par_names, compute in components:
+            key = (grid_key, repr([self.conf.get(par) for par in par_names]))
+            if name not in self.cont_cache or self.cont_cache[name][0] != key:
+                self.cont_cache[name] = (key, compute())
+                n_computed += 1
+            self.conts[name] = self.cont_cache[name][1]
+        log_.debug('{0} continuum components computed'.format(n_computed), calling=self.calling)
+        if (bool(self.get_conf('cont_auto', False)) and self.cont_auto is not None and 
+            len(self.cont_auto) == len(self.w)):
+            self.conts['auto'] = self.cont_auto
             
         self.cont = np.zeros_like(self.w)  
         for key in self.conts:
@@ -824,13 +1567,78 @@ class spectrum(object):
         self.cont *= self.aire_ref
         self.cont /= self.red_corr
         
+    def make_cont_auto(self):
+        """
+        Automatic continuum, fitted on the observations outside the lines of the synthesis (pixels where the
+        lines are weaker than cont_auto_cut times the strongest one). The observations are cut into bins of
+        cont_auto_width (w units); the sigma-clipped medians of the bins (see clipped_medians) are linearly
+        interpolated. The difference with the other continuum components is set in self.cont_auto, 
+        the 'auto' component of conts. Only the bins where the line mask changed since the last call are 
+        computed again.
+        """
+        w = self.w_ori
+        f = self.f_ori
+        if self.sp_synth_lr is not None:
+            lines = np.abs(self.sp_synth_lr - self.cont_lr)
+            free = lines <= self.get_conf('cont_auto_cut', 1e-3) * np.max(lines)
+        else:
+            free = np.ones(len(w), dtype=bool)
+        free &= np.isfinite(f)
+        width = self.get_conf('cont_auto_width', 50.)
+        clip = self.get_conf('cont_auto_clip', 3.)
+        niter = self.get_conf('cont_auto_niter', 3)
+        bins = np.floor((w - np.min(w)) / width).astype(int)
+        n_bins = bins[-1] + 1
+        
+        key = (grid_hash(w), grid_hash(f), width, clip, niter)
+        state = self.cont_auto_state
+        if state is None or state['key'] != key:
+            values = np.full(n_bins, np.nan)
+            todo = np.arange(n_bins)
+        else:
+            values = state['values'].copy()
+            todo = np.unique(bins[free != state['free']])
+        if len(todo) > 0:
+            in_todo = np.zeros(n_bins, dtype=bool)
+            in_todo[todo] = True
+            sel = free & in_todo[bins]
+            values[todo] = clipped_medians(f[sel], np.searchsorted(todo, bins[sel]), len(todo), clip=clip, niter=niter)
+        self.cont_auto_state = {'key': key, 'free': free, 'values': values}
+        log_.debug('Automatic continuum: {0} of {1} bins computed'.format(len(todo), n_bins), calling=self.calling)
+
+        counts = np.bincount(bins[free], minlength=n_bins)
+        valid = (counts > 0) & np.isfinite(values)
+        if valid.sum() == 0:
+            log_.warn('No pixel free of lines for the automatic continuum', calling=self.calling)
+            self.cont_auto = None
+            return
+        centers = np.bincount(bins[free], weights=w[free], minlength=n_bins)[valid] / counts[valid]
+        cont_obs = np.interp(self.w, centers, values[valid])
+        others = np.zeros_like(self.w)
+        for name in self.conts:
+            if name != 'auto':
+                others += self.conts[name]
+        self.cont_auto = cont_obs * self.red_corr / self.aire_ref - others
+        
+    def update_cont_auto(self):
+        """
+        If cont_auto is set, fit the automatic continuum (see make_cont_auto) on the current synthesis, and
+        convolve and rebin again the synthesis with it.
+        """
+        if not bool(self.get_conf('cont_auto', False)) or self.sp_synth is None:
+            return
+        self.make_cont_auto()
+        self.make_continuum()
+        self.sp_synth_tot = self.convol_synth(self.cont, self.sp_synth)
+        self.cont_lr, self.sp_synth_lr = self.rebin_on_obs()
+        
     def plot_conts(self, ax):
         if self.sp_synth_lr is None:
             return
         colors = {'bb': 'cyan', 'pl': 'green', '2photons': 'blue', 'FF': 'red',
-                  'H': 'red', 'He1': 'green', 'He2': 'blue', 'user': 'black'}        
+                  'H': 'red', 'He1': 'green', 'He2': 'blue', 'user': 'black', 'auto': 'magenta'}        
         labels = {'bb': 'bb', 'pl': 'pl', '2photons': '2q', 'FF': 'ff',
-                  'H': 'H I', 'He1': 'He I', 'He2': 'He II', 'user': 'interpol'}
+                  'H': 'H I', 'He1': 'He I', 'He2': 'He II', 'user': 'interpol', 'auto': 'auto'}
         for key in self.conts:
             if key[0] == 'H':
                 style=':'
@@ -841,13 +1649,25 @@ class spectrum(object):
         ax.legend()
                     
         
-    def append_lists(self, phyat_arr, model_arr, cosmetik_arr):
+    def match_cosmetik(self, liste, cosmetik_arr):
+        """
+        Join cosmetik_arr with liste on the line number.
+        Return the indexes of the cosmetik lines matching exactly one line of liste, the rows of these lines 
+        in liste, and a report (dictionary of arrays of line numbers) of the cosmetik lines undefined in liste 
+        ('undefined'), multiply defined in liste ('multiple') and repeated in cosmetik_arr ('repeated').
+        """
+        rows = find_rows(liste['num'], cosmetik_arr['num'])
+        nums, counts = np.unique(cosmetik_arr['num'], return_counts=True)
+        report = {'undefined': cosmetik_arr['num'][rows == -1],
+                  'multiple': cosmetik_arr['num'][rows == -2],
+                  'repeated': nums[counts > 1]}
+        i_cosm = np.where(rows >= 0)[0]
+        return i_cosm, rows[i_cosm], report
+        
+    def append_lists(self, phyat_arr, model_arr, cosmetik_arr, w_lims=None):
         
         n_models = len(model_arr)
-        liste_totale = phyat_arr.copy()
-        liste_totale.resize(len(phyat_arr) + len(model_arr))
-        for i,j in enumerate(np.arange(len(phyat_arr), len(phyat_arr) + len(model_arr))):
-            liste_totale[j] = model_arr[i]
+        liste_totale = np.concatenate((phyat_arr, model_arr)).view(np.recarray)
 
         sp_theo = {}
         sp_theo['raie_ref'] = model_arr
@@ -860,126 +1680,246 @@ class spectrum(object):
             sp_theo['raie_ref'].i_rel *= sp_theo['raie_ref'].i_cor
             sp_theo['raie_ref'].i_cor = 1.
         
-        if self.do_cosmetik:
-            for line_cosmetik in cosmetik_arr:
-                if (line_cosmetik['ref'] == 0) and not bool(self.conf['do_icor_on_ref']):
-                    log_.warn('No cosmetik on {0}, reference line'.format(line_cosmetik['num']),
-                                    calling = self.calling)
-                else:
-                    to_change = (liste_totale.num == line_cosmetik['num'])
-                    if to_change.sum() == 1:
-                        line_to_change = liste_totale[to_change][0]
-                        if (line_to_change['lambda'] == line_cosmetik['lambda']) or (line_cosmetik['l_shift'] == 0.):
-                            line_to_change['l_shift'] = line_cosmetik['l_shift']
-                        if (line_to_change['i_rel'] == line_cosmetik['i_rel']) or (line_cosmetik['i_cor'] == 1.):
-                            line_to_change['i_cor'] = line_cosmetik['i_cor']
-                        liste_totale[to_change] = line_to_change
-                        log_.debug('Cosmetik on {0}'.format([line_cosmetik]), calling=self.calling)
-                    elif to_change.sum() == 0:
-                        if self.get_conf('warn_on_no_cosmetik'):
-                            log_.warn('No cosmetik on {0}, undefined line'.format(line_cosmetik['num']),
-                                        calling = self.calling)
-                    else:
-                        log_.warn('No cosmetik on {0}, multiple defined line'.format(line_cosmetik['num']),
-                                        calling = self.calling)
-
-        liste_raies = self.restric_liste(liste_totale)
+        self.cosmetik_report = None
+        do_cosmetik = self.do_cosmetik and cosmetik_arr is not None and len(cosmetik_arr) > 0
+        if do_cosmetik:
+            on_ref = (cosmetik_arr['ref'] == 0) & (not bool(self.conf['do_icor_on_ref']))
+            for num in cosmetik_arr['num'][on_ref]:
+                log_.warn('No cosmetik on {0}, reference line'.format(num), calling = self.calling)
+            i_cosm, rows, report = self.match_cosmetik(liste_totale, cosmetik_arr[~on_ref])
+            report['ref_line'] = cosmetik_arr['num'][on_ref]
+            self.cosmetik_report = report
+            if self.get_conf('warn_on_no_cosmetik'):
+                for num in report['undefined']:
+                    log_.warn('No cosmetik on {0}, undefined line'.format(num), calling = self.calling)
+            for num in report['multiple']:
+                log_.warn('No cosmetik on {0}, multiple defined line'.format(num), calling = self.calling)
+            cosm = cosmetik_arr[~on_ref][i_cosm]
+            # When a line is changed by more than one cosmetik, the last one wins
+            do_l_shift = (liste_totale['lambda'][rows] == cosm['lambda']) | (cosm['l_shift'] == 0.)
+            i_last = last_occurrences(rows[do_l_shift])
+            liste_totale['l_shift'][rows[do_l_shift][i_last]] = cosm['l_shift'][do_l_shift][i_last]
+            do_i_cor = (liste_totale['i_rel'][rows] == cosm['i_rel']) | (cosm['i_cor'] == 1.)
+            i_last = last_occurrences(rows[do_i_cor])
+            liste_totale['i_cor'][rows[do_i_cor][i_last]] = cosm['i_cor'][do_i_cor][i_last]
+            log_.debug('Cosmetik on {0} lines'.format(len(np.unique(rows))), calling=self.calling)
+
+        liste_raies = self.restric_liste(liste_totale, w_lims=w_lims)
         log_.message('Size of the line list: {0}, size of the restricted line list: {1}'.format(len(liste_totale),
                                                                                                       len(liste_raies)), calling=self.calling)
 
-        if self.do_cosmetik:
-            for line_cosmetik in cosmetik_arr:
-                if bool(self.conf['do_icor_on_ref']):
-                    to_change = (liste_raies.num == line_cosmetik['num'])
-                    if to_change.sum() == 1:
-                        line_to_change = liste_raies[to_change][0]
-                        line_to_change['vitesse'] *= line_cosmetik['vitesse']
-                        if line_cosmetik['profile'] != -1:
-                            line_to_change['profile'] = line_cosmetik['profile']
-                        liste_raies[to_change] = line_to_change
+        if do_cosmetik and bool(self.conf['do_icor_on_ref']):
+            i_cosm, rows, report = self.match_cosmetik(liste_raies, cosmetik_arr)
+            cosm = cosmetik_arr[i_cosm]
+            np.multiply.at(liste_raies['vitesse'], rows, cosm['vitesse'])
+            do_profile = cosm['profile'] != -1
+            i_last = last_occurrences(rows[do_profile])
+            liste_raies['profile'][rows[do_profile][i_last]] = cosm['profile'][do_profile][i_last]
         
         return sp_theo, liste_totale, liste_raies
         
-    def restric_liste(self, liste_in):
+    def resolve_refs(self, liste_in):
+        """
+        Follow the chains of reference lines (satellite -> sub-reference -> ... -> reference) of liste_in.
+        Return, for each line:
+            - the row of the line ending its chain, i.e. the first one having ref = 0 or -1 
+              (-1 for the lines which are not satellites),
+            - the products of i_rel and of i_cor along the chain, the line itself excluded and 
+              the line ending the chain included,
+            - a status: 0 if resolved, 1 if a reference is missing or multiply defined, 2 if the chain is cyclic.
+        The chains are resolved all together by pointer jumping, in log2(depth) vectorized steps.
+        """
+        n_lines = len(liste_in)
+        refs = liste_in['ref']
+        parent = find_rows(liste_in['num'], refs)
+        is_sat = (refs != 0) & (refs != -1) & (refs != 999)
+        
+        status = np.zeros(n_lines, dtype=int)
+        status[is_sat & (parent < 0)] = 1
+        active = is_sat & (parent >= 0)
+        done = np.zeros(n_lines, dtype=bool)
+        end = -np.ones(n_lines, dtype=int)
+        jump = np.where(active, parent, -1)
+        prod_i_rel = np.ones(n_lines)
+        prod_i_cor = np.ones(n_lines)
+        prod_i_rel[active] = liste_in['i_rel'][parent[active]]
+        prod_i_cor[active] = liste_in['i_cor'][parent[active]]
+        
+        i_active = np.where(active)[0]
+        parent_refs = refs[parent[i_active]]
+        i_done = i_active[(parent_refs == 0) | (parent_refs == -1) | (parent_refs == 999)]
+        done[i_done] = True
+        end[i_done] = parent[i_done]
+        active[i_done] = False
+        
+        # Each step makes every line point to the target of its target, so the chains are 
+        # resolved after log2(n_lines) steps. Lines still active after that are in a cycle.
+        n_steps = 0
+        max_steps = int(np.log2(max(n_lines, 2))) + 2
+        while active.any() and n_steps < max_steps:
+            i_active = np.where(active)[0]
+            j = jump[i_active]
+            new_prod_i_rel = prod_i_rel[i_active] * prod_i_rel[j]
+            new_prod_i_cor = prod_i_cor[i_active] * prod_i_cor[j]
+            new_status, new_done, new_end, new_jump = status[j], done[j], end[j], jump[j]
+            prod_i_rel[i_active] = new_prod_i_rel
+            prod_i_cor[i_active] = new_prod_i_cor
+            status[i_active] = new_status
+            done[i_active] = new_done
+            end[i_active] = new_end
+            jump[i_active] = new_jump
+            active[i_active] = ~new_done & (new_status == 0)
+            n_steps += 1
+        status[active] = 2
+        end[status != 0] = -1
+        return end, prod_i_rel, prod_i_cor, status
+        
+    def restric_liste(self, liste_in, w_lims=None):
         """
         This function changes liste_in
+        The lines are restricted to w_lims (default: the range of self.w). The rows of liste_in of the 
+        returned lines are kept in self.restric_rows.
         """
-        
+        if w_lims is None:
+            w_lims = (np.min(self.w), np.max(self.w))
         
         """
         We set ref=999 for all the lines depending on a 999 one.
         """
+        hidden = (liste_in['ref'] == 999)
+        new_hidden = hidden
         while True:
-            the_end = True
-            non_affich = np.where(liste_in['ref'] == 999)[0]
-            for i_999 in non_affich:
-                this_num = liste_in['num'][i_999]
-                dep_non_affich = ((liste_in['ref'] == this_num) & (liste_in['ref'] != 999))
-                if dep_non_affich.sum() != 0:
-                    before = liste_in['ref'][dep_non_affich]
-                    liste_in['ref'][dep_non_affich] = 999
-                    log_.message('Before = {0}, After = {1}'.format(before, liste_in['ref'][dep_non_affich]), calling=self.calling)
-                    the_end = False
-            if the_end:
+            dep_non_affich = np.isin(liste_in['ref'], liste_in['num'][new_hidden]) & ~hidden
+            if dep_non_affich.sum() == 0:
                 break
+            log_.message('{0} lines depending on a 999 line set to 999'.format(dep_non_affich.sum()), calling=self.calling)
+            liste_in['ref'][dep_non_affich] = 999
+            hidden = hidden | dep_non_affich
+            new_hidden = dep_non_affich
 
-        where_restr = (((liste_in['lambda'] + liste_in['l_shift']) < np.max(self.w)) & 
-                       ((liste_in['lambda'] + liste_in['l_shift']) > np.min(self.w)) &
+        where_restr = (((liste_in['lambda'] + liste_in['l_shift']) < w_lims[1]) & 
+                       ((liste_in['lambda'] + liste_in['l_shift']) > w_lims[0]) &
                        (liste_in['ref'] != 999))
-        liste_out = liste_in.copy()[where_restr]
+        liste_out = liste_in[where_restr]
         log_.message('Old size = {0}, new_size = {1}'.format(len(liste_in), len(liste_out)), calling=self.calling)
         
-        last_loop = 0
-        the_end = False
+        """
+        The satellites get the products of i_rel (and i_cor) along their chain of reference lines, 
+        and the profile of the last one. If it is a reference line (ref = 0), they also get its width and shift.
+        """
+        end, prod_i_rel, prod_i_cor, status = self.resolve_refs(liste_in)
+        end = end[where_restr]
+        status = status[where_restr]
+        satellites = (liste_out['ref'] != 0) & (liste_out['ref'] != -1)
+        
+        for i_sat in np.where(satellites & (status != 0))[0]:
+            if status[i_sat] == 2:
+                log_.warn('Satellite in a cyclic chain of reference lines:{0}'.format(liste_out['num'][i_sat]), 
+                          calling=self.calling)
+            elif self.get_conf('warn_on_no_reference'):
+                log_.warn('Satellite sans raie de reference:{0} looking for {1}'.format(liste_out['num'][i_sat], liste_out['ref'][i_sat]), 
+                          calling=self.calling)
+        liste_out['i_rel'][satellites & (status != 0)] = 0.0
+        
+        resolved = satellites & (status == 0)
+        end = end[resolved]
+        liste_out['i_rel'][resolved] *= prod_i_rel[where_restr][resolved]
+        if bool(self.conf['recursive_i_cor']):
+            liste_out['i_cor'][resolved] *= prod_i_cor[where_restr][resolved]
+        liste_out['profile'][resolved] = liste_in['profile'][end]
+        to_ref = (liste_in['ref'][end] == 0)
+        i_to_ref = np.where(resolved)[0][to_ref]
+        liste_out['vitesse'][i_to_ref] *= liste_in['vitesse'][end[to_ref]]
+        liste_out['l_shift'][i_to_ref] += liste_in['l_shift'][end[to_ref]]
+        liste_out['ref'][resolved] = np.where(to_ref, liste_in['num'][end], -1)
         
-        while True:
-            if last_loop == 1:
-                the_end = True
-            satellites = np.where(liste_out['ref'] != 0)[0]
-            for i_satellite in satellites[::-1]:
-                if liste_out['ref'][i_satellite] != -1:
-                    raie_synth = liste_out[i_satellite].copy()
-                    i_main_line = np.where(liste_in['num'] == raie_synth['ref'])[0]
-                    if len(i_main_line) != 1:
-                        if self.get_conf('warn_on_no_reference'):
-                            log_.warn('Satellite sans raie de reference:{0} looking for {1}'.format(raie_synth['num'], raie_synth['ref']), 
-                                        calling=self.calling)
-                        raie_synth['i_rel'] = 0.0
-                        raie_synth['comment'] = '!pas de ref' + raie_synth['comment']
-                    else:
-                        main_line = liste_in[i_main_line]
-                        if main_line['ref'] != 0:
-                            raie_synth['i_rel'] *= main_line['i_rel']
-                            raie_synth['ref'] = main_line['ref']
-                            if bool(self.conf['recursive_i_cor']):
-                                raie_synth['i_cor'] *= main_line['i_cor']
-                            raie_synth['profile'] = main_line['profile']
-                            last_loop = 2
-                            log_.debug('filling {0} with {1}'.format(liste_out[i_satellite]['num'],
-                                                                             main_line['num']),
-                                               calling = self.calling)
-                        if last_loop == 1:
-                            raie_synth['i_rel'] *= main_line['i_rel']
-                            raie_synth['vitesse'] *= main_line['vitesse']
-                            raie_synth['l_shift'] += main_line['l_shift']
-                            if bool(self.conf['recursive_i_cor']):
-                                raie_synth['i_cor'] *= main_line['i_cor']
-                            raie_synth['profile'] = main_line['profile']
-                            log_.debug('filling {0} with {1}, last loop'.format(liste_out[i_satellite]['num'],
-                                                                             main_line['num']),
-                                               calling = self.calling)
-                    liste_out[i_satellite] = raie_synth
-            if last_loop == 0:
-                last_loop = 1
-            else:
-                last_loop = 0
-                
-            if the_end:
-                break
         tt = (np.abs(liste_out['i_rel']) > 1e-50)
         log_.message('number of lines with i_rel > 1e-50: {0}'.format(tt.sum()), calling=self.calling)
+        self.restric_rows = np.where(where_restr)[0][tt]
         return liste_out[tt]
 
+    def merge_blends(self, liste_raies):
+        """
+        Merge the satellites sharing the same reference line, profile, width and mass, and lying 
+        within blend_tolerance pixel from each other, into one effective line having the summed 
+        intensity at the intensity-weighted wavelength. The strongest line of each group carries the blend.
+        Return the list of lines to be synthesized and a dictionary giving, for each line number 
+        of a blend, the numbers of all the lines of this blend (the carrier first).
+        """
+        tol = self.get_conf('blend_tolerance', 0.) * self.lambda_pix
+        if tol <= 0. or len(liste_raies) < 2:
+            return liste_raies, {}
+        
+        num = liste_raies['num']
+        i_tot = liste_raies['i_rel'] * liste_raies['i_cor']
+        lambda_tot = liste_raies['lambda'] + liste_raies['l_shift']
+        masse = 2 * (num - num % 100000000000) / 100000000000
+        masse[(masse == 2) & ((num - num % 101000000000) / 100000000 == 1010)] = 1
+        flags = np.zeros(len(num), dtype=int)
+        flags[is_absorb(liste_raies)] += 1
+        flags[no_red_corr(liste_raies)] += 2
+        flags[i_tot < 0] += 4
+        
+        satellites = np.where((liste_raies['ref'] != 0) & (liste_raies['ref'] != -1))[0]
+        keys = [liste_raies['ref'], liste_raies['profile'], liste_raies['vitesse'], masse, flags]
+        order = satellites[np.lexsort([lambda_tot[satellites]] + [key[satellites] for key in keys[::-1]])]
+        if len(order) < 2:
+            return liste_raies, {}
+        
+        # A new group starts when a key changes or when the gap to the previous line is larger than tol.
+        # Groups are then cut so that their wavelength span stays smaller than tol.
+        new_group = np.zeros(len(order), dtype=bool)
+        new_group[0] = True
+        for key in keys:
+            new_group[1:] |= key[order][1:] != key[order][:-1]
+        lambda_sorted = lambda_tot[order]
+        new_group[1:] |= np.diff(lambda_sorted) > tol
+        chain = np.cumsum(new_group) - 1
+        chain_start = lambda_sorted[np.where(new_group)[0]][chain]
+        piece = np.floor((lambda_sorted - chain_start) / tol).astype(int)
+        new_group[1:] |= piece[1:] != piece[:-1]
+        starts = np.where(new_group)[0]
+        n_members = np.diff(np.append(starts, len(order)))
+        if (n_members > 1).sum() == 0:
+            return liste_raies, {}
+        
+        weights = np.abs(i_tot[order])
+        sum_weights = np.add.reduceat(weights, starts)
+        group = np.cumsum(new_group) - 1
+        by_weight = np.lexsort((weights, group))
+        last_of_group = np.append(np.where(np.diff(group[by_weight]) != 0)[0], len(order) - 1)
+        strongest = order[by_weight[last_of_group]]
+        
+        liste_out = liste_raies.copy()
+        blended = n_members > 1
+        carriers = strongest[blended]
+        liste_out['lambda'][carriers] = (np.add.reduceat(weights * liste_raies['lambda'][order], starts) / sum_weights)[blended]
+        liste_out['l_shift'][carriers] = (np.add.reduceat(weights * liste_raies['l_shift'][order], starts) / sum_weights)[blended]
+        liste_out['i_rel'][carriers] = np.add.reduceat(i_tot[order], starts)[blended]
+        liste_out['i_cor'][carriers] = 1.0
+        
+        to_remove = np.zeros(len(liste_raies), dtype=bool)
+        to_remove[order[blended[group]]] = True
+        to_remove[carriers] = False
+        
+        blend_map = {}
+        for i_group in np.where(blended)[0]:
+            members = num[order[starts[i_group]:starts[i_group] + n_members[i_group]]]
+            carrier = num[strongest[i_group]]
+            members = tuple([int(carrier)] + [int(m) for m in members if m != carrier])
+            for m in members:
+                blend_map[m] = members
+        log_.message('{0} lines merged into {1} blends'.format(n_members[blended].sum(), blended.sum()), 
+                     calling=self.calling)
+        return liste_out[~to_remove], blend_map
+    
+    def get_blend(self, line_num):
+        """
+        Return the numbers of the lines merged with line_num in the synthesis (the carrier first), 
+        or None if line_num is not part of a blend.
+        """
+        return self.blend_map.get(line_num)
+
     def make_synth_test(self, liste_raies):
 
         sp_theo = self.sp_theo.copy()
@@ -1020,20 +1960,57 @@ class spectrum(object):
         log_.message('Number of theoretical spectra: {0}'.format(len(sp_theo['correc'])), calling=self.calling)
         return sp_theo, sp_synth
 
+    def make_synth_grid(self, liste_raies):
+        """
+        Define the grid on which the line profiles are computed.
+        If adaptive_grid is set, only the pixels lying closer than adaptive_grid_width line widths 
+        from a line are split into resol sub-pixels. Otherwise the profiles are computed on self.w.
+        """
+        self.w_synth = None
+        self.synth_starts = None
+        if self.adaptive_resol == 1 or len(liste_raies) == 0:
+            return
+        lambda_0 = liste_raies['lambda'] + liste_raies['l_shift'] + self.get_conf('lambda_shift', 0.0)
+        largeur = np.abs(liste_raies['vitesse']) * lambda_0 / CST.CLIGHT * 1e5
+        half_width = self.get_conf('adaptive_grid_width', 10.) * largeur + 2 * self.lambda_pix
+        i_min = np.searchsorted(self.w, lambda_0 - half_width)
+        i_max = np.searchsorted(self.w, lambda_0 + half_width)
+        n_windows = np.zeros(len(self.w) + 1, dtype=int)
+        np.add.at(n_windows, i_min, 1)
+        np.add.at(n_windows, i_max, -1)
+        refine = np.cumsum(n_windows)[:-1] > 0
+        self.w_synth, self.synth_starts = make_adaptive_grid(self.w, refine, self.adaptive_resol)
+        log_.message('Synthesis grid: {0} points, {1} pixels refined'.format(len(self.w_synth), refine.sum()), 
+                     calling=self.calling)
+
     def make_synth(self, liste_raies, sp_theo):
 
         if bool(self.conf['do_calcul_aire_ref']):
             self.aire_ref = 1.0
-                   
-        sp_synth = np.zeros_like(self.w)
-        sp_theo['spectr'] *= 0.0 
+        
+        if self.synth_starts is None:
+            w = self.w
+            red_corr = self.red_corr
+            spectr = sp_theo['spectr']
+        else:
+            w = self.w_synth
+            red_corr = np.interp(w, self.w, self.red_corr)
+            spectr = np.zeros((len(sp_theo['correc']), len(w)))
+        sp_synth = np.zeros_like(w)
+        nored_synth = np.zeros_like(w)
+        spectr *= 0.0 
         sp_theo['correc'] *= 0.0
+        # Reference lines having lines corrected and not corrected for reddening (see change_ebv)
+        red = np.zeros(len(sp_theo['correc']), dtype=bool)
+        nored = np.zeros(len(sp_theo['correc']), dtype=bool)
+        # Part of spectr of the lines not corrected for reddening, for the reference lines having some
+        nored_spectr = {}
         
         #TODO parallelize this loop
         for raie in liste_raies:
             #sp_tmp = self.profil_emis(self.w, raie, self.conf['lambda_shift'])
-            sp_tmp = self.get_profile(raie)
-            aire = np.trapz(sp_tmp, self.w)
+            sp_tmp = self.get_profile(raie, w, adaptive=self.synth_starts is not None)
+            aire = np.trapz(sp_tmp, w)
             if np.isfinite(aire) and (aire != 0.):
                 max_sp = np.max(sp_tmp)
                 if (np.abs(sp_tmp[0]/max_sp) > 1e-3) or (np.abs(sp_tmp[-1]/max_sp) > 1e-3):
@@ -1047,15 +2024,38 @@ class spectrum(object):
                     tab_tmp = (sp_theo['raie_ref'].num == raie['ref'])
                 this_line = intens_pic * sp_tmp
                 if not no_red_corr(raie):
-                    this_line /= self.red_corr
+                    this_line /= red_corr
+                    red[tab_tmp] = True
+                else:
+                    nored[tab_tmp] = True
+                    for i_ref in np.flatnonzero(tab_tmp):
+                        if i_ref not in nored_spectr:
+                            nored_spectr[i_ref] = np.zeros_like(w)
+                        nored_spectr[i_ref] += this_line
                 if not is_absorb(raie):
                     sp_synth += this_line
-                sp_theo['spectr'][tab_tmp] +=  this_line
+                    if no_red_corr(raie):
+                        nored_synth += this_line
+                spectr[tab_tmp] +=  this_line
                 sp_theo['correc'][tab_tmp] = 1.0
                 log_.debug('doing line {}'.format(raie['num']), calling=self.calling)
+        nored_rows = np.array(sorted(nored_spectr), dtype=int)
+        nored_spectr = np.array([nored_spectr[i_ref] for i_ref in nored_rows]).reshape(len(nored_rows), len(w))
+        if self.synth_starts is not None:
+            sp_synth = rebin_adaptive(sp_synth, self.synth_starts)
+            nored_synth = rebin_adaptive(nored_synth, self.synth_starts)
+            sp_theo['spectr'] = rebin_adaptive(spectr, self.synth_starts)
+            nored_spectr = rebin_adaptive(nored_spectr, self.synth_starts)
         tt = (sp_theo['correc'] != 0.)
         for key in ('correc', 'raie_ref', 'spectr'):
             sp_theo[key] = sp_theo[key][tt]
+        sp_theo['red'] = red[tt]
+        sp_theo['red_mixed'] = (red & nored)[tt].any()
+        sp_theo['nored_synth'] = nored_synth
+        # Rows of sp_theo['spectr'] having lines not corrected for reddening, and the part of these lines
+        # (as computed by make_synth, not updated by adjust)
+        sp_theo['nored_rows'] = (np.cumsum(tt) - 1)[nored_rows]
+        sp_theo['nored_spectr'] = nored_spectr
         
         log_.message('Number of theoretical spectra: {0}'.format(len(sp_theo['correc'])), calling=self.calling)
         return sp_theo, sp_synth
@@ -1136,13 +2136,13 @@ class spectrum(object):
         if self.sp_synth_tot is None:
             return None, None
         
-        resol = self.get_conf('resol', undefined = 1, message=None)
-        cont_lr = rebin(self.cont, resol)
-        sp_synth_lr = rebin(self.sp_synth_tot, resol)
+        cont_lr = rebin(self.cont, self.resol)
+        sp_synth_lr = rebin(self.sp_synth_tot, self.resol)
         return cont_lr, sp_synth_lr 
                 
     def adjust(self):
         spectr0 = self.sp_theo['spectr'].copy()
+        self.comment_tables.pop('model', None)
         new_model_arr = self.read_model(self.fic_model)        
         new_cosmetik_arr, errorMsg = self.read_cosmetik()
         if len(errorMsg) > 0:
@@ -1160,49 +2160,80 @@ class spectrum(object):
             if np.str(l) in ref_diff:
                 mask_diff[im] = True
         if mask_diff.sum() > 0 and len(mask_diff) == len(self.liste_raies):
-            old_sp_theo = self.sp_theo.copy()
-            if len(new_sp_theo) != len(old_sp_theo):
-                log_.error('The new list has different number of elements', 
-                                 calling = self.calling+'.adjust')
-            liste_old_diff = self.liste_raies[mask_diff]
-            old_sp_theo, old_sp_synth = self.make_synth(liste_old_diff, old_sp_theo)
-            if len(ref_diff) > 0:
-                self.do_profile_dict()
-            liste_new_diff = new_liste_raies[mask_diff]
-            new_sp_theo, new_sp_synth = self.make_synth(liste_new_diff, new_sp_theo)
-            
-            if log_.level >= 3:
-                print('Old values:')
-                self.print_line(liste_old_diff)
-                print('New values:')
-                self.print_line(liste_new_diff)
-            do_abs = False
-            self.sp_theo['spectr'] = spectr0
-            for i_change in np.arange(len(new_sp_theo['raie_ref'])):
-                to_change = (self.sp_theo['raie_ref']['num'] == new_sp_theo['raie_ref'][i_change]['num'])
-                new_sp_theo['correc'][i_change] = self.sp_theo['correc'][to_change].copy()
-                old_sp_theo['correc'][i_change] = self.sp_theo['correc'][to_change].copy()
-                if (new_sp_theo['raie_ref'][i_change]['i_rel'] != old_sp_theo['raie_ref'][i_change]['i_rel']):
-                    new_sp_theo['correc'][i_change] = 1.0
-                self.sp_theo['spectr'][to_change] += new_sp_theo['spectr'][i_change] - old_sp_theo['spectr'][i_change]
-                self.sp_theo['raie_ref'][to_change] = new_sp_theo['raie_ref'][i_change]
-                self.sp_theo['correc'][to_change] = new_sp_theo['correc'][i_change]
-                if is_absorb(new_sp_theo['raie_ref'][i_change]):
-                    do_abs = True
-                else:
-                    self.sp_synth += (new_sp_theo['correc'][i_change] * new_sp_theo['spectr'][i_change] -
-                                      old_sp_theo['correc'][i_change] * old_sp_theo['spectr'][i_change]) 
-                log_.message('change line {0}'.format(new_sp_theo['raie_ref'][i_change]['num']),
-                                   calling=self.calling + ' adjust')         
-            if do_abs:
+            # The synthesis is made from the lists merged into blends (see merge_blends): they are compared
+            new_liste_synth, new_blend_map = self.merge_blends(new_liste_raies)
+            if (len(new_liste_synth) != len(self.liste_synth) or np.any(new_liste_synth['num'] != self.liste_synth['num']) or
+                len(new_sp_theo['raie_ref']) != len(self.sp_theo['raie_ref'])):
+                log_.message('blends or reference lines changed, full synthesis', calling=self.calling + ' adjust')
+                if len(ref_diff) > 0:
+                    self.do_profile_dict()
+                self.sp_theo, self.liste_totale, self.liste_raies = new_sp_theo, new_liste_totale, new_liste_raies
+                self.liste_synth, self.blend_map = new_liste_synth, new_blend_map
+                self.make_synth_grid(self.liste_raies)
+                self.sp_theo, self.sp_synth = self.make_synth(self.liste_synth, self.sp_theo)
+                self.n_sp_theo = len(self.sp_theo['spectr'])
                 self.sp_abs = self.make_sp_abs(self.sp_theo)
-            self.liste_raies = new_liste_raies
+            else:
+                synth_diff = np.zeros(len(new_liste_synth), dtype=bool)
+                for key in ('lambda', 'l_shift', 'i_rel', 'i_cor', 'vitesse', 'profile'):
+                    synth_diff = synth_diff | (new_liste_synth[key] != self.liste_synth[key])
+                for im, l in enumerate(new_liste_synth['profile']):
+                    if str(l) in ref_diff:
+                        synth_diff[im] = True
+                self.adjust_synth(self.liste_synth[synth_diff], new_liste_synth[synth_diff], new_sp_theo, spectr0,
+                                  len(ref_diff) > 0)
+                self.liste_raies = new_liste_raies
+                self.liste_synth, self.blend_map = new_liste_synth, new_blend_map
+            self.line_indexes = {}
+            self.wl_index = None
+            self.ion_index = None
             self.sp_synth_tot = self.convol_synth(self.cont, self.sp_synth)
             self.cont_lr, self.sp_synth_lr = self.rebin_on_obs()
+            self.update_cont_auto()
         log_.message('{} differences'.format(mask_diff.sum()), calling=self.calling + ' adjust')
         return mask_diff.sum(), errorMsg
         
         #self.update_plot2()
+
+    def adjust_synth(self, liste_old_diff, liste_new_diff, new_sp_theo, spectr0, new_profiles):
+        """
+        Used by adjust: replace in the synthesis the contributions of the lines liste_old_diff by the ones of
+        liste_new_diff. spectr0: theoretical spectra before the changes. new_profiles: the profiles changed.
+        """
+        old_sp_theo = self.sp_theo.copy()
+        old_sp_theo, old_sp_synth = self.make_synth(liste_old_diff, old_sp_theo)
+        if new_profiles:
+            self.do_profile_dict()
+        new_sp_theo, new_sp_synth = self.make_synth(liste_new_diff, new_sp_theo)
+        
+        if log_.level >= 3:
+            print('Old values:')
+            self.print_line(liste_old_diff)
+            print('New values:')
+            self.print_line(liste_new_diff)
+        do_abs = False
+        self.sp_theo['spectr'] = spectr0
+        for i_change in np.arange(len(new_sp_theo['raie_ref'])):
+            to_change = (self.sp_theo['raie_ref']['num'] == new_sp_theo['raie_ref'][i_change]['num'])
+            new_sp_theo['correc'][i_change] = self.sp_theo['correc'][to_change][0]
+            old_sp_theo['correc'][i_change] = self.sp_theo['correc'][to_change][0]
+            if (new_sp_theo['raie_ref'][i_change]['i_rel'] != old_sp_theo['raie_ref'][i_change]['i_rel']):
+                new_sp_theo['correc'][i_change] = 1.0
+            self.sp_theo['spectr'][to_change] += new_sp_theo['spectr'][i_change] - old_sp_theo['spectr'][i_change]
+            self.sp_theo['raie_ref'][to_change] = new_sp_theo['raie_ref'][i_change]
+            self.sp_theo['correc'][to_change] = new_sp_theo['correc'][i_change]
+            if is_absorb(new_sp_theo['raie_ref'][i_change]):
+                do_abs = True
+            else:
+                diff_synth = (new_sp_theo['correc'][i_change] * new_sp_theo['spectr'][i_change] -
+                              old_sp_theo['correc'][i_change] * old_sp_theo['spectr'][i_change]) 
+                self.sp_synth += diff_synth
+                if 'red' in self.sp_theo and not self.sp_theo['red'][to_change].any():
+                    self.sp_theo['nored_synth'] = self.sp_theo['nored_synth'] + diff_synth
+            log_.message('change line {0}'.format(new_sp_theo['raie_ref'][i_change]['num']),
+                               calling=self.calling + ' adjust')         
+        if do_abs:
+            self.sp_abs = self.make_sp_abs(self.sp_theo)
             
 #     def modif_intens(self, raie_num, fact):
 #         
@@ -1234,35 +2265,83 @@ class spectrum(object):
                 self.print_line(line[isort])
             return
         print('{0[num]:>14d} {0[id]:9s}{0[lambda]:11.3f}{0[l_shift]:6.3f}{0[i_rel]:10.3e}{0[i_cor]:7.3f}'\
-              ' {0[ref]:>14d}{0[profile]:5d}{0[vitesse]:7.2f}{1:1s}'.format(line, line['comment'].strip()))
+              ' {0[ref]:>14d}{0[profile]:5d}{0[vitesse]:7.2f}{1:1s}'.format(line, self.get_comment(line).strip()))
        
+    def get_line_index(self, arr):
+        """
+        Return the LineIndex of the line list arr, building it at the first call.
+        Only the indexes of the line lists of the object (phyat_arr, model_arr, cosmetik_arr, liste_totale, 
+        liste_raies and sp_theo['raie_ref']) are kept, by name, and dropped each time the line lists are 
+        rebuilt (run and adjust). For any other array, the index is built at each call.
+        """
+        name = None
+        for key in ('liste_raies', 'phyat_arr', 'model_arr', 'cosmetik_arr', 'liste_totale'):
+            if getattr(self, key, None) is arr:
+                name = key
+                break
+        if name is None and getattr(self, 'sp_theo', None) is not None and self.sp_theo.get('raie_ref') is arr:
+            name = 'raie_ref'
+        if name is None:
+            return LineIndex(arr)
+        index = self.line_indexes.get(name)
+        if index is None or index.arr is not arr:
+            index = LineIndex(arr)
+            self.line_indexes[name] = index
+        return index
+
+    def get_wl_index(self):
+        """
+        Return the WavelengthIndex of liste_raies, rebuilding it if the list or lambda_shift changed.
+        """
+        lambda_shift = self.get_conf('lambda_shift', 0.0)
+        if (self.wl_index is None or self.wl_index.arr is not self.liste_raies or 
+            self.wl_index.lambda_shift != lambda_shift):
+            self.wl_index = WavelengthIndex(self.liste_raies, lambda_shift)
+        return self.wl_index
+
+    def get_ion_index(self):
+        """
+        Return the IonIndex of liste_raies and of the reference lines, rebuilding it if one of them changed.
+        """
+        if (self.ion_index is None or self.ion_index.liste_raies is not self.liste_raies or
+            self.ion_index.raie_ref is not self.sp_theo['raie_ref']):
+            self.ion_index = IonIndex(self.liste_raies, self.sp_theo['raie_ref'])
+        return self.ion_index
+
     def get_line_info(self, line_num, sort='lambda', reverse=False):
         line = None
         refline = None
         satellites = None
         refline_num = -1
-        to_select = (self.liste_raies['num'] == line_num)
-        if to_select.sum() > 0:
-            line = self.liste_raies[to_select][0]
+        index_raies = self.get_line_index(self.liste_raies)
+        rows = index_raies.rows_of(line_num)
+        if len(rows) > 0:
+            line = self.liste_raies[rows[0]]
             refline_num = line['ref']
         if line is None:
             refline_num = line_num
-        to_select = (self.sp_theo['raie_ref']['num'] == refline_num)
-        if to_select.sum() > 0:
-            refline = self.sp_theo['raie_ref'][to_select][0]
-            to_select = (self.liste_raies['ref'] == refline_num)
-            satellites = self.liste_raies[to_select]
+        rows = self.get_line_index(self.sp_theo['raie_ref']).rows_of(refline_num)
+        if len(rows) > 0:
+            refline = self.sp_theo['raie_ref'][rows[0]]
+            satellites = self.liste_raies[np.sort(index_raies.children(refline_num))]
             order = np.argsort(satellites[sort])
             satellites = np.array(satellites)[order]
         return line, refline, satellites
 
+    def get_line_file(self, filename):
+        """
+        In-memory indexed copy (LineFile) of a file in the line list format, kept from one call to the other.
+        """
+        key = os.path.abspath(filename)
+        if key not in self.line_files:
+            self.line_files[key] = LineFile(key, num_pos=self.field_pos['num'], num_width=self.field_width['num'],
+                                            ref_pos=self.field_pos['ref'], ref_width=self.field_width['ref'])
+        return self.line_files[key]
+
     def read_satellites(self, filename, refline_num):
-        with open(filename, 'r') as f:
-            satellites = []
-            for eachline in f:
-                if int(self.fieldStrFromLine(eachline,'ref')) == refline_num:
-                    satellites.append(eachline)
-        return satellites
+        if self.get_line_db() is not None:
+            return self.get_line_db().read_satellites(filename, refline_num)
+        return self.get_line_file(filename).read_satellites(refline_num)
 
     def cosmetic_line_unchanged_old(self, line_c):
         if line_c == None:
@@ -1286,7 +2365,9 @@ class spectrum(object):
         if line_c == None:
             return None
         line_num = int(self.fieldStrFromLine(line_c,'num'))
-        line = self.get_line(self.phyat_arr, line_num)
+        return self._cosmetic_line_unchanged(line_c, line_num, self.get_line(self.phyat_arr, line_num))
+
+    def _cosmetic_line_unchanged(self, line_c, line_num, line):
         if line == None:
             log_.warn('Error in cosmetic file: line {0:} does not exist in the atomic database\n'.format(str(line_num)), calling=self.calling)
             return None
@@ -1324,7 +2405,9 @@ class spectrum(object):
         if line_c == None:
             return None
         line_num = int(self.fieldStrFromLine(line_c,'num'))
-        line = self.get_line(self.phyat_arr, line_num)
+        return self._cosmetic_line_ok(line_c, line_num, self.get_line(self.phyat_arr, line_num))
+
+    def _cosmetic_line_ok(self, line_c, line_num, line):
         if line == None:
             log_.warn('Error in cosmetic file: line {0:} does not exist in the atomic database\n'.format(str(line_num)), calling=self.calling)
             return None
@@ -1340,31 +2423,37 @@ class spectrum(object):
             else:
                 return True
 
+    def check_cosmetic_file(self, filename=None, test='ok'):
+        """
+        Check all the lines of a cosmetic file (default: fic_cosmetik) against the atomic database, 
+        looking up all their codes at once. test is 'ok' (cosmetic_line_ok) or 'unchanged' (cosmetic_line_unchanged).
+        Return the lines of the file (without end of line) and the list of the results of the test.
+        """
+        if filename is None:
+            filename = self.fic_cosmetik
+        lines = self.get_line_file(filename).get_lines()
+        line_nums = [int(self.fieldStrFromLine(line_c,'num')) for line_c in lines]
+        rows = self.get_line_index(self.phyat_arr).rows(line_nums)
+        if test == 'ok':
+            check = self._cosmetic_line_ok
+        else:
+            check = self._cosmetic_line_unchanged
+        results = [check(line_c, line_num, self.phyat_arr[row] if row >= 0 else None) 
+                   for line_c, line_num, row in zip(lines, line_nums, rows)]
+        return lines, results
+
     def read_line(self, filename, line_num):
-        line = None
-        line_num_str = str(line_num)
-        k = len(line_num_str)
         if not os.path.isfile(filename):
             return None
+        if self.get_line_db() is not None:
+            line = self.get_line_db().read_line(filename, line_num)
         else:
-            with open(filename, 'r') as f:
-                line = None
-                for eachline in f:
-                    s = self.fieldStrFromLine(eachline,'num')
-                    s = str(int(s))
-                    if (int(s) == line_num) or (s[:k] == line_num_str and s[k:].strip('0') == ''):
-                        line = eachline
-                        break
+            line = self.get_line_file(filename).read_line(line_num)
         log_.debug('Reading line {} from {}'.format(line_num, filename), calling=self.calling+'.read_line')
         return line
     
     def get_line(self, arr, line_num):
-        mask = arr['num'] == int(line_num)
-        if mask.sum() == 1:
-            line = arr[mask][0]
-        else:
-            line = None
-        return line
+        return self.get_line_index(arr).get(line_num)
 
     def replace_field(self, line, field, value):
         w = self.field_width[field]
@@ -1379,43 +2468,19 @@ class spectrum(object):
         return line
 
     def remove_line(self, filename, line_num):
-        line = self.read_line(filename, line_num)
-        if line == None:
-            return False
         if not os.path.isfile(filename):
             return False
-        else:
-            f = open(filename, 'r')
-            lines = f.readlines()
-            f.close()
-            i = lines.index(line)
-            if i >= 0:
-                del lines[i]
-                with open(filename, 'w') as f:
-                    f.writelines(lines)
-                return True
-            else:
-                return False        
+        line_file = self.get_line_file(filename)
+        removed = line_file.remove_line(line_num)
+        if removed and self.get_line_db() is not None:
+            self.get_line_db().remove_line(filename, line_num, file_written=not line_file.modified)
+        return removed
 
     def replace_line(self, filename, line):
-        line_num = int(self.fieldStrFromLine(line,'num'))
-        if os.path.isfile(filename):
-            lineNotFound = True
-            with open(filename, 'r') as f:
-                lines = f.read().splitlines()
-                for i in range(0, len(lines)):
-                    curr_line = lines[i]
-                    if int(self.fieldStrFromLine(curr_line,'num')) == line_num:
-                        lines[i] = line + '\n'
-                        lineNotFound = False
-                    else:
-                        lines[i] = lines[i] + '\n'
-            if lineNotFound:    
-                lines.append(line)
-        else:
-            lines = [line]                
-        with open(filename, 'w') as f:
-            f.writelines(lines)
+        line_file = self.get_line_file(filename)
+        line_file.replace_line(line)
+        if self.get_line_db() is not None:
+            self.get_line_db().replace_line(filename, line, file_written=not line_file.modified)
 
     def fieldStrFromLine(self, lineOfFile, field):
         if lineOfFile == None:
@@ -1435,33 +2500,45 @@ class spectrum(object):
             for line in line_num:
                 self.line_info(line, sat_info=sat_info, print_header=False)
             return 
-        to_print = (self.liste_raies['num'] == line_num)
-        if to_print.sum() == 1:
-            raie = self.liste_raies[to_print][0]
+        synth_db = self.get_synth_db()
+        if synth_db is not None:
+            rows = synth_db.synth_rows_of(line_num)
+            raie = self.liste_raies[rows[0]] if len(rows) == 1 else None
+        else:
+            index_raies = self.get_line_index(self.liste_raies)
+            raie = index_raies.get(line_num)
+        if raie is not None:
             self.print_line(raie)
+            blend = self.get_blend(line_num)
+            if blend is not None:
+                print('Blended in the synthesis with: {0}'.format(', '.join([str(n) for n in blend if n != line_num])))
             if raie['ref'] != 0 and sat_info:
                 print('\nSatellite line of:')
                 self.line_info(raie['ref'], print_header=False)
                 
-        to_print = (self.sp_theo['raie_ref']['num'] == line_num)
-        if to_print.sum() > 0 and sat_info:
-            raie = self.sp_theo['raie_ref'][to_print][0]
+        rows = self.get_line_index(self.sp_theo['raie_ref']).rows_of(line_num)
+        if len(rows) > 0 and sat_info:
+            raie = self.sp_theo['raie_ref'][rows[0]]
             self.print_line(raie)
             print('')
-            satellites_tab = (self.liste_raies['ref'] == raie['num'])
-            Nsat = satellites_tab.sum()
+            if synth_db is not None:
+                satellites_rows = synth_db.synth_children(raie['num'])
+            else:
+                satellites_rows = np.sort(index_raies.children(raie['num']))
+            Nsat = len(satellites_rows)
             if Nsat > 0:
                 print('{0} satellites'.format(Nsat))
-                self.print_line(self.liste_raies[satellites_tab], sort=sort, reverse=reverse)
-            if self.sp_theo['correc'][to_print][0] != 1.0:
-                print('Intensity corrected by {0}'.format(self.sp_theo['correc'][to_print][0]))
+                self.print_line(self.liste_raies[satellites_rows], sort=sort, reverse=reverse)
+            if self.sp_theo['correc'][rows[0]] != 1.0:
+                print('Intensity corrected by {0}'.format(self.sp_theo['correc'][rows[0]]))
         if print_header:
             print('-'*45)
 
     def get_ref_list(self, ions):
         ref_list = []
+        ion_index = self.get_ion_index()
         for ion in ions:
-            i_ion = np.where(self.sp_theo['raie_ref']['id'] == ion.ljust(9))[0]
+            i_ion = ion_index.ref_rows(ion)
             if len(i_ion) == 0:
                 ref_list.append(-1)
             for i in i_ion:
@@ -1496,6 +2573,14 @@ class spectrum(object):
             int_ion = 999
         return element, int_ion
 
+    def ion_sort_key(self, label):
+        """
+        Natural sort key of an ion label: element, then ionization stage, then label.
+        """
+        true_ion = self.true_ion(label)
+        element, int_ion = self.get_element_and_int_ion(true_ion)
+        return (element, int_ion, true_ion, label)
+
     def set_selected_ions_data(self):
 
         color = 'dummy'
@@ -1511,18 +2596,17 @@ class spectrum(object):
         linestyles = [ 'solid', 'dashed', 'dashdot', 'dotted' ]
         label_list = []
         ref_list = []
+        ion_index = self.get_ion_index()
+        index_raies = self.get_line_index(self.liste_raies)
+        index_ref = self.get_line_index(self.sp_theo['raie_ref'])
         
         for ion in selected_ions:
-            i_ion = np.where(self.sp_theo['raie_ref']['id'] == ion.ljust(9))[0]
+            i_ion = ion_index.ref_rows(ion)
             if len(i_ion) == 0:
-                i_ion_raies = np.where(self.liste_raies['id'] == ion.ljust(9))[0]
+                i_ion_raies = ion_index.sat_rows(ion)
                 if len(i_ion_raies) > 0:
-                    ref_list = self.liste_raies[i_ion_raies]['ref']     
-                    ref_list = list(set(ref_list))
-                    i_ion = []
-                    for i in ref_list:
-                        i_ion = i_ion + list(np.where(self.sp_theo['raie_ref']['num'] == i)[0])
-                    i_ion = list(set(i_ion))
+                    ref_list = np.unique(self.liste_raies['ref'][i_ion_raies])
+                    i_ion = sorted(set(np.concatenate([index_ref.rows_of(i) for i in ref_list]).tolist()))
             ref_list = []
             ref_ion = []
             ion_list = []
@@ -1534,10 +2618,8 @@ class spectrum(object):
                 this_ion = self.sp_theo['raie_ref'][i_ion[i]]['id'].strip()
                 ref_ion.append(this_ion)
 
-                i_ion_raies = np.where(self.liste_raies['ref'] == ref_line)[0]
-                for j in i_ion_raies:
-                    this_ion = self.liste_raies[j]['id'].strip()
-                    ion_list.append(this_ion)
+                i_ion_raies = index_raies.children(ref_line)
+                ion_list.extend(np.char.strip(self.liste_raies['id'][i_ion_raies]).tolist())
             
             ref_ion = list(set(ref_ion))
             ion_list = list(set(ion_list))
@@ -1559,22 +2641,7 @@ class spectrum(object):
                 label_list.append([ion, ion_list, ref_list, list(i_ion), color, linestyle])
                 
         # sorting
-        for i in range(0,len(label_list)-1):
-            label1 = label_list[i][pos_label]
-            true_ion1 = self.true_ion(label1)
-            element1, int_ion1 = self.get_element_and_int_ion(true_ion1)
-            for j in range(i+1, len(label_list)):
-                label2 = label_list[j][pos_label]
-                true_ion2 = self.true_ion(label2)
-                element2, int_ion2 = self.get_element_and_int_ion(true_ion2)
-                if (element2 < element1) or ((element2 == element1) and (int_ion2 < int_ion1)) or ((true_ion2 == true_ion1) and (label2 < label1)): 
-                    prov = label_list[i]
-                    label_list[i] = label_list[j]
-                    label_list[j] = prov
-                    label1 = label2
-                    true_ion1 = true_ion2
-                    element1 = element2
-                    int_ion1 = int_ion2
+        label_list.sort(key=lambda item: self.ion_sort_key(item[pos_label]))
 
         if self.get_conf('diff_lines_by') == 2:
             i = 0
@@ -1623,30 +2690,30 @@ class spectrum(object):
         ref_code_list = []
         ref_index_list = []
         ref_label_list = []
+        ion_index = self.get_ion_index()
         for ion in ions:
             ion = self.true_ion(ion)
-            i_ion = np.where(self.sp_theo['raie_ref']['id'] == ion.ljust(9))[0]
+            i_ion = ion_index.ref_rows(ion)
             if len(i_ion) == 0:
                 ref_code_list.append(-1)
                 ref_index_list.append(-1)
                 ref_label_list.append(ion.replace('_',' ') + ' (no lines)')
-            for i in i_ion:
+            for k, i in enumerate(i_ion):
                 ref_code_list.append(self.sp_theo['raie_ref'][i][0])
                 ref_index_list.append(i)
                 if len(i_ion) == 1:
                     ref_label_list.append(ion.replace('_',' '))
                 else:
-                    ref_label_list.append(ion.replace('_',' ')+ ' - ' + str(np.where(i_ion==i)[0][0]))
+                    ref_label_list.append(ion.replace('_',' ')+ ' - ' + str(k))
 #              ref_label_list.append(ion.replace('_',' ')+ ' - ' + str(self.sp_theo['raie_ref'][i][0])[:-8])
         return ref_code_list, ref_index_list, ref_label_list
 
     def get_ref_index_list(self, ions):
         ref_index_list = []
+        ion_index = self.get_ion_index()
         for ion in ions:
             ion = self.true_ion(ion)
-            i_ion = np.where(self.sp_theo['raie_ref']['id'] == ion.ljust(9))[0]
-            for i in i_ion:
-                ref_index_list.append(i)
+            ref_index_list.extend(ion_index.ref_rows(ion))
         return ref_index_list
 
     def get_line_from_reduce_code(self, code_str):
@@ -1659,19 +2726,29 @@ class spectrum(object):
         return line
         
     
+    def get_line_from_code(self, code_str):
+        try:
+            line_num = int(code_str)
+        except (ValueError, TypeError):
+            return None
+        if code_str != str(line_num):
+            return None
+        rows = self.get_line_index(self.liste_raies).rows_of(line_num)
+        if len(rows) == 0:
+            return None
+        return self.liste_raies[rows[-1]]
+
     def get_refline_from_code(self, code_str):
-        s = ''
-        for line in self.liste_raies:
-            if code_str == str(line[0]):
-                s = line['ref']
-        return s
+        line = self.get_line_from_code(code_str)
+        if line is None:
+            return ''
+        return line['ref']
         
     def get_ion_from_code(self,code_str):
-        s = ''
-        for line in self.liste_raies:
-            if code_str == str(line[0]):
-                s = line['id']
-        return s
+        line = self.get_line_from_code(code_str)
+        if line is None:
+            return ''
+        return line['id']
         
     def isRoman(self, s):
         isRom = True
@@ -1695,32 +2772,25 @@ class spectrum(object):
                 
     def get_all_ions_from_ion(self, ion):
         ion = self.true_ion(ion)
-        ion_list = [ion]
-        k = len(ion)
-        for line in self.liste_raies:
-            s = str(line['id'])
-            if len(s) > k and s[:k] == ion and s[k] not in [ 'I', 'V', 'X' ]:
-                ion_list.append(s.strip())
+        ion_list = [ion] + self.get_ion_index().ions_starting_with(ion)
         return list(set(ion_list))
         
     def get_ions_from_element(self, elem):
-        ion_list = []
-        for line in self.liste_raies:
-            s = str(line['id'])
-            k = s.find('_')
-            if elem == s[:k]:
-                ion_list.append(s.strip())
-        return list(set(ion_list))
+        return self.get_ion_index().ions_of_element(elem)
 
     def save_lines(self):
+        """
+        Save the lines of liste_raies (selected by cut_plot2 and the selected ions if the corresponding options
+        are set) in line_saved_filename, as text, tex, csv (depending on the extension) or npz.
+        The columns are formatted in bulk and the file is written by blocks of lines.
+        """
         if self.get_conf('show_selected_intensities_only'):
             cut = self.get_conf('cut_plot2')
         else:
             cut = 0.0
-        ref_list = self.get_ref_list(self.get_conf('selected_ions'))        
         sort_list = [ 'lambda', 'i_rel', 'id' ]
         k = self.get_conf('line_saved_ordered_by')
-        sort = sort_list[k/2]
+        sort = sort_list[k//2]
         filename = self.get_conf('line_saved_filename')
         extension = os.path.splitext(filename)[1][1:].lower()
         sep = ' '
@@ -1734,9 +2804,31 @@ class spectrum(object):
         sorts = np.argsort(self.liste_raies[sort])
         if k%2 == 1:
             sorts = sorts[::-1]
+        i_tot = self.liste_raies['i_rel'] * self.liste_raies['i_cor']
+        mask = np.abs(i_tot) > cut
+        if self.get_conf('show_selected_ions_only'):
+            ref_list = self.get_ref_list(self.get_conf('selected_ions'))
+            mask &= np.isin(self.liste_raies['ref'], ref_list)
+        sorts = sorts[mask[sorts]]
+        field_print = self.get_conf('line_field_print')
+        n = len(field_print)
+
+        def get_column(item, rows):
+            lines = self.liste_raies
+            if item == 'l_tot':
+                return lines['lambda'][rows] + lines['l_shift'][rows] + self.conf['lambda_shift']
+            elif item == 'i_tot':
+                return i_tot[rows]
+            elif item == 'comment' and 'comment' not in lines.dtype.names:
+                return np.array([self.get_comment(line) for line in lines[rows]])
+            else:
+                return lines[item][rows]
+
+        if extension == 'npz':
+            np.savez(filename, **dict((item, get_column(item, sorts)) for item in field_print))
+            return
+
         with open(filename, 'w') as f:
-            field_print = self.get_conf('line_field_print')
-            n = len(field_print)
             
             if self.get_conf('line_saved_header'):
                 s = ''
@@ -1745,7 +2837,6 @@ class spectrum(object):
                   
                 for item in field_print:
                     width = self.field_width[item]
-                    thisformat = '{{:{a}{w}s}{}}'
                     if ( item == field_print[n-1] ):
                         add_s = end
                     else:
@@ -1757,31 +2848,30 @@ class spectrum(object):
                     s = s + str('{:{a}{w}s}{}'.format(item, add_s, a=align, w=width))
                 f.write('\n'+s+'\n')
             
-            for i_sort in sorts:
-                line = self.liste_raies[i_sort]
-                wl = line['lambda'] + line['l_shift'] + self.conf['lambda_shift']
-                i_rel = line['i_rel']
-                i_tot = line['i_rel'] * line['i_cor']
-                #if (abs(i_rel) > cut) and ( not self.get_conf('show_selected_ions_only') or line['ref'] in ref_list):
-                if (abs(i_tot) > cut) and ( not self.get_conf('show_selected_ions_only') or line['ref'] in ref_list):
-                    s = ''
-                    n = len(field_print)
-                    for item in field_print:
-                        thisformat = self.field_format[item]
-                        if item == 'l_tot':
-                            r = wl
-                        elif item == 'i_tot':
-                            r = i_tot
-                        else:
-                            r = line[item]
-                        if item == 'l_shift': 
-                            s = s + ' '
-                        s = s + str(thisformat.format(r))
-                        if ( item == field_print[n-1] ):
-                            s = s + end
-                        else:
-                            s = s + sep
-                    f.write(s)
+            # Each line is formatted with one % operation, the columns without printf equivalent being 
+            # formatted first
+            line_format = []
+            for item in field_print:
+                item_format = printf_format(self.field_format[item])
+                if item_format is None:
+                    item_format = '%s'
+                if item == 'l_shift':
+                    item_format = ' ' + item_format
+                line_format.append(item_format)
+            line_format = sep.replace('%', '%%').join(line_format) + end.replace('%', '%%')
+            block = 100000
+            for i in range(0, len(sorts), block):
+                rows = sorts[i:i+block]
+                columns = []
+                for item in field_print:
+                    column = get_column(item, rows)
+                    if column.dtype.kind == 'S':
+                        column = column.astype(str)
+                    column = column.tolist()
+                    if printf_format(self.field_format[item]) is None:
+                        column = [self.field_format[item].format(v) for v in column]
+                    columns.append(column)
+                f.writelines(line_format % values for values in zip(*columns))
 
     def plot1(self):
         f, ax = plt.subplots()
@@ -1920,11 +3010,9 @@ class spectrum(object):
             
         if self.sp_synth_lr is None:
             return
-        for line in self.liste_raies:
-            wl = line['lambda'] + line['l_shift'] + self.conf['lambda_shift']
-            i_rel = line['i_rel']
-            if (abs(i_rel) > self.get_conf('cut_plot2')): 
-                ax.axvline( wl, ymin=0.2, ymax=0.8, color = 'blue', linestyle = 'solid', linewidth = 1.5 )
+        wl_index = self.get_wl_index()
+        for wl in wl_index.wl[wl_index.rows_in(-np.inf, np.inf, cut=self.get_conf('cut_plot2'), cut_on='i_rel')]:
+            ax.axvline( wl, ymin=0.2, ymax=0.8, color = 'blue', linestyle = 'solid', linewidth = 1.5 )
 #                ax.plot([wl, wl], [0, 1], color='blue')
 #                ax.text(wl, -0.2, '{0} {1:7.4f}'.format(line['id'], i_rel), 
 #                              rotation='vertical', fontsize=self.ax2_fontsize).set_clip_on(True)
@@ -1939,22 +3027,24 @@ class spectrum(object):
         if j in range(0, len(label_list)):
             label_list = label_list[j:j+1]
 
-        for line in self.liste_raies:
-            wl = line['lambda'] + line['l_shift'] + self.conf['lambda_shift']
-            i_rel = line['i_rel']
-            i_tot = line['i_rel'] * line['i_cor']
-            if (wmin < wl) and (wl < wmax) and ((abs(i_tot) > self.get_conf('cut_plot2')) or ( not self.get_conf('show_selected_intensities_only'))): 
-                if not self.get_conf('show_selected_ions_only'):
-                    ax.axvline( wl, ymin=y1, ymax=y2, color = lcolor, linestyle = 'solid' )
-                refline = line['ref']
-                ion = line['id'].strip()
-                for item in label_list:
-                    ion_list = item[1]
-                    ref_list = item[2]
-                    color = item[4]
-                    linestyle = item[5]
-                    if refline in ref_list and ion in ion_list:
-                        ax.axvline( wl, ymin=y1, ymax=y2, color = color, linestyle = linestyle, linewidth = 1.5 )
+        wl_index = self.get_wl_index()
+        if self.get_conf('show_selected_intensities_only'):
+            cut = self.get_conf('cut_plot2')
+        else:
+            cut = None
+        rows = wl_index.rows_in(wmin, wmax, cut=cut)
+        if not self.get_conf('show_selected_ions_only'):
+            for wl in wl_index.wl[rows]:
+                ax.axvline( wl, ymin=y1, ymax=y2, color = lcolor, linestyle = 'solid' )
+        for item in label_list:
+            ion_list = item[1]
+            ref_list = item[2]
+            color = item[4]
+            linestyle = item[5]
+            rows_ion = rows[np.isin(self.liste_raies['ref'][rows], ref_list)]
+            rows_ion = rows_ion[np.isin(np.char.strip(self.liste_raies['id'][rows_ion]), ion_list)]
+            for wl in wl_index.wl[rows_ion]:
+                ax.axvline( wl, ymin=y1, ymax=y2, color = color, linestyle = linestyle, linewidth = 1.5 )
         
         # To add ticks to the legend of the figure when the spectrum of the selected ions are not plotted
         if show_legend:
@@ -2010,7 +3100,7 @@ class spectrum(object):
                 self.ax1_line_magenta.remove()
             except:
                 pass
-            i_magenta = np.where(self.sp_theo['raie_ref']['num'] == self.plot_magenta)[0]
+            i_magenta = self.get_line_index(self.sp_theo['raie_ref']).rows_of(self.plot_magenta)
             if self.label_magenta is None:
                 self.label_magenta = self.sp_theo['raie_ref'][i_magenta]['id']
             if len(i_magenta) == 1:
@@ -2021,7 +3111,7 @@ class spectrum(object):
                 self.ax1_line_cyan.remove()
             except:
                 pass
-            i_cyan = np.where(self.sp_theo['raie_ref']['num'] == self.plot_cyan)[0]
+            i_cyan = self.get_line_index(self.sp_theo['raie_ref']).rows_of(self.plot_cyan)
             if self.label_cyan is None:
                 self.label_cyan = self.sp_theo['raie_ref'][i_cyan]['id']
             if len(i_cyan) == 1:
@@ -2033,12 +3123,11 @@ class spectrum(object):
         for i in np.arange(len(self.ax2.lines)):
             self.ax2.lines.pop()
         
-        i_max = np.max(self.liste_raies['i_rel'])
-        for line in self.liste_raies:
-            wl = line['lambda'] + line['l_shift'] + self.conf['lambda_shift']
-            i_rel = line['i_rel']
-            if (abs(i_rel) > self.get_conf('cut_plot2')) & (wl > self.ax2.get_xlim()[0]) & (wl < self.ax2.get_xlim()[1]):
-                self.ax2.axvline( wl, ymin=0.2, ymax=0.8, color = 'blue', linestyle = 'solid', linewidth = 1.5 )
+        wl_index = self.get_wl_index()
+        rows = wl_index.rows_in(self.ax2.get_xlim()[0], self.ax2.get_xlim()[1], 
+                                cut=self.get_conf('cut_plot2'), cut_on='i_rel')
+        for wl in wl_index.wl[rows]:
+            self.ax2.axvline( wl, ymin=0.2, ymax=0.8, color = 'blue', linestyle = 'solid', linewidth = 1.5 )
                 #self.ax2.plot([wl, wl], [0, 1], color='blue')
                 #self.ax2.text(wl, -0.2, '{0} {1:7.4f}'.format(line['id'], i_rel), 
                 #                rotation='vertical', fontsize=self.ax2_fontsize)
@@ -2276,7 +3365,11 @@ class spectrum(object):
             return  None
         w = (w1 + w2)/2
         w_lim = abs(w2 - w1)/2
-        tt = (np.abs(self.liste_raies['lambda'] + self.liste_raies['l_shift'] + self.conf['lambda_shift'] - w) < w_lim)
+        synth_db = self.get_synth_db()
+        if synth_db is not None:
+            tt = synth_db.synth_rows_in(w - w_lim, w + w_lim, self.get_conf('lambda_shift', 0.0))
+        else:
+            tt = self.get_wl_index().rows_in(w - w_lim, w + w_lim)
         nearby_lines = self.liste_raies[tt]
         i_tot = nearby_lines['i_rel']*nearby_lines['i_cor']
         if sort == 'i_tot':
@@ -2286,7 +3379,7 @@ class spectrum(object):
         if reverse:
             sorts = sorts[::-1]
         nearby_lines = np.array(nearby_lines)[sorts]
-        if tt.sum() > 0:
+        if len(tt) > 0:
             if do_print:
                 print('\n{0:-^45}'.format(' CURSOR on {0:.3f} '.format(w)))
                 self.print_line(self.liste_raies[tt])
@@ -2341,8 +3434,8 @@ class spectrum(object):
         try:
             if event.button in (1,3):
                 wl_lim = self.cursor_width * (self.ax1.get_xlim()[1] - self.ax1.get_xlim()[0])
-                tt = (np.abs(self.liste_raies['lambda'] + self.liste_raies['l_shift'] + self.conf['lambda_shift'] - wl) < wl_lim)
-                if tt.sum() > 0:
+                tt = self.get_wl_index().rows_in(wl - wl_lim, wl + wl_lim)
+                if len(tt) > 0:
                     print('\n{0:-^45}'.format(' CURSOR on {0:.3f} '.format(wl)))
                     self.print_line(self.liste_raies[tt])
                     print('-'*45)
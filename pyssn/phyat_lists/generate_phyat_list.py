@@ -724,6 +724,7 @@ def make_all_lists():
     parser.add_argument("-D", "--pynebdatafiles", help="PyNeb datafiles file", default=None)
     parser.add_argument("-O", "--phyat_file", help="Output phyat file")
     parser.add_argument("-v", "--verbose", action="store_true", help="Verbose")
+    parser.add_argument("-n", "--n_procs", type=int, help="Number of processes for the collisional lines", default=None)
     
     
     args = parser.parse_args()
@@ -767,7 +768,8 @@ def make_all_lists_args(args):
           Aij_zero_dic=Aij_zero_dic,
           Del_ion = Del_ion,
           phy_cond_file = args.phy_cond_file,
-          extra_file=extra_file)
+          extra_file=extra_file,
+          n_procs=getattr(args, 'n_procs', None))
     print('phyat col done')
     if args.ion_only is None:
         merge_files((execution_path('liste_phyat_rec.dat', extra='../fortran/'), execution_path('liste_phyat_coll.dat'), 
@@ -7,7 +7,8 @@ import os
 import shutil
 import time
 from glob import glob
-from pyssn.utils.misc import split_atom, read_data, execution_path
+from pyssn import config
+from pyssn.utils.misc import split_atom, read_data, execution_path, fork_pool
 
 pn.atomicData.addAllChianti()
 pn.config.vactoair_high_wl = 20000.
@@ -88,7 +89,7 @@ def print_phyat_list(atom, tem, den, cut=1e-3, cut_inter=1e-5, ij_ref = None, fi
         str_print += '\n'
         if type(filename) is str:
             f = open(filename, 'w')
-        elif type(filename) is file:
+        elif hasattr(filename, 'write'):
             f = filename
 
     if filename is None:
@@ -105,7 +106,7 @@ def print_phyat_list(atom, tem, den, cut=1e-3, cut_inter=1e-5, ij_ref = None, fi
         lf = open(log_file, 'w')
         def logprint(s):
             lf.write(s)
-    elif type(log_file) is file:
+    elif hasattr(log_file, 'write'):
         lf = log_file            
         def logprint(s):
             lf.write(s)
@@ -117,7 +118,7 @@ def print_phyat_list(atom, tem, den, cut=1e-3, cut_inter=1e-5, ij_ref = None, fi
         hf = open(log_file, 'w')
         def hprint(s):
             hf.write(s)
-    elif type(help_file) is file:
+    elif hasattr(help_file, 'write'):
         hf = help_file            
         def hprint(s):
             hf.write(s)
@@ -146,7 +147,9 @@ def print_phyat_list(atom, tem, den, cut=1e-3, cut_inter=1e-5, ij_ref = None, fi
             logprint('Atom {} without energy levels'.format(atom_str))
         return None
     #print('Doing {} with NLevels={}'.format(atom.atom, this_NLevels))
-    atom = pn.Atom(atom=atom.atom, NLevels=this_NLevels)
+    # The atom is built again only if it has to be modified
+    if this_NLevels != atom.NLevels or Aij_zero is not None:
+        atom = pn.Atom(atom=atom.atom, NLevels=this_NLevels)
     if Aij_zero  is not None:
         for ij in Aij_zero:
             atom._A[ij[0]-1, ij[1]-1] = 0.0
@@ -286,10 +289,81 @@ def print_phyat_list(atom, tem, den, cut=1e-3, cut_inter=1e-5, ij_ref = None, fi
     if type(log_file) is str:
         lf.close()
 
+class _Buffer(object):
+    """
+    Collects the strings written to it, used in place of a file by print_phyat_list.
+    """
+    def __init__(self):
+        self.strs = []
+    def write(self, s):
+        self.strs.append(s)
+    def getvalue(self):
+        return ''.join(self.strs)
+
+# Parameters of make_phyat_list, used by _phyat_atom in the processes (inherited from the parent process)
+_phyat_conf = None
+
+def get_tem_den(atom, dic_temp_ion, dic_dens_ion, tab_temp_dens):
+    if atom.atom in dic_temp_ion:
+        temp = dic_temp_ion[atom.atom]
+        dens = dic_dens_ion[atom.atom]
+        return temp, dens
+    else:
+        for temp_dens in tab_temp_dens:
+            if temp_dens['IP'] > atom.IP:
+                temp = temp_dens['temp']
+                dens = temp_dens['dens']
+                return temp, dens
+
+def _phyat_atom(a):
+    """
+    Lines of the atom a for make_phyat_list, using the parameters in _phyat_conf.
+    Return the strings to be written in the phyat, log and help files.
+    """
+    pc = _phyat_conf
+    f = _Buffer()
+    log_file = _Buffer()
+    help_file = _Buffer()
+    ref_lines = pc['ref_lines_dic'].get(a)
+    this_NLevels = pc['NLevels_dic'].get(a, pc['NLevels'])
+    up_lev_rule = pc['up_lev_rule_dic'].get(a)
+    conf = gsFromAtom(a)
+    log_file.write('{}, conf={}, '.format(a, conf))
+    atom_str=''
+    try:
+        atom = pn.Atom(atom=a, NLevels=this_NLevels)
+        try:
+            atom_str = '{}-{}'.format(atom.atomFile, atom.collFile)
+        except:
+            atom_str = 'atom {} not build'.format(a)
+        if atom.NLevels > 0:
+            do_it = True
+        else:
+            do_it = False
+    except:
+        log_file.write('Atom not build. {} \n'.format(atom_str))
+        do_it = False
+    if do_it:
+        tem, den = get_tem_den(atom, pc['dic_temp_ion'], pc['dic_dens_ion'], pc['tab_temp_dens'])
+        Aij_zero = pc['Aij_zero_dic'].get(a)
+        if pc['notry']:
+            print_phyat_list(atom, tem, den, cut=pc['cut'], filename=f, E_cut=pc['E_cut'], log_file=log_file, 
+                              cut_inter=pc['cut_inter'], verbose=pc['verbose'], help_file=help_file, ij_ref=ref_lines,
+                              up_lev_rule=up_lev_rule, Aij_zero=Aij_zero)                
+        else:
+            try:
+                print_phyat_list(atom, tem, den, cut=pc['cut'], filename=f, E_cut=pc['E_cut'], log_file=log_file, 
+                              cut_inter=pc['cut_inter'], verbose=pc['verbose'], help_file=help_file, ij_ref=ref_lines,
+                              up_lev_rule=up_lev_rule, Aij_zero=Aij_zero)    
+            except:
+                log_file.write('plp error.')
+        log_file.write('\n')
+    return f.getvalue(), log_file.getvalue(), help_file.getvalue()
+
 def make_phyat_list(filename, cut=1e-4, E_cut=20, cut_inter=1e-5, 
              verbose=False, notry=False, NLevels=50, atoms=None, 
              ref_lines_dic=None, NLevels_dic=None, up_lev_rule_dic=None, Aij_zero_dic=None,
-             Del_ion = None, phy_cond_file = 'phy_cond.dat', extra_file=None):
+             Del_ion = None, phy_cond_file = 'phy_cond.dat', extra_file=None, n_procs=None):
     
     """
     filename: output file name
@@ -327,6 +401,8 @@ def make_phyat_list(filename, cut=1e-4, E_cut=20, cut_inter=1e-5,
                         }
     
     extra_file: a file of pySSN data format containing data to include.
+    n_procs: number of processes among which the atoms are distributed. The output files are the same as
+        with one process. Default: config.Nprocs if multiprocessing is used, 1 otherwise.
     """
     
     
@@ -454,21 +530,9 @@ def make_phyat_list(filename, cut=1e-4, E_cut=20, cut_inter=1e-5,
             else:
                 dic_temp_ion['{}{}'.format(record['name'], int(record['value']))] = record['temp']
                 dic_dens_ion['{}{}'.format(record['name'], int(record['value']))] = record['dens']
-    tab_temp_dens = np.array(zip(tab_ips, tab_temps, tab_denss), dtype=[('IP', float), ('temp', float), ('dens', float)])
+    tab_temp_dens = np.array(list(zip(tab_ips, tab_temps, tab_denss)), dtype=[('IP', float), ('temp', float), ('dens', float)])
     tab_temp_dens.sort()
     
-    def get_tem_den(atom):
-        if atom.atom in dic_temp_ion:
-            temp = dic_temp_ion[atom.atom]
-            dens = dic_dens_ion[atom.atom]
-            return temp, dens
-        else:
-            for temp_dens in tab_temp_dens:
-                if temp_dens['IP'] > atom.IP:
-                    temp = temp_dens['temp']
-                    dens = temp_dens['dens']
-                    return temp, dens
-    
     f = open(filename, 'w')
     #f.write("# liste_phyat automatically generated on {} \n".format(time.ctime()))
     log_file = open('log.dat', 'w')
@@ -493,67 +557,45 @@ def make_phyat_list(filename, cut=1e-4, E_cut=20, cut_inter=1e-5,
         atoms = get_atoms_by_conf(atoms=atoms)
         
     atoms = unique(atoms)
-    printed_confs = []
-    #atoms = []
+    atoms = [a for a in atoms if a not in Del_ion]
+    pn_atoms = [a for a in atoms if a not in extra_atoms]
+    
+    global _phyat_conf
+    _phyat_conf = {'cut': cut, 'E_cut': E_cut, 'cut_inter': cut_inter, 'verbose': verbose, 'notry': notry,
+                   'NLevels': NLevels, 'ref_lines_dic': ref_lines_dic, 'NLevels_dic': NLevels_dic,
+                   'up_lev_rule_dic': up_lev_rule_dic, 'Aij_zero_dic': Aij_zero_dic,
+                   'dic_temp_ion': dic_temp_ion, 'dic_dens_ion': dic_dens_ion, 'tab_temp_dens': tab_temp_dens}
+    if n_procs is None:
+        n_procs = config.Nprocs if (config.INSTALLED['mp'] and config._use_mp) else 1
+    try:
+        # The processes inherit _phyat_conf, they are only used where they can be started by fork
+        if n_procs > 1 and len(pn_atoms) > 1 and hasattr(os, 'fork'):
+            pool = fork_pool(n_procs)
+            try:
+                pn_res = pool.map(_phyat_atom, pn_atoms, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            pn_res = [_phyat_atom(a) for a in pn_atoms]
+    finally:
+        _phyat_conf = None
+    pn_res = dict(zip(pn_atoms, pn_res))
+    
     for a in atoms:
-        if a not in Del_ion:
-            print(a)
-            if a in extra_atoms:
-                n_lines = 0
-                for line in extra_data[extra_atoms == a]:
-                    if line[0] != '9':
-                        n_lines += 1
-                    f.write(line)
-                log_file.write('{}, {} lines from file {}\n'.format(a, n_lines, extra_file))
-            else:
-                if a in ref_lines_dic:
-                    ref_lines = ref_lines_dic[a]
-                else:
-                    ref_lines = None
-                if a in NLevels_dic:
-                    this_NLevels = NLevels_dic[a]
-                else:
-                    this_NLevels = NLevels
-                if a in up_lev_rule_dic:
-                    up_lev_rule = up_lev_rule_dic[a]
-                else:
-                    up_lev_rule = None
-                conf = gsFromAtom(a)
-                log_file.write('{}, conf={}, '.format(a, conf))
-                if conf not in printed_confs:
-                    printed_confs.append(conf)
-                atom_str=''
-                try:
-                    atom = pn.Atom(atom=a, NLevels=this_NLevels)
-                    try:
-                        atom_str = '{}-{}'.format(atom.atomFile, atom.collFile)
-                    except:
-                        atom_str = 'atom {} not build'.format(a)
-                    if atom.NLevels > 0:
-                        do_it = True
-                    else:
-                        do_it = False
-                except:
-                    log_file.write('Atom not build. {} \n'.format(atom_str))
-                    do_it = False
-                if do_it:
-                    tem, den = get_tem_den(atom)
-                    if a in Aij_zero_dic:
-                        Aij_zero = Aij_zero_dic[a]
-                    else:
-                        Aij_zero = None
-                    if notry:
-                        print_phyat_list(atom, tem, den, cut=cut, filename=f, E_cut=E_cut, log_file=log_file, 
-                                          cut_inter=cut_inter, verbose=verbose, help_file=help_file, ij_ref=ref_lines,
-                                          up_lev_rule=up_lev_rule, Aij_zero=Aij_zero)                
-                    else:
-                        try:
-                            print_phyat_list(atom, tem, den, cut=cut, filename=f, E_cut=E_cut, log_file=log_file, 
-                                          cut_inter=cut_inter, verbose=verbose, help_file=help_file, ij_ref=ref_lines,
-                                          up_lev_rule=up_lev_rule, Aij_zero=Aij_zero)    
-                        except:
-                            log_file.write('plp error.')
-                    log_file.write('\n')
+        print(a)
+        if a in extra_atoms:
+            n_lines = 0
+            for line in extra_data[extra_atoms == a]:
+                if line[0] != '9':
+                    n_lines += 1
+                f.write(line)
+            log_file.write('{}, {} lines from file {}\n'.format(a, n_lines, extra_file))
+        else:
+            lines, log, help_ = pn_res[a]
+            f.write(lines)
+            log_file.write(log)
+            help_file.write(help_)
                     
     #f.write('\n')
     f.close()
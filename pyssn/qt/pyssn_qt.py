@@ -1382,6 +1382,12 @@ class AppForm(QtGui.QMainWindow):
                     item.setBackgroundColor(self.readOnlyCells_bg_color)
                 self.line_info_table.setItem(i,j,item)
 
+        def blend_text(line):
+            blend = self.sp.get_blend(int(self.sp.fieldStrFromLine(line,'num')))
+            if blend is None:
+                return ''
+            return ' (blended in the synthesis with {} other lines)'.format(len(blend)-1)
+
         def fill_text(i, text):
             item = QtGui.QTableWidgetItem(text)
             item.setFlags(item.flags() ^ (QtCore.Qt.ItemIsEditable|QtCore.Qt.ItemIsSelectable|QtCore.Qt.ItemIsEnabled))
@@ -1527,7 +1533,7 @@ class AppForm(QtGui.QMainWindow):
             k = 0
             sat_list = []
             if line is not None:
-                fill_text(k,'Line:')
+                fill_text(k,'Line:' + blend_text(line))
                 k += 2
                 fill_data(k, line, 'sat')
                 k += 1
@@ -2546,28 +2552,24 @@ class AppForm(QtGui.QMainWindow):
     def remove_duplicate_lines(self, lines):
         if lines is None:
             return None
-        numbers = []
+        numbers = set()
         output = []
         for line in lines:
             line_num = int(self.sp.fieldStrFromLine(line,'num'))
             if line_num not in numbers:
-                numbers.append(line_num)
+                numbers.add(line_num)
                 output.append(line)
         return output
     
     def order_cosmetic_file(self):
         if self.sp.fic_cosmetik is None or not os.path.isfile(self.sp.fic_cosmetik):
             return
-        f = open(self.sp.fic_cosmetik, 'r')
-        cosmetic_lines = f.readlines()
-        f.close()
-        cosmetic_lines = self.order_lines(cosmetic_lines)
+        cosmetic_file = self.sp.get_line_file(self.sp.fic_cosmetik)
+        cosmetic_lines = self.order_lines(cosmetic_file.get_lines())
         n0 = len(cosmetic_lines)
         cosmetic_lines = self.remove_duplicate_lines(cosmetic_lines)
         n1 = len(cosmetic_lines)
-        f = open(self.sp.fic_cosmetik, 'w')
-        f.writelines(cosmetic_lines)
-        f.close()
+        cosmetic_file.set_lines(cosmetic_lines)
         if n0 > n1:
             s = ' and the duplicate lines removed'
         else:
@@ -2615,15 +2617,13 @@ class AppForm(QtGui.QMainWindow):
             return
         if not os.path.isfile(self.sp.fic_cosmetik):
             return
-        f = open(self.sp.fic_cosmetik, 'r')
-        cosmetic_lines = f.readlines()
-        f.close()
+        cosmetic_lines, unchanged = self.sp.check_cosmetic_file(self.sp.fic_cosmetik, test='unchanged')
         UnchangedLineList = []
         ChangedLines = []
         for i in range(len(cosmetic_lines)):
             line_c = cosmetic_lines[i].rstrip()
             line_num = int(self.sp.fieldStrFromLine(line_c,'num'))
-            if self.sp.cosmetic_line_unchanged(line_c):
+            if unchanged[i]:
                 UnchangedLineList.append(line_num)
             else:
                 ChangedLines.append(line_c + '\n')
@@ -2631,9 +2631,7 @@ class AppForm(QtGui.QMainWindow):
         if len(UnchangedLineList) > 0:
             ret = ShowCleanMessage(UnchangedLineList)
             if ret == True:
-                f = open(self.sp.fic_cosmetik, 'w')
-                f.writelines(ChangedLines)
-                f.close()
+                self.sp.get_line_file(self.sp.fic_cosmetik).set_lines(ChangedLines)
         else:
             msg = 'No unchanged line in the cosmetic file {:}'.format(self.sp.fic_cosmetik)
             self.statusBar().showMessage(msg, 4000) 
@@ -2733,43 +2731,44 @@ class AppForm(QtGui.QMainWindow):
                 return
 
             ret = None
-            f = open(self.sp.fic_cosmetik, 'r')
-            cosmetic_lines = f.readlines()
-            f.close()
+            cosmetic_file = self.sp.get_line_file(self.sp.fic_cosmetik)
+            cosmetic_lines, cosmetic_lines_ok = self.sp.check_cosmetic_file(self.sp.fic_cosmetik, test='ok')
             ErrorList = []
             CorrectedList = []
             UnCorList = []
             NotFound =[]
             k = self.sp.field_pos['id']
             keys = [ 'lambda', 'l_shift', 'i_rel', 'i_cor' ]
-            for i in range(len(cosmetic_lines)):
-                line_c = cosmetic_lines[i].rstrip()
-                line_num = int(self.sp.fieldStrFromLine(line_c,'num'))
-                cosmeticLineOk = self.sp.cosmetic_line_ok(line_c)
-                if cosmeticLineOk == None:
-                    NotFound.append(line_c[:k])
-                    ErrorList.append(line_c[:k])
-                elif cosmeticLineOk == False:
-                    ErrorList.append(line_c[:k])
-                    if ret != QtGui.QMessageBox.YesToAll and ret != QtGui.QMessageBox.NoToAll:
-                            ret = ShowErrorMessage()
-                    if ret == QtGui.QMessageBox.Yes or ret == QtGui.QMessageBox.YesToAll:
-                        CorrectedList.append(line_c[:k])
-                        line = self.sp.read_line(self.sp.phyat_file, line_num)
-                        line = line.rstrip()
-                        v0 = {i: np.float(self.sp.fieldStrFromLine(line, i)) for i in keys}
-                        v1 = {i: np.float(self.sp.fieldStrFromLine(line_c, i)) for i in keys}
-                        l_shift = v1['lambda'] + v1['l_shift'] - v0['lambda']
-                        i_cor =  v1['i_cor'] * v1['i_rel'] / v0['i_rel']
-                        l_shift_str = self.rightFormat(str(l_shift), 'l_shift')
-                        i_cor_str = self.rightFormat(str(i_cor), 'i_cor')
-                        line = self.sp.replace_field(line, 'l_shift', l_shift_str)
-                        line = self.sp.replace_field(line, 'i_cor', i_cor_str)
-                        log_.warn('(corrected) ' + line + '\n', calling=self.calling)
-                        self.sp.replace_line(self.sp.fic_cosmetik, line)
-                    else:
-                        UnCorList.append(line_c[:k])
-                        log_.warn('Not corrected.\n', calling=self.calling)
+            # The corrected lines are written at once at the end of the loop
+            with cosmetic_file.batch():
+                for i in range(len(cosmetic_lines)):
+                    line_c = cosmetic_lines[i].rstrip()
+                    line_num = int(self.sp.fieldStrFromLine(line_c,'num'))
+                    cosmeticLineOk = cosmetic_lines_ok[i]
+                    if cosmeticLineOk == None:
+                        NotFound.append(line_c[:k])
+                        ErrorList.append(line_c[:k])
+                    elif cosmeticLineOk == False:
+                        ErrorList.append(line_c[:k])
+                        if ret != QtGui.QMessageBox.YesToAll and ret != QtGui.QMessageBox.NoToAll:
+                                ret = ShowErrorMessage()
+                        if ret == QtGui.QMessageBox.Yes or ret == QtGui.QMessageBox.YesToAll:
+                            CorrectedList.append(line_c[:k])
+                            line = self.sp.read_line(self.sp.phyat_file, line_num)
+                            line = line.rstrip()
+                            v0 = {i: np.float(self.sp.fieldStrFromLine(line, i)) for i in keys}
+                            v1 = {i: np.float(self.sp.fieldStrFromLine(line_c, i)) for i in keys}
+                            l_shift = v1['lambda'] + v1['l_shift'] - v0['lambda']
+                            i_cor =  v1['i_cor'] * v1['i_rel'] / v0['i_rel']
+                            l_shift_str = self.rightFormat(str(l_shift), 'l_shift')
+                            i_cor_str = self.rightFormat(str(i_cor), 'i_cor')
+                            line = self.sp.replace_field(line, 'l_shift', l_shift_str)
+                            line = self.sp.replace_field(line, 'i_cor', i_cor_str)
+                            log_.warn('(corrected) ' + line + '\n', calling=self.calling)
+                            self.sp.replace_line(self.sp.fic_cosmetik, line)
+                        else:
+                            UnCorList.append(line_c[:k])
+                            log_.warn('Not corrected.\n', calling=self.calling)
             nErr = len(ErrorList)
             nCor = len(CorrectedList)
             nUnCor = len(UnCorList)
@@ -2778,11 +2777,9 @@ class AppForm(QtGui.QMainWindow):
                 answer = ShowFinalMessage(nErr, nCor, nUnCor, nNfd, UnCorList, NotFound)
 
                 if  'DelNotFnd' in answer:
-                    for i in NotFound:
-                        self.sp.remove_line(self.sp.fic_cosmetik, int(i))
+                    cosmetic_file.remove_lines([int(i) for i in NotFound])
                 if  'DelUncor' in answer:
-                    for i in UnCorList:
-                        self.sp.remove_line(self.sp.fic_cosmetik, int(i))
+                    cosmetic_file.remove_lines([int(i) for i in UnCorList])
     def set_status_text(self):
     
         if self.sp is None:
@@ -3053,10 +3050,7 @@ class AppForm(QtGui.QMainWindow):
         log_.message('Changing obj_velo. Old: {}, New: {}'.format(old_obj_velo, new_obj_velo), calling=self.calling)
         self.statusBar().showMessage('Executing doppler correction of the observed spectrum ...') 
         QtGui.QApplication.processEvents() 
-        self.sp.init_obs(obj_velo=new_obj_velo)
-        self.sp.init_red_corr()
-        self.sp.make_continuum()
-        self.sp.run(do_synth = self.sp.do_synth, do_read_liste = True, do_profiles=False)
+        self.sp.change_velo(new_obj_velo)
         self.on_draw()
 
     def ebv(self):
@@ -3072,10 +3066,7 @@ class AppForm(QtGui.QMainWindow):
         self.statusBar().showMessage('Changing color excess E(B-V) ...', 4000) 
         self.statusBar().showMessage('Executing reddening correction of the synthetic spectrum ...') 
         QtGui.QApplication.processEvents() 
-        self.sp.set_conf('e_bv', new_ebv)
-        self.sp.init_red_corr()
-        self.sp.make_continuum()
-        self.sp.run(do_synth = self.sp.do_synth, do_read_liste = False, do_profiles=False)
+        self.sp.change_ebv(new_ebv)
         self.on_draw()
         self.cont_par_changed = False
             
@@ -3207,6 +3198,7 @@ class AppForm(QtGui.QMainWindow):
         for s0 in sList:
             s = s + s0 + ', '
         s = s[:-2]
+        ion_index = self.sp.get_ion_index()
         for item in sList[:]:
             sList.remove(item)
             if item[-1] == '*':
@@ -3214,12 +3206,12 @@ class AppForm(QtGui.QMainWindow):
                 this_ion_only = False
             else:
                 this_ion_only = True                
-            if item.ljust(9) in self.sp.liste_raies['id']:                
+            if len(ion_index.sat_rows(item)) > 0:                
                 if self.sp.true_ion(item) == item or this_ion_only:
                     sList = sList + [item]
                     if not this_ion_only:
                         sList = sList + self.sp.get_all_ions_from_ion(item)
-            elif item.ljust(9) in self.sp.sp_theo['raie_ref']['id']:
+            elif len(ion_index.ref_rows(item)) > 0:
                 if self.sp.true_ion(item) == item or this_ion_only:
                     sList = sList + [item]
                     if not this_ion_only:
@@ -3602,7 +3594,7 @@ class AppForm(QtGui.QMainWindow):
         self.statusBar().showMessage('Saved to %s' % path, 4000)
     
     def save_lines_as(self):
-        file_choices = "Text files (*.txt *.dat) (*.txt *.dat);;Tex files (*.tex) (*.tex);;CSV files (*.csv) (*.csv);;All Files (*) (*)"
+        file_choices = "Text files (*.txt *.dat) (*.txt *.dat);;Tex files (*.tex) (*.tex);;CSV files (*.csv) (*.csv);;Numpy files (*.npz) (*.npz);;All Files (*) (*)"
         filename = self.sp.get_conf('line_saved_filename')
         path = unicode(QtGui.QFileDialog.getSaveFileName(self, 'Save lines to file', filename, file_choices))
         if path:
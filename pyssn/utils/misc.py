@@ -6,6 +6,8 @@ Created on 16/01/2014
 import os
 import sys
 import re
+import gzip
+import hashlib
 import argparse
 from scipy import interpolate
 import numpy as np
@@ -13,16 +15,132 @@ import pyssn
 from pyneb.utils.physics import vactoair
 from pyneb.utils.misc import roman_to_int
 
-def read_data(filename, NF=True):
-    dtype = 'i8, a1, a9, float64, float64, float64, float64, a1, i8, i4, f, a100'
+def _to_numbers(col, dtype, convert, fill):
+    """
+    Convert an array of byte strings to dtype. If some values are empty or invalid, the conversion is done
+    value by value with convert, fill being used for the values that cannot be converted.
+    """
+    try:
+        return col.astype(dtype)
+    except ValueError:
+        res = np.empty(len(col), dtype=dtype)
+        for i, val in enumerate(col):
+            try:
+                res[i] = convert(val)
+            except ValueError:
+                res[i] = fill
+        return res
+
+def read_bytes(filename):
+    """
+    Content of a file (uncompressed if its name ends with .gz) as bytes.
+    """
+    if filename.endswith('.gz'):
+        with gzip.open(filename, 'rb') as f:
+            return f.read()
+    else:
+        with open(filename, 'rb') as f:
+            return f.read()
+
+def parse_line_file(filename, NF=True, comments=True):
+    """
+    Read a file in the pySSN line format (fixed-width columns num, id, lambda, l_shift, i_rel, i_cor, 
+    ref, profile, vitesse, comment; NF=False for the short line codes) and return a structured array.
+    Same result as np.genfromtxt with the corresponding delimiters (e.g. text after # is ignored, 
+    invalid integers are -1 and invalid floats nan), but the columns are sliced from a 2D byte array and
+    converted in bulk instead of line by line.
+    """
+    return parse_line_bytes(read_bytes(filename), NF=NF, comments=comments)
+
+def line_widths(NF=True):
+    """
+    Widths of the fixed-width columns of the line files: num, blank, id, lambda, l_shift, i_rel, i_cor, blank,
+    ref, profile, vitesse, comment (NF=False for the short line codes).
+    """
     if NF:
-        delimiter = [14, 1, 9, 11, 6, 10, 7, 1, 14, 4, 7, 100]
+        return [14, 1, 9, 11, 6, 10, 7, 1, 14, 4, 7, 100]
     else:
-        delimiter = [ 9, 1, 9, 11, 6, 10, 7, 1,  9, 4, 7, 100]
+        return [ 9, 1, 9, 11, 6, 10, 7, 1,  9, 4, 7, 100]
+
+def parse_line_bytes(content, NF=True, comments=True):
+    """
+    Same as parse_line_file, from the content of the file.
+    """
+    widths = line_widths(NF)
     names = ['num', 'foo', 'id', 'lambda','l_shift', 'i_rel', 'i_cor', 'foo2', 'ref', 'profile', 
              'vitesse', 'comment']
+    dtypes = {'num': np.int64, 'id': 'S9', 'lambda': np.float64, 'l_shift': np.float64, 'i_rel': np.float64,
+              'i_cor': np.float64, 'ref': np.int64, 'profile': np.int32, 'vitesse': np.float32, 
+              'comment': 'S100'}
     usecols = (0, 2, 3, 4, 5, 6, 8, 9, 10, 11)
-    dd = np.genfromtxt(filename, dtype=dtype, delimiter=delimiter, names = names, usecols = usecols)
+    if not comments:
+        usecols = usecols[:-1]
+    n_width = sum(widths)
+    if b'\r' in content:
+        # Same comments as with the text mode of genfromtxt
+        content = content.replace(b'\r\n', b'\n')
+    raw = np.frombuffer(content, dtype=np.uint8)
+    ends = np.flatnonzero(raw == 10) + 1
+    len_lines = np.diff(np.append(0, ends))
+    if (b'#' not in content and len(content) > 0 and ends[-1] == len(content) and 
+        (len_lines == len_lines[0]).all()):
+        # All the lines have the same length: the file is used as a 2D array without copy
+        buf = raw.reshape(len(ends), len_lines[0])
+        if buf.shape[1] < n_width:
+            buf = np.hstack((buf, np.zeros((buf.shape[0], n_width - buf.shape[1]), dtype=np.uint8)))
+    else:
+        lines = content.splitlines(True)
+        if b'#' in content:
+            lines = [line.split(b'#')[0] for line in lines]
+            lines = [line for line in lines if len(line) > 0]
+        buf = np.frombuffer(np.array(lines, dtype='S{0}'.format(n_width)).tobytes(), dtype=np.uint8)
+        buf = buf.reshape(len(lines), n_width)
+    n_lines = buf.shape[0]
+    starts = np.cumsum([0] + widths)
+    # The columns are fields of a structured view of the lines, converted without copying them
+    cols = np.ascontiguousarray(buf[:, :n_width]).view({'names': [names[i] for i in usecols], 
+                                                        'formats': ['S{0}'.format(widths[i]) for i in usecols],
+                                                        'offsets': [starts[i] for i in usecols],
+                                                        'itemsize': n_width}).ravel()
+    dd = np.zeros(n_lines, dtype=[(names[i], dtypes[names[i]]) for i in usecols])
+    for i in usecols:
+        col = cols[names[i]]
+        if names[i] in ('id', 'comment'):
+            dd[names[i]] = col
+        elif dd.dtype[names[i]].kind == 'i':
+            dd[names[i]] = _to_numbers(col, np.int64, int, -1)
+        else:
+            dd[names[i]] = _to_numbers(col, np.float64, float, np.nan)
+    return dd
+
+def parse_columns_bytes(content):
+    """
+    Same array as np.loadtxt for the content of a file of columns of numbers separated by blanks (text after #
+    being ignored), but all the values are split and converted at once. Falls back to np.loadtxt
+    if the lines do not all have the same number of values or if some values are not numbers.
+    """
+    from io import BytesIO
+    if b'#' in content:
+        content = b'\n'.join(line.split(b'#')[0] for line in content.splitlines())
+    raw = np.frombuffer(content, dtype=np.uint8)
+    blank = np.isin(raw, np.frombuffer(b' \t\n\r\x0b\x0c', dtype=np.uint8))
+    # Number of values of each non-blank line, from the first character of each value
+    starts = ~blank & np.append(True, blank[:-1])
+    n_values = np.bincount(np.cumsum(raw == 10)[starts])
+    n_values = n_values[n_values > 0]
+    if len(n_values) == 0 or (n_values != n_values[0]).any():
+        return np.loadtxt(BytesIO(content))
+    try:
+        values = np.array(content.split(), dtype=np.float64)
+    except ValueError:
+        return np.loadtxt(BytesIO(content))
+    n_lines, n_cols = len(n_values), n_values[0]
+    if n_cols == 1 or n_lines == 1:
+        return values
+    return values.reshape(n_lines, n_cols)
+
+def read_data(filename, NF=True):
+    dd = parse_line_file(filename, NF=NF)
 
     if np.isnan(dd['num']).sum() > 0:
         pyssn.log_.error('Some line ID are not defined {}'.format(dd['id'][np.isnan(dd['num'])]))
@@ -37,6 +155,19 @@ def read_data(filename, NF=True):
     
     return dd.view(np.recarray)
 
+def printf_format(fmt):
+    """
+    The printf-style (%) equivalent of fmt, a str.format string with one field (e.g. '{:>14d}' -> '%14d'),
+    None if there is no simple equivalent. Used to format many values in one % operation.
+    """
+    match = re.match(r'^\{:([<>]?)(\d*(?:\.\d+)?)([sdfe])\}$', fmt)
+    if match is None:
+        return None
+    align, width, conv = match.groups()
+    if align == '<' or (align == '' and conv == 's'):
+        width = '-' + width
+    return '%' + width + conv
+
 def print_data(filename, data):
     with open(filename, 'w') as f:
         for d in data:
@@ -86,7 +217,111 @@ def rebin(tab, fact):
                          calling = 'pyssn.misc.rebin')
         return None
     return tab.reshape(len(tab)/fact, fact).sum(1) / fact
+
+def make_adaptive_grid(w, refine, fact):
+    """
+    Build a non-uniform grid from w, where only the pixels flagged in refine are split into fact sub-pixels.
+    The other pixels are kept as they are.
+    Return the new grid and the index of the first sub-pixel of each pixel of w (to be used by rebin_adaptive).
+    """
+    n = len(w)
+    edges = np.empty(n + 1)
+    edges[1:-1] = (w[1:] + w[:-1]) / 2.
+    edges[0] = w[0] - (edges[1] - w[0])
+    edges[-1] = w[-1] + (w[-1] - edges[-2])
+    n_sub = np.where(refine, int(fact), 1)
+    starts = np.zeros(n, dtype=int)
+    starts[1:] = np.cumsum(n_sub)[:-1]
+    pix = np.repeat(np.arange(n), n_sub)
+    k_sub = np.arange(len(pix)) - starts[pix]
+    w_grid = edges[pix] + (k_sub + 0.5) * (edges[pix+1] - edges[pix]) / n_sub[pix]
+    not_split = n_sub[pix] == 1
+    w_grid[not_split] = w[pix[not_split]]
+    return w_grid, starts
+
+def rebin_adaptive(tab, starts):
+    """
+    Flux-conserving resampling of tab (1D or 2D, the last axis being the wavelength) from a grid made by
+    make_adaptive_grid onto the original pixels: each pixel receives the mean of its sub-pixels.
+    """
+    n_sub = np.diff(np.append(starts, tab.shape[-1]))
+    return np.add.reduceat(tab, starts, axis=-1) / n_sub
+
+def find_rows(values, keys, order=None):
+    """
+    Return, for each element of keys, the index of the element of values equal to it, 
+    -1 if there is none and -2 if there are more than one.
+    order is values.argsort(kind='mergesort'), if already known.
+    """
+    keys = np.atleast_1d(keys)
+    if order is None:
+        order = np.argsort(values, kind='mergesort')
+    sorted_values = values[order]
+    left = np.searchsorted(sorted_values, keys, side='left')
+    right = np.searchsorted(sorted_values, keys, side='right')
+    n_found = right - left
+    rows = -np.ones(len(keys), dtype=int)
+    rows[n_found == 1] = order[left[n_found == 1]]
+    rows[n_found > 1] = -2
+    return rows
+
+def last_occurrences(rows):
+    """
+    Return the indexes of the last occurrence of each distinct value of rows, so that a fancy-indexed
+    assignment tab[rows[i]] = val[i] with them gives the same result as the sequential loop.
+    """
+    rows = np.asarray(rows)
+    i_first = np.unique(rows[::-1], return_index=True)[1]
+    return len(rows) - 1 - i_first
+
+def clipped_medians(values, bins, n_bins, clip=3., niter=3):
+    """
+    Sigma-clipped median of the values of each bin (bins being the bin of each value, 0 <= bins < n_bins), 
+    NaN for the empty bins. At each of the niter iterations, the values farther than clip sigmas from the 
+    median are removed, sigma being estimated from the median absolute deviation. All the bins are
+    processed at once, in a 2D array padded with NaN.
+    """
+    def medians(tab):
+        # The NaN are sorted at the end of the rows
+        tab = np.sort(tab, axis=1)
+        n = (~np.isnan(tab)).sum(axis=1)
+        rows = np.arange(len(tab))
+        med = 0.5 * (tab[rows, np.maximum(n - 1, 0) // 2] + tab[rows, n // 2 - (n == 0)])
+        med[n == 0] = np.nan
+        return med
     
+    counts = np.bincount(bins, minlength=n_bins)
+    if len(values) == 0:
+        return np.full(n_bins, np.nan)
+    order = np.argsort(bins, kind='mergesort')
+    sorted_bins = bins[order]
+    starts = np.cumsum(counts) - counts
+    tab = np.full((n_bins, counts.max()), np.nan)
+    tab[sorted_bins, np.arange(len(values)) - starts[sorted_bins]] = values[order]
+    with np.errstate(invalid='ignore'):
+        for i in range(niter):
+            med = medians(tab)
+            dev = np.abs(tab - med[:, np.newaxis])
+            sigma = 1.4826 * medians(dev)
+            tab[dev > clip * sigma[:, np.newaxis]] = np.nan
+    return medians(tab)
+
+def grid_hash(tab):
+    """
+    Hash of the values of the array tab, used as a key of the caches of the results computed on a grid.
+    """
+    return hashlib.sha1(np.ascontiguousarray(tab).tobytes()).hexdigest()
+
+def fork_pool(n_procs):
+    """
+    multiprocessing Pool of n_procs processes, started by fork when possible so that they inherit
+    the module variables set by the parent process.
+    """
+    import multiprocessing as mp
+    if hasattr(mp, 'get_context') and 'fork' in mp.get_all_start_methods():
+        return mp.get_context('fork').Pool(n_procs)
+    return mp.Pool(n_procs)
+
 def convol(array, kernel, method='numpy'):
     
     if method == 'same':
@@ -102,11 +337,34 @@ def convol(array, kernel, method='numpy'):
     else:
         return None
 
-def convolgauss(spectrum, w, lambda_0, fwhm):
+def convolgauss(spectrum, w, lambda_0, fwhm, adaptive=False):
     """
     Convolution with a Gaussian
+    If adaptive (w being the grid of make_adaptive_grid, whose step is not uniform), the convolution is done on
+    a uniform grid with the step of w at lambda_0, covering the pixels where the spectrum is not negligible.
     """
     
+    if adaptive and len(w) > 2:
+        pix_0 = np.clip(np.searchsorted(w, lambda_0), 1, len(w) - 1)
+        step = w[pix_0] - w[pix_0-1]
+        spec_max = np.max(np.abs(spectrum))
+        if step <= 0 or spec_max == 0:
+            return spectrum.copy()
+        not_null = np.flatnonzero(np.abs(spectrum) > 1e-9 * spec_max)
+        w_min = max(w[0], w[not_null[0]] - 3 * fwhm)
+        w_max = min(w[-1], w[not_null[-1]] + 3 * fwhm)
+        sig = fwhm / step / 2.35482
+        # Kernel down to 1e-9, the uniform grid being extended by its half-width so that it is never shorter
+        n_half = max(int(np.ceil(6.5 * sig)), 1)
+        kernel = np.exp(-0.5 * (np.arange(-n_half, n_half + 1) / sig)**2)
+        kernel = kernel / kernel.sum()
+        w_unif = w_min + step * np.arange(-n_half, int((w_max - w_min) / step) + n_half + 1)
+        cspectrum = np.zeros_like(spectrum)
+        in_unif = (w >= w_min) & (w <= w_max)
+        cspectrum[in_unif] = np.interp(w[in_unif], w_unif, 
+                                       np.convolve(np.interp(w_unif, w, spectrum, left=0., right=0.), kernel, mode='same'))
+        return cspectrum
+    
     pix_0 = np.argmin(np.abs(w - lambda_0))
     if pix_0 == 0:
         pix_0 = 1
@@ -6,7 +6,7 @@ Created on 17/01/2014
 import numpy as np
 import pickle
 import pyssn
-from pyssn.utils.misc import execution_path
+from pyssn.utils.misc import execution_path, grid_hash
 from scipy.interpolate import interp1d
 
 class CST(object):
@@ -44,38 +44,59 @@ def Planck(w, T):
     
     return res
 
+# Coefficients of Ercolano & Storey (2006), read once
+_ercolano_coeffs = None
+
+# Last continua computed by make_cont_Ercolano: {(case, T, grid hash): cont}
+_ercolano_cache = {}
+_ercolano_cache_size = 16
+
+def read_ercolano_coeffs():
+    """
+    Tables of coeff_ercolano.pickle, read at the first call. For each case (H, He1, He2): temperatures,
+    coefficients, and the sorted threshold energies (erg).
+    """
+    global _ercolano_coeffs
+    if _ercolano_coeffs is None:
+        with open(execution_path('../data/coeff_ercolano.pickle'), 'rb') as handle:
+            BE = pickle.load(handle)
+        _ercolano_coeffs = {}
+        for case, key_T, key_D in (('H', 'th', 'dh'), ('He1', 'the1', 'dhe1'), ('He2', 'the2', 'dhe2')):
+            D = BE[key_D]
+            BE_E_erg = D[:,1] * CST.RYD_erg
+            _ercolano_coeffs[case] = {'tab_T': 10**BE[key_T], 'D': D, 'BE_E_erg': BE_E_erg,
+                                      'BE_E_Thr': np.sort(BE_E_erg[D[:,0] == 1])}
+    return _ercolano_coeffs
+
 def make_cont_Ercolano(T_in, case, lam):
     """
     Adapted from http://adsabs.harvard.edu/abs/2006MNRAS.372.1875E
+    The results are kept for the last (case, T_in, lam) used.
     """
-    n_lam = len(lam)
-    hnu =  CST.CLIGHT * 1e8 / lam * CST.HPLANCK  #!phy.c_ang_sec/lam*!phy.h
-    with open(execution_path('../data/coeff_ercolano.pickle'), 'rb') as handle:
-        BE = pickle.load(handle)
+    lam = np.asarray(lam, dtype=float)
+    key = (case, float(T_in), grid_hash(lam))
+    if key in _ercolano_cache:
+        return _ercolano_cache[key].copy()
     
-    if case == 'H':
-        tab_T = 10**BE['th']
-        D = BE['dh']
-    elif case == 'He1':
-        tab_T = 10**BE['the1']
-        D = BE['dhe1']
-    elif case == 'He2':
-        tab_T = 10**BE['the2']
-        D = BE['dhe2']
-    else:
+    hnu =  CST.CLIGHT * 1e8 / lam * CST.HPLANCK  #!phy.c_ang_sec/lam*!phy.h
+    BE = read_ercolano_coeffs()
+    if case not in BE:
         pyssn.log_.error('Invalid case {0}'.format(case), calling='make_cont_Ercolano')
         return None
+    tab_T = BE[case]['tab_T']
+    D = BE[case]['D']
     if (T_in < np.min(tab_T)) or (T_in > np.max(tab_T)):
         pyssn.log_.error('Invalid temperature {0}'.format(T_in), calling='make_cont_Ercolano')
         return None
     
-    BE_E_Ry = D[:,1]
-    BE_E_erg = BE_E_Ry * CST.RYD_erg
-    BE_E_Thr = BE_E_erg[D[:,0] == 1]
-    Delta_E = np.zeros(n_lam)
-    for i in np.arange(n_lam):
-        DE = hnu[i] - BE_E_Thr
-        Delta_E[i] = np.min(DE[DE > 0])
+    BE_E_erg = BE[case]['BE_E_erg']
+    BE_E_Thr = BE[case]['BE_E_Thr']
+    # Distance to the closest threshold below hnu
+    i_thr = np.searchsorted(BE_E_Thr, hnu, side='left') - 1
+    if np.any(i_thr < 0):
+        pyssn.log_.error('Energies below the first threshold', calling='make_cont_Ercolano')
+        return None
+    Delta_E = hnu - BE_E_Thr[i_thr]
         
     n_T_sup = np.min(np.where(tab_T >= T_in)[0])
     n_T_inf = n_T_sup - 1
@@ -93,13 +114,25 @@ def make_cont_Ercolano(T_in, case, lam):
     coeff = coeff_sup * C_interp + coeff_inf*(1. - C_interp)
     
     cont = coeff * 1e-34 * T_in**(-1.5) * np.exp(-Delta_E / T_in / CST.BOLTZMANN) / lam**2. * CST.CLIGHT * 1e8 # erg/s.cm3/A
-    return cont
+    if len(_ercolano_cache) >= _ercolano_cache_size:
+        _ercolano_cache.clear()
+    _ercolano_cache[key] = cont
+    return cont.copy()
 
 
+# Last Gaunt factors computed by gff: {(Z, T, grid hash): G}
+_gff_cache = {}
+_gff_cache_size = 16
+
 def gff(Z, T, lam):
     """
      Adaptated from http://adsabs.harvard.edu/abs/1991CoPhC..66..129S
+     The results are kept for the last (Z, T, lam) used.
     """
+    lam = np.asarray(lam, dtype=float)
+    key = (float(Z), float(T), grid_hash(lam))
+    if key in _gff_cache:
+        return _gff_cache[key].copy()
     D= np.array([8.986940175e+00, -4.009515855e+00,  8.808871266e-01,
         2.640245111e-02, -4.580645915e-02, -3.568055702e-03,   
         2.827798067e-03,  3.365860195e-04, -8.006936989e-01,
@@ -134,8 +167,6 @@ def gff(Z, T, lam):
 
 
     XLF = np.log10(CST.CLIGHT * 1e8 / lam)
-    N_lam = len(lam)
-    G = np.zeros(N_lam)
     D = D.reshape(11, 8)
     B = np.zeros(11)
     C = np.zeros(8)
@@ -153,15 +184,19 @@ def gff(Z, T, lam):
 
     CON=0.72727273 * XLRKT - 10.376127  
 
-    for i in np.arange(N_lam):
-        TXU = 0.72727273 * XLF[i] + CON 
-        B[7] = C[7]
-        B[6] = TXU * B[7] + C[6] 
-        for IR in np.arange(5)[::-1]: 
-            B[IR] = TXU * B[IR+1] - B[IR+2] + C[IR]
-        G[i] = B[0] - B[2]
-
-    return G
+    # Clenshaw recurrence on all the wavelengths at once (B[5] keeps the value left by the loop above)
+    TXU = 0.72727273 * XLF + CON 
+    B = list(B)
+    B[7] = C[7]
+    B[6] = TXU * B[7] + C[6] 
+    for IR in np.arange(5)[::-1]: 
+        B[IR] = TXU * B[IR+1] - B[IR+2] + C[IR]
+    G = B[0] - B[2]
+
+    if len(_gff_cache) >= _gff_cache_size:
+        _gff_cache.clear()
+    _gff_cache[key] = G
+    return G.copy()
 
 def make_ion_frac(N, co=None):
 
@@ -0,0 +1,80 @@
+"""
+Small synthetic data sets (atomic data, model, observations) used by the tests.
+"""
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('pyneb')
+
+# Lines of the atomic database: (code, id, lambda, i_rel, reference line)
+PHYAT_LINES = [(90101000000000, 'H_I', 1.0, 1.0, 999),
+               (101000000001, 'H_I', 4861.33, 1.0, 101000000000),
+               (101000000002, 'H_I', 4340.47, 0.47, 101000000000),
+               (101000000003, 'H_I', 4101.74, 0.26, 101000000000),
+               (101000000004, 'H_I', 6562.80, 2.86, 101000000000),
+               (90803000000000, 'O_III', 1.0, 1.0, 999),
+               (803000000001, 'O_III', 5006.84, 1.0, 803000000000),
+               (803000000002, 'O_III', 4958.91, 0.335, 803000000000),
+               (803000000003, 'O_III', 4363.21, 0.01, 803000000000),
+               (803000000004, 'O_III', 5007.10, 0.2, 803000000000)]
+
+MODEL_LINES = [(101000000000, 'H_I', 1.0, 1.0e4, 999),
+               (803000000000, 'O_III', 1.0, 3.0e4, 999)]
+
+def format_line(num, id_, lam, i_rel, ref, vitesse=1.0, comment='', l_shift=0., i_cor=1.):
+    return '{0:>14d} {1:<9s}{2:>11.3f}{3:>6.3f}{4:>10.3e}{5:>7.3f} {6:>14d}{7:>4d}{8:>7.3f} {9}\n'.format(
+        num, id_, lam, l_shift, i_rel, i_cor, ref, 1, vitesse, comment)
+
+def write_lines(filename, lines, vitesse=1.0):
+    with open(filename, 'w') as f:
+        for num, id_, lam, i_rel, ref in lines:
+            f.write(format_line(num, id_, lam, i_rel, ref, vitesse=vitesse, comment=id_.replace('_', ' ')))
+
+def write_obs(filename, w1, w2, dw, lines=((4861.33, 1e3), (5006.84, 3e3), (6562.8, 3e3))):
+    w = np.arange(w1, w2, dw)
+    f = 10. + 1e-3 * (w - w1)
+    for lam, intens in lines:
+        f += intens / (np.sqrt(2 * np.pi) * 1.) * np.exp(-0.5 * ((w - lam) / 1.)**2)
+    np.savetxt(filename, np.array([w, f]).T)
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """
+    Directory holding liste_phyat.dat, liste_modele.dat, the observations obs.spr (4000-6700),
+    obs_b.spr (4000-5200) and obs_r.spr (5200-6700), and an init.py using them. The tests run in it.
+    """
+    write_lines(str(tmp_path / 'liste_phyat.dat'), PHYAT_LINES)
+    write_lines(str(tmp_path / 'liste_modele.dat'), MODEL_LINES, vitesse=20.)
+    write_obs(str(tmp_path / 'obs.spr'), 4000., 6700., 0.5)
+    write_obs(str(tmp_path / 'obs_b.spr'), 4000., 5200., 0.25)
+    write_obs(str(tmp_path / 'obs_r.spr'), 5200., 6700., 0.5)
+    with open(str(tmp_path / 'init.py'), 'w') as f:
+        f.write("spectr_obs = 'obs'\n"
+                "phyat_file = 'liste_phyat.dat'\n"
+                "fic_modele = 'liste_modele.dat'\n"
+                "fic_cosmetik = None\n"
+                "do_cosmetik = False\n"
+                "limit_sp = [4000., 6700.]\n"
+                "e_bv = 0.1\n"
+                "log_level = 1\n")
+    monkeypatch.chdir(str(tmp_path))
+    return tmp_path
+
+def add_conf(data_dir, text):
+    with open(str(data_dir / 'init.py'), 'a') as f:
+        f.write(text)
+
+@pytest.fixture
+def use_mp():
+    """
+    Multiprocessing enabled (with 2 processes) during the test.
+    """
+    from pyssn import config
+    if not (config.INSTALLED['mp'] and hasattr(os, 'fork')):
+        pytest.skip('processes cannot be forked')
+    use, n_procs = config._use_mp, config.Nprocs
+    config.use_multiprocs()
+    config.Nprocs = 2
+    yield config
+    config._use_mp, config.Nprocs = use, n_procs
@@ -0,0 +1,48 @@
+import os
+import numpy as np
+import pytest
+from pyssn import config
+from pyssn.core.spectrum import spectrum
+from pyssn.core.cube import SpectrumCube
+from conftest import add_conf, format_line
+
+fits = pytest.importorskip('astropy.io.fits')
+
+def write_cube(filename, ny=2, nx=3):
+    w, f = np.loadtxt('obs.spr', unpack=True)
+    cube = np.repeat(f[:, np.newaxis, np.newaxis], ny * nx, axis=1).reshape(len(w), ny, nx)
+    hdu = fits.PrimaryHDU(cube)
+    hdu.header['CRVAL3'] = w[0]
+    hdu.header['CRPIX3'] = 1.
+    hdu.header['CDELT3'] = w[1] - w[0]
+    hdu.writeto(filename)
+
+@pytest.mark.parametrize('mode,e_bv', [('serial', 0.), ('fork', 0.), ('no_fork', 0.), ('serial', 0.3)])
+def test_cube_spaxel(data_dir, monkeypatch, mode, e_bv):
+    # The automatic continuum is not used for the bases
+    add_conf(data_dir, "e_bv = {0}\ncont_auto = True\n".format(e_bv))
+    # Line not corrected for reddening, sharing its reference line with lines corrected for it
+    with open('liste_phyat.dat', 'a') as f:
+        f.write(format_line(9701010000005, 'H_I', 5500., 0.3, 101000000000, comment='H I'))
+    write_cube('cube.fits')
+    sp = spectrum(config_file='init.py')
+    cube = SpectrumCube(sp, 'cube.fits', fit=False, e_bv=e_bv)
+    if mode != 'serial':
+        config.use_multiprocs()
+    if mode == 'no_fork':
+        # Platforms starting the processes by spawn: the spaxels are evaluated in this process
+        monkeypatch.delattr(os, 'fork', raising=False)
+    try:
+        cube.run()
+    finally:
+        config.unuse_multiprocs()
+    with open('init.py') as f:
+        conf = f.read()
+    with open('init_direct.py', 'w') as f:
+        f.write(conf + "cont_auto = False\n")
+    sp_direct = spectrum(config_file='init_direct.py')
+    i = np.searchsorted(sp_direct.w_ori, cube.w)
+    assert np.allclose(sp_direct.w_ori[i], cube.w)
+    for y, x in ((0, 0), (1, 2)):
+        np.testing.assert_allclose(cube.synth[:, y, x], sp_direct.sp_synth_lr[i], rtol=1e-10, atol=1e-10)
+    cube.close()
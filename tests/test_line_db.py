@@ -0,0 +1,76 @@
+import os
+import sqlite3
+import numpy as np
+from pyssn.core.spectrum import spectrum
+from pyssn.core.line_db import LineDB
+from pyssn.utils.misc import parse_line_file
+from conftest import PHYAT_LINES, add_conf, format_line
+
+def test_export(tmp_path):
+    lines = [format_line(*line, comment=line[1]) for line in PHYAT_LINES]
+    lines.insert(2, '# comment\n')
+    filename = str(tmp_path / 'liste_phyat.dat')
+    db = LineDB(str(tmp_path / 'lines.db'))
+    # LF and CRLF ends of line, with and without end of line at the end of the file
+    for content in (''.join(lines), ''.join(lines).rstrip('\n'), ''.join(lines).replace('\n', '\r\n')):
+        with open(filename, 'wb') as f:
+            f.write(content.encode('ascii'))
+        db.import_file(filename)
+        out_filename = str(tmp_path / 'export.dat')
+        db.export(filename, out_filename)
+        with open(out_filename, 'rb') as f:
+            assert f.read() == content.encode('ascii')
+    # Line changed in the database only, then written back to the file
+    content = ''.join(lines)
+    with open(filename, 'w') as f:
+        f.write(content)
+    new_lines = [format_line(803000000002, 'O_III', 4958.91, 0.335, 803000000000, i_cor=2.),
+                 format_line(803000000005, 'O_III', 2321.66, 0.01, 803000000000)]
+    db.replace_line(filename, new_lines[0].rstrip('\n'), file_written=False)
+    db.export(filename)
+    content = content.replace(lines[8], new_lines[0])
+    with open(filename, 'r') as f:
+        assert f.read() == content
+    # Line appended to the file, which is imported again
+    with open(filename, 'a') as f:
+        f.write(new_lines[1])
+    db.replace_line(filename, new_lines[1].rstrip('\n'), file_written=False)
+    db.export(filename, out_filename)
+    with open(out_filename, 'r') as f:
+        assert f.read() == content + new_lines[1]
+
+def test_queries(tmp_path):
+    filename = str(tmp_path / 'liste_phyat.dat')
+    with open(filename, 'w') as f:
+        f.writelines(format_line(*line, l_shift=0.5 * (i % 3), comment=line[1]) for i, line in enumerate(PHYAT_LINES))
+    dd = parse_line_file(filename)
+    db = LineDB(str(tmp_path / 'lines.db'))
+    for w1, w2 in ((4000., 5000.), (4959., 5007.), (0., 1e4)):
+        wl = dd['lambda'] + dd['l_shift']
+        np.testing.assert_array_equal(db.lines_in(filename, w1, w2), dd[(wl > w1) & (wl < w2)])
+    for ion in ('H_I', 'O_III ', 'Ne_III'):
+        np.testing.assert_array_equal(db.lines_of_ion(filename, ion), dd[np.char.strip(dd['id']) == ion.strip().encode()])
+    plans = [row[-1] for row in db.conn.execute('EXPLAIN QUERY PLAN SELECT num FROM lines WHERE file_id = 1 AND '
+                                                'lambda + l_shift > 4000. AND lambda + l_shift < 5000.')]
+    assert any('lines_l_tot' in plan for plan in plans)
+    plans = [row[-1] for row in db.conn.execute('EXPLAIN QUERY PLAN SELECT num FROM lines WHERE file_id = 1 AND num = 1')]
+    assert any('lines_num' in plan for plan in plans)
+
+def test_nearby_lines_line_info(data_dir, capsys):
+    add_conf(data_dir, "lambda_shift = 0.3\n")
+    sp = spectrum(config_file='init.py')
+    add_conf(data_dir, "line_db = 'lines.db'\n")
+    sp_db = spectrum(config_file='init.py')
+    outputs = []
+    for s in (sp, sp_db):
+        # Lines printed (print_line formats the ids as str)
+        s.print_line = lambda line, sort='lambda', reverse=False: print(np.atleast_1d(line)['num'].tolist(), sort)
+        nearby = [s.get_nearby_lines(w1, w2) for w1, w2 in ((4000., 5000.), (4958., 5008.), (5006.6, 5007.5))]
+        s.line_info(803000000000)
+        s.line_info(101000000002)
+        outputs.append((nearby, capsys.readouterr().out))
+    for nearby, nearby_db in zip(outputs[0][0], outputs[1][0]):
+        np.testing.assert_array_equal(nearby, nearby_db)
+    assert outputs[0][1] == outputs[1][1]
+    assert 'satellites' in outputs[0][1]
+    assert sp_db.line_db.synth_arr is sp_db.liste_raies
@@ -0,0 +1,128 @@
+import os
+import shutil
+from pyssn.core.spectrum import spectrum
+from conftest import format_line
+
+# Text helpers of spectrum before LineFile
+def read_line_loop(self, filename, line_num):
+    line = None
+    line_num_str = str(line_num)
+    k = len(line_num_str)
+    if not os.path.isfile(filename):
+        return None
+    else:
+        with open(filename, 'r') as f:
+            line = None
+            for eachline in f:
+                s = self.fieldStrFromLine(eachline,'num')
+                s = str(int(s))
+                if (int(s) == line_num) or (s[:k] == line_num_str and s[k:].strip('0') == ''):
+                    line = eachline
+                    break
+    return line
+
+def read_satellites_loop(self, filename, refline_num):
+    with open(filename, 'r') as f:
+        satellites = []
+        for eachline in f:
+            if int(self.fieldStrFromLine(eachline,'ref')) == refline_num:
+                satellites.append(eachline)
+    return satellites
+
+def remove_line_loop(self, filename, line_num):
+    line = read_line_loop(self, filename, line_num)
+    if line == None:
+        return False
+    if not os.path.isfile(filename):
+        return False
+    else:
+        f = open(filename, 'r')
+        lines = f.readlines()
+        f.close()
+        i = lines.index(line)
+        if i >= 0:
+            del lines[i]
+            with open(filename, 'w') as f:
+                f.writelines(lines)
+            return True
+        else:
+            return False        
+
+def replace_line_loop(self, filename, line):
+    line_num = int(self.fieldStrFromLine(line,'num'))
+    if os.path.isfile(filename):
+        lineNotFound = True
+        with open(filename, 'r') as f:
+            lines = f.read().splitlines()
+            for i in range(0, len(lines)):
+                curr_line = lines[i]
+                if int(self.fieldStrFromLine(curr_line,'num')) == line_num:
+                    lines[i] = line + '\n'
+                    lineNotFound = False
+                else:
+                    lines[i] = lines[i] + '\n'
+        if lineNotFound:    
+            lines.append(line)
+    else:
+        lines = [line]                
+    with open(filename, 'w') as f:
+        f.writelines(lines)
+
+def read(filename):
+    with open(filename, 'r') as f:
+        return f.read()
+
+def end_of_line(filename):
+    # The line appended by replace_line_loop had no end of line, LineFile writes it with one
+    content = read(filename)
+    if not content.endswith('\n'):
+        with open(filename, 'a') as f:
+            f.write('\n')
+
+# Lines as given by the line editor of the GUI (without their ends of line)
+LINES = [format_line(803000000002, 'O_III', 4958.91, 0.335, 803000000000, i_cor=2.).rstrip(),
+         format_line(101000000003, 'H_I', 4101.74, 0.26, 101000000000, l_shift=0.5).rstrip(),
+         format_line(803000000005, 'O_III', 2321.66, 0.01, 803000000000).rstrip(),
+         format_line(803000000003, 'O_III', 4363.21, 0.01, 101000000000).rstrip()]
+
+def test_line_file_edits(data_dir):
+    sp = spectrum(config_file='init.py')
+    # 101000000003 defined twice
+    with open('liste_phyat.dat', 'a') as f:
+        f.write(format_line(101000000003, 'H_I', 4101.74, 0.26, 101000000000))
+    shutil.copy('liste_phyat.dat', 'liste_loop.dat')
+    filename = os.path.abspath('liste_phyat.dat')
+    
+    def check():
+        end_of_line('liste_loop.dat')
+        assert read(filename) == read('liste_loop.dat')
+        for num in (90101, 90803000000000, 101000000003, 803000000003, 803000000005, 803000000009):
+            assert sp.read_line(filename, num) == read_line_loop(sp, 'liste_loop.dat', num)
+        for ref in (999, 101000000000, 803000000000):
+            assert sp.read_satellites(filename, ref) == read_satellites_loop(sp, 'liste_loop.dat', ref)
+
+    check()
+    # Replaced lines (one of them twice in the file), appended line, change of reference line
+    for line in LINES:
+        sp.replace_line(filename, line)
+        replace_line_loop(sp, 'liste_loop.dat', line)
+        check()
+    # Removal by reduced code, of a line defined twice, of an undefined line
+    for num in (90101, 101000000003, 803000000009, 803000000005):
+        assert sp.remove_line(filename, num) == remove_line_loop(sp, 'liste_loop.dat', num)
+        check()
+    # Batch of edits written at once
+    line_file = sp.get_line_file(filename)
+    with line_file.batch():
+        sp.replace_line(filename, LINES[1])
+        assert line_file.remove_lines([90803, 803000000001, 803000000009]) == 2
+    replace_line_loop(sp, 'liste_loop.dat', LINES[1])
+    for num in (90803, 803000000001):
+        remove_line_loop(sp, 'liste_loop.dat', num)
+    check()
+    # The file is read again when it is changed by another program
+    replace_line_loop(sp, 'liste_loop.dat', LINES[2])
+    end_of_line('liste_loop.dat')
+    shutil.copy('liste_loop.dat', filename)
+    os.utime(filename, (0, 0))
+    check()
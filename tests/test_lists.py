@@ -0,0 +1,160 @@
+"""
+Line lists: the vectorized functions are compared with the loops they replaced.
+"""
+import numpy as np
+from pyssn.core.spectrum import spectrum
+
+DTYPE = [('num', '<i8'), ('id', 'S9'), ('lambda', '<f8'), ('l_shift', '<f8'), ('i_rel', '<f8'), ('i_cor', '<f8'),
+         ('ref', '<i8'), ('profile', '<i4'), ('vitesse', '<f4'), ('comment', 'S100')]
+
+def make_list(rows):
+    """
+    Line list from the rows (num, lambda, l_shift, i_rel, i_cor, ref, profile, vitesse).
+    """
+    liste = np.zeros(len(rows), dtype=DTYPE).view(np.recarray)
+    for i, (num, lam, l_shift, i_rel, i_cor, ref, profile, vitesse) in enumerate(rows):
+        liste[i] = (num, b'X', lam, l_shift, i_rel, i_cor, ref, profile, vitesse, b'line')
+    return liste
+
+def restric_liste_loop(self, liste_in):
+    # restric_liste before resolve_refs (the reference line taken as a record, for recent numpy)
+    while True:
+        the_end = True
+        non_affich = np.where(liste_in['ref'] == 999)[0]
+        for i_999 in non_affich:
+            this_num = liste_in['num'][i_999]
+            dep_non_affich = ((liste_in['ref'] == this_num) & (liste_in['ref'] != 999))
+            if dep_non_affich.sum() != 0:
+                liste_in['ref'][dep_non_affich] = 999
+                the_end = False
+        if the_end:
+            break
+    where_restr = (((liste_in['lambda'] + liste_in['l_shift']) < np.max(self.w)) & 
+                   ((liste_in['lambda'] + liste_in['l_shift']) > np.min(self.w)) &
+                   (liste_in['ref'] != 999))
+    liste_out = liste_in.copy()[where_restr]
+    last_loop = 0
+    the_end = False
+    while True:
+        if last_loop == 1:
+            the_end = True
+        satellites = np.where(liste_out['ref'] != 0)[0]
+        for i_satellite in satellites[::-1]:
+            if liste_out['ref'][i_satellite] != -1:
+                raie_synth = liste_out[i_satellite].copy()
+                i_main_line = np.where(liste_in['num'] == raie_synth['ref'])[0]
+                if len(i_main_line) != 1:
+                    raie_synth['i_rel'] = 0.0
+                else:
+                    main_line = liste_in[i_main_line[0]]
+                    if main_line['ref'] != 0:
+                        raie_synth['i_rel'] *= main_line['i_rel']
+                        raie_synth['ref'] = main_line['ref']
+                        if bool(self.conf['recursive_i_cor']):
+                            raie_synth['i_cor'] *= main_line['i_cor']
+                        raie_synth['profile'] = main_line['profile']
+                        last_loop = 2
+                    if last_loop == 1:
+                        raie_synth['i_rel'] *= main_line['i_rel']
+                        raie_synth['vitesse'] *= main_line['vitesse']
+                        raie_synth['l_shift'] += main_line['l_shift']
+                        if bool(self.conf['recursive_i_cor']):
+                            raie_synth['i_cor'] *= main_line['i_cor']
+                        raie_synth['profile'] = main_line['profile']
+                liste_out[i_satellite] = raie_synth
+        if last_loop == 0:
+            last_loop = 1
+        else:
+            last_loop = 0
+        if the_end:
+            break
+    tt = (np.abs(liste_out['i_rel']) > 1e-50)
+    return liste_out[tt]
+
+# Reference lines A (101000000000) and B (803000000000); chain of sub-references S1 <- S2 <- S3 on A;
+# satellite of a missing line; line hidden by a 999 master; line which is not a satellite (ref = -1)
+CHAINS = [(101000000000, 1., 0.5, 1e4, 2., 0, 2, 20.),
+          (803000000000, 1., 0., 3e4, 1., 0, 1, 15.),
+          (101000000010, 1., 0., 2., 1.5, 101000000000, 3, 1.),
+          (101000000011, 5000., 0.1, 0.5, 1.2, 101000000010, 1, 1.),
+          (101000000012, 5100., 0., 0.25, 1., 101000000011, 1, 2.),
+          (101000000013, 5200., 0., 0.7, 1., 101000000010, 1, 1.),
+          (803000000001, 5006.84, 0., 1., 1., 803000000000, 1, 1.),
+          (803000000002, 4958.91, 0., 0.3, 1., 101000000099, 1, 1.),
+          (90808000000000, 1., 0., 1., 1., 999, 1, 1.),
+          (808000000001, 6300., 0., 1., 1., 90808000000000, 1, 1.),
+          (808000000002, 6364., 0., 1., 1., 808000000001, 1, 1.),
+          (999000000001, 6000., 0., 5., 1., -1, 1, 1.)]
+
+def test_restric_liste_chains(data_dir):
+    sp = spectrum(config_file='init.py')
+    liste = sp.restric_liste(make_list(CHAINS))
+    liste_loop = restric_liste_loop(sp, make_list(CHAINS))
+    for key in ('num', 'lambda', 'l_shift', 'i_rel', 'i_cor', 'profile', 'vitesse'):
+        np.testing.assert_array_equal(liste[key], liste_loop[key], err_msg=key)
+    # The missing reference and the hidden lines are removed
+    assert 803000000002 not in liste['num'] and 808000000001 not in liste['num']
+    i_s3 = np.flatnonzero(liste['num'] == 101000000012)[0]
+    assert liste['i_rel'][i_s3] == 0.25 * 0.5 * 2. * 1e4 and liste['ref'][i_s3] == 101000000000
+
+def test_restric_liste_cycle(data_dir):
+    # The loop never ended on a cycle: it is dropped, the other lines being unchanged
+    sp = spectrum(config_file='init.py')
+    cycle = [(102000000001, 5500., 0., 1., 1., 102000000002, 1, 1.),
+             (102000000002, 5600., 0., 1., 1., 102000000001, 1, 1.)]
+    liste = sp.restric_liste(make_list(CHAINS + cycle))
+    assert not np.isin([102000000001, 102000000002], liste['num']).any()
+    np.testing.assert_array_equal(liste['i_rel'], sp.restric_liste(make_list(CHAINS))['i_rel'])
+
+def append_lists_loop(self, phyat_arr, model_arr, cosmetik_arr):
+    # Cosmetics of append_lists before match_cosmetik
+    liste_totale = np.concatenate((phyat_arr, model_arr)).view(np.recarray)
+    for line_cosmetik in cosmetik_arr:
+        if not ((line_cosmetik['ref'] == 0) and not bool(self.conf['do_icor_on_ref'])):
+            to_change = (liste_totale.num == line_cosmetik['num'])
+            if to_change.sum() == 1:
+                line_to_change = liste_totale[to_change][0]
+                if (line_to_change['lambda'] == line_cosmetik['lambda']) or (line_cosmetik['l_shift'] == 0.):
+                    line_to_change['l_shift'] = line_cosmetik['l_shift']
+                if (line_to_change['i_rel'] == line_cosmetik['i_rel']) or (line_cosmetik['i_cor'] == 1.):
+                    line_to_change['i_cor'] = line_cosmetik['i_cor']
+                liste_totale[to_change] = line_to_change
+    liste_raies = self.restric_liste(liste_totale)
+    for line_cosmetik in cosmetik_arr:
+        if bool(self.conf['do_icor_on_ref']):
+            to_change = (liste_raies.num == line_cosmetik['num'])
+            if to_change.sum() == 1:
+                line_to_change = liste_raies[to_change][0]
+                line_to_change['vitesse'] *= line_cosmetik['vitesse']
+                if line_cosmetik['profile'] != -1:
+                    line_to_change['profile'] = line_cosmetik['profile']
+                liste_raies[to_change] = line_to_change
+    return liste_totale, liste_raies
+
+# Repeated cosmetics (the last one wins, the vitesse factors are multiplied), cosmetics not applied
+# (lambda or i_rel different from the line), undefined line, line defined twice and reference line
+COSMETIK = [(803000000001, 5006.84, 0.3, 1., 1.5, 803000000000, -1, 2.),
+            (803000000001, 5006.84, 0.1, 1., 2., 803000000000, 3, 1.5),
+            (803000000002, 4950., 0.5, 0.9, 3., 803000000000, 2, 1.),
+            (803000000003, 4363.21, 0., 0.5, 1., 803000000000, -1, 1.),
+            (999000000099, 5000., 0., 1., 2., 803000000000, -1, 1.),
+            (101000000003, 4101.74, 0.2, 0.26, 2., 101000000000, -1, 1.),
+            (803000000000, 1., 0., 3e4, 2., 0, -1, 3.)]
+
+def test_cosmetik(data_dir):
+    sp = spectrum(config_file='init.py')
+    # 101000000003 defined twice
+    phyat_arr = np.concatenate((sp.phyat_arr, sp.phyat_arr[sp.phyat_arr['num'] == 101000000003])).view(np.recarray)
+    for do_icor_on_ref in (True, False):
+        sp.conf['do_icor_on_ref'] = do_icor_on_ref
+        sp.do_cosmetik = True
+        sp_theo, liste_totale, liste_raies = sp.append_lists(phyat_arr.copy(), sp.model_arr.copy(), 
+                                                             make_list(COSMETIK))
+        liste_totale_loop, liste_raies_loop = append_lists_loop(sp, phyat_arr.copy(), sp.model_arr.copy(), 
+                                                                make_list(COSMETIK))
+        for key in ('num', 'l_shift', 'i_rel', 'i_cor', 'profile', 'vitesse'):
+            np.testing.assert_array_equal(liste_totale[key], liste_totale_loop[key], err_msg=key)
+            np.testing.assert_array_equal(liste_raies[key], liste_raies_loop[key], err_msg=key)
+        assert list(sp.cosmetik_report['undefined']) == [999000000099]
+        assert list(sp.cosmetik_report['multiple']) == [101000000003]
+        assert list(sp.cosmetik_report['repeated']) == [803000000001]
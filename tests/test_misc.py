@@ -0,0 +1,39 @@
+import numpy as np
+from pyssn.utils import misc
+
+def convolgauss_ref(spectrum, w, lambda_0, fwhm):
+    # convolgauss before the adaptive grid
+    pix_0 = np.argmin(np.abs(w - lambda_0))
+    if pix_0 == 0:
+        pix_0 = 1
+    if pix_0 == len(w)-1:
+        pix_0 = len(w)-2
+    lam_pix = np.abs(w[pix_0-1] - w[pix_0+1]) / 2.
+    sig = fwhm / lam_pix / 2.35482
+    nres = 21
+    while True:
+        nres = nres * 2 + 1
+        wkernel = np.arange(nres) - nres / 2
+        kernel = np.exp(-(wkernel / (np.sqrt(2.) * sig))**2)
+        if (np.min(kernel) < 1e-9) or ((nres * 2 - 3) > len(w)):
+            break
+    return misc.convol(spectrum, kernel / kernel.sum())
+
+def gauss_line(w, lambda_0, sigma):
+    return np.exp(-0.5 * ((w - lambda_0) / sigma)**2)
+
+def test_convolgauss_log_grid():
+    # Log-linear grid (e.g. FITS WAVE-LOG): the step varies, the grid is not adaptive
+    w = 4000. * np.exp(np.arange(4000) * 1e-5)
+    spectrum = gauss_line(w, 4500., 0.3)
+    np.testing.assert_array_equal(misc.convolgauss(spectrum, w, 4500., 0.5), convolgauss_ref(spectrum, w, 4500., 0.5))
+
+def test_convolgauss_adaptive():
+    w = np.arange(4000., 6000., 1.)
+    w_synth, starts = misc.make_adaptive_grid(w, (w > 4990) & (w < 5010), 10)
+    w_fine = np.arange(4000., 6000., 0.1)
+    for fwhm in (0.05, 0.3, 2., 20.):
+        c_fine = misc.convolgauss(gauss_line(w_fine, 5000., 0.3), w_fine, 5000., fwhm)
+        c_adapt = misc.convolgauss(gauss_line(w_synth, 5000., 0.3), w_synth, 5000., fwhm, adaptive=True)
+        assert len(c_adapt) == len(w_synth)
+        np.testing.assert_allclose(np.trapz(c_adapt, w_synth), np.trapz(c_fine, w_fine), rtol=1e-3)
@@ -0,0 +1,32 @@
+import os
+import shutil
+import pytest
+from pyssn.phyat_lists import manage_phyat_list
+
+ATOMS = ['O3', 'N2', 'Ne3', 'S2']
+
+def make_list(tmp_path, name, n_procs):
+    out_dir = tmp_path / name
+    out_dir.mkdir()
+    shutil.copy(os.path.join(os.path.dirname(manage_phyat_list.__file__), 'phy_cond.dat'), str(out_dir))
+    cwd = os.getcwd()
+    os.chdir(str(out_dir))
+    try:
+        manage_phyat_list.make_phyat_list('liste_phyat.dat', atoms=ATOMS, n_procs=n_procs)
+    finally:
+        os.chdir(cwd)
+    # Without the first lines of log.dat and help.dat, which hold the time of writing
+    return dict((f, (out_dir / f).read_text().split('\n', f != 'liste_phyat.dat')[-1]) 
+                for f in ('liste_phyat.dat', 'log.dat', 'help.dat'))
+
+@pytest.mark.parametrize('fork', [True, False])
+def test_phyat_list_n_procs(tmp_path, monkeypatch, fork):
+    serial = make_list(tmp_path, 'serial', 1)
+    assert len(serial['liste_phyat.dat'].splitlines()) > len(ATOMS)
+    if not fork:
+        # Platforms starting the processes by spawn: the atoms are done in this process
+        monkeypatch.delattr(os, 'fork', raising=False)
+    elif not hasattr(os, 'fork'):
+        pytest.skip('processes cannot be forked')
+    assert make_list(tmp_path, 'parallel', 3) == serial
+    assert manage_phyat_list._phyat_conf is None
@@ -0,0 +1,109 @@
+import os
+import pickle
+import numpy as np
+import pytest
+from pyssn.utils import physics
+from pyssn.utils.physics import CST
+
+def make_cont_Ercolano_loop(T_in, case, lam):
+    # make_cont_Ercolano before the vectorization
+    n_lam = len(lam)
+    hnu =  CST.CLIGHT * 1e8 / lam * CST.HPLANCK
+    with open(os.path.join(os.path.dirname(physics.__file__), '../data/coeff_ercolano.pickle'), 'rb') as handle:
+        BE = pickle.load(handle)
+    if case == 'H':
+        tab_T = 10**BE['th']
+        D = BE['dh']
+    elif case == 'He1':
+        tab_T = 10**BE['the1']
+        D = BE['dhe1']
+    else:
+        tab_T = 10**BE['the2']
+        D = BE['dhe2']
+    BE_E_Ry = D[:,1]
+    BE_E_erg = BE_E_Ry * CST.RYD_erg
+    BE_E_Thr = BE_E_erg[D[:,0] == 1]
+    Delta_E = np.zeros(n_lam)
+    for i in np.arange(n_lam):
+        DE = hnu[i] - BE_E_Thr
+        Delta_E[i] = np.min(DE[DE > 0])
+    n_T_sup = np.min(np.where(tab_T >= T_in)[0])
+    n_T_inf = n_T_sup - 1
+    T_sup = tab_T[n_T_sup]
+    T_inf = tab_T[n_T_inf]
+    coeff_sup = physics.interp1d(BE_E_erg, D[:, n_T_sup+2])(hnu)
+    coeff_inf = physics.interp1d(BE_E_erg, D[:, n_T_inf+2])(hnu)
+    C_interp= (np.log10(T_in) - np.log10(T_inf)) / (np.log10(T_sup) - np.log10(T_inf))
+    coeff = coeff_sup * C_interp + coeff_inf*(1. - C_interp)
+    return coeff * 1e-34 * T_in**(-1.5) * np.exp(-Delta_E / T_in / CST.BOLTZMANN) / lam**2. * CST.CLIGHT * 1e8
+
+def gff_loop(Z, T, lam, D):
+    # gff before the vectorization, D being the (11, 8) table of coefficients
+    XLF = np.log10(CST.CLIGHT * 1e8 / lam)
+    N_lam = len(lam)
+    G = np.zeros(N_lam)
+    B = np.zeros(11)
+    C = np.zeros(8)
+    XLRKT = 5.1983649 - np.log10(T)
+    TXG = 0.66666667 * (2.0 * np.log10(Z) + XLRKT)
+    for j in np.arange(7):
+        B[10] = D[10, j]
+        B[9] = TXG * B[10] + D[9, j]
+        for IR in np.arange(8)[::-1]:
+            B[IR] = TXG * B[IR+1] - B[IR+2] + D[IR, j]
+        C[j] = 0.25 * (B[0] - B[2])
+    CON=0.72727273 * XLRKT - 10.376127
+    for i in np.arange(N_lam):
+        TXU = 0.72727273 * XLF[i] + CON
+        B[7] = C[7]
+        B[6] = TXU * B[7] + C[6]
+        for IR in np.arange(5)[::-1]:
+            B[IR] = TXU * B[IR+1] - B[IR+2] + C[IR]
+        G[i] = B[0] - B[2]
+    return G
+
+# Coefficients of gff (Sutherland 1998), before the vectorization
+GFF_D = np.array([ 8.986940175e+00, -4.009515855e+00,  8.808871266e-01,  2.640245111e-02,
+                  -4.580645915e-02, -3.568055702e-03,  2.827798067e-03,  3.365860195e-04,
+                  -8.006936989e-01,  9.466021705e-01,  9.043402532e-02, -9.608451450e-02,
+                  -1.885629865e-02,  1.050313890e-02,  2.800889961e-03, -1.078209202e-03,
+                  -3.781305103e-01,  1.102726332e-01, -1.543619180e-02,  8.310561114e-03,
+                   2.179620525e-02,  4.259726289e-03, -4.181588794e-03, -1.770208330e-03,
+                   1.877213132e-02, -1.004885705e-01, -5.483366378e-02, -4.520154409e-03,
+                   8.366530426e-03,  3.700273930e-03,  6.889320423e-04,  9.460313195e-05,
+                   7.300158392e-02,  3.576785497e-03, -4.545307025e-03, -1.017965604e-02,
+                  -9.530211924e-03, -3.450186162e-03,  1.040482914e-03,  1.407073544e-03,
+                  -1.744671550e-03,  2.864013856e-02,  1.903394837e-02,  7.091074494e-03,
+                  -9.668371391e-04, -2.999107465e-03, -1.820642230e-03, -3.874082085e-04,
+                  -1.707268366e-02, -4.694254776e-03,  1.311691517e-03,  5.316703136e-03,
+                   5.178193095e-03,  2.451228935e-03, -2.277321615e-05, -8.182359057e-04,
+                   2.567331664e-04, -9.155339970e-03, -6.997479192e-03, -3.571518641e-03,
+                  -2.096101038e-04,  1.553822487e-03,  1.509584686e-03,  6.212627837e-04,
+                   4.098322531e-03,  1.635218463e-03, -5.918883504e-04, -2.333091048e-03,
+                  -2.484138313e-03, -1.359996060e-03, -5.371426147e-05,  5.553549563e-04,
+                   3.837562402e-05,  2.938325230e-03,  2.393747064e-03,  1.328839809e-03,
+                   9.135013312e-05, -7.137252303e-04, -7.656848158e-04, -3.504683798e-04,
+                  -8.491991820e-04, -3.615327726e-04,  3.148015257e-04,  8.909207650e-04,
+                   9.869737522e-04,  6.134671184e-04,  1.068883394e-04, -2.046080100e-04]).reshape(11, 8)
+
+# Wavelengths across the Balmer and Paschen jumps of H and of the He lines
+LAM = np.concatenate((np.linspace(3000., 9000., 1001), [3421.8, 3421.9, 3647.0, 3647.02, 8205.8, 8205.9]))
+
+@pytest.mark.parametrize('case', ['H', 'He1', 'He2'])
+@pytest.mark.parametrize('T', [5000., 10000., 12345.])
+def test_make_cont_Ercolano(case, T):
+    cont_loop = make_cont_Ercolano_loop(T, case, LAM)
+    cont = physics.make_cont_Ercolano(T, case, LAM)
+    np.testing.assert_allclose(cont, cont_loop, rtol=1e-12, atol=0)
+    # From the cache, which is not changed by the caller
+    cont[:] = 0.
+    np.testing.assert_allclose(physics.make_cont_Ercolano(T, case, LAM), cont_loop, rtol=1e-12, atol=0)
+
+def test_gff():
+    for Z in (1., 2.):
+        for T in (1e4, 12345.):
+            G_loop = gff_loop(Z, T, LAM, GFF_D)
+            G = physics.gff(Z, T, LAM)
+            np.testing.assert_allclose(G, G_loop, rtol=1e-12, atol=0)
+            G[:] = 0.
+            np.testing.assert_allclose(physics.gff(Z, T, LAM), G_loop, rtol=1e-12, atol=0)
@@ -0,0 +1,113 @@
+import os
+import numpy as np
+import pytest
+from pyssn.core import spectrum as spectrum_module
+from pyssn.core.spectrum import spectrum
+from conftest import PHYAT_LINES, add_conf, format_line, write_lines
+
+def test_cache_file_changed_while_read(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'liste_phyat.dat')
+    cache_dir = str(tmp_path / 'cache')
+    write_lines(filename, PHYAT_LINES[:-1])
+    read_data = spectrum_module.read_data
+    def read_data_changed(*args, **kwargs):
+        dd = read_data(*args, **kwargs)
+        write_lines(filename, PHYAT_LINES)
+        return dd
+    monkeypatch.setattr(spectrum_module, 'read_data', read_data_changed)
+    dd, msg = spectrum_module.read_data_cached(filename, cache_dir=cache_dir)
+    assert len(dd) == len(PHYAT_LINES) - 1
+    # The array of the old content is not cached with the metadata of the new one
+    assert not os.path.isdir(cache_dir) or os.listdir(cache_dir) == []
+    monkeypatch.setattr(spectrum_module, 'read_data', read_data)
+    for i in range(2):
+        dd, msg = spectrum_module.read_data_cached(filename, cache_dir=cache_dir)
+        assert msg == ''
+        np.testing.assert_array_equal(dd['num'], [line[0] for line in PHYAT_LINES])
+    assert len([f for f in os.listdir(cache_dir) if f.endswith('.npy')]) == 1
+
+def genfromtxt_lines(filename, NF=True):
+    # Reading of the line files before parse_line_bytes
+    dtype = 'i8, a1, a9, float64, float64, float64, float64, a1, i8, i4, f, a100'
+    if NF:
+        delimiter = [14, 1, 9, 11, 6, 10, 7, 1, 14, 4, 7, 100]
+    else:
+        delimiter = [ 9, 1, 9, 11, 6, 10, 7, 1,  9, 4, 7, 100]
+    names = ['num', 'foo', 'id', 'lambda','l_shift', 'i_rel', 'i_cor', 'foo2', 'ref', 'profile', 
+             'vitesse', 'comment']
+    usecols = (0, 2, 3, 4, 5, 6, 8, 9, 10, 11)
+    return np.atleast_1d(np.genfromtxt(filename, dtype=dtype, delimiter=delimiter, names = names, usecols = usecols))
+
+def test_parse_line_bytes(tmp_path):
+    lines = [format_line(*line, comment='{0:<10s}'.format(line[1])) for line in PHYAT_LINES]
+    # Lines of the same length
+    contents = [''.join(lines)]
+    # Blank line, line without comment, line without vitesse and comment, commented line, comment after a line
+    lines[1] = '\n'
+    lines[2] = lines[2][:83] + '\n'
+    lines[3] = lines[3][:76] + '\n'
+    lines[4] = '#' + lines[4]
+    lines[5] = lines[5].rstrip('\n') + ' # comment\n'
+    contents.append(''.join(lines))
+    for content, eol in [(content, eol) for content in contents for eol in ('\n', '\r\n')]:
+        filename = str(tmp_path / 'lines.dat')
+        with open(filename, 'wb') as f:
+            f.write(content.replace('\n', eol).encode('ascii'))
+        dd = spectrum_module.parse_line_file(filename)
+        dd_ref = genfromtxt_lines(filename)
+        assert dd.dtype.names == dd_ref.dtype.names
+        for key in dd.dtype.names:
+            np.testing.assert_array_equal(dd[key], dd_ref[key], err_msg=key)
+
+def write_fits(filename, header_cards, n_pix=200):
+    from astropy.io import fits
+    flux = np.arange(n_pix, dtype=float) ** 1.5
+    hdu = fits.ImageHDU(flux, name='FLUX')
+    for key, value in header_cards.items():
+        hdu.header[key] = value
+    fits.HDUList([fits.PrimaryHDU(), hdu, fits.ImageHDU(flux / 10., name='VAR'),
+                  fits.ImageHDU((np.arange(n_pix) % 7 == 0).astype(np.int16), name='MASK')]).writeto(filename)
+
+# Dispersions: keywords and wavelengths of the 0-based pixels x
+DISPERSIONS = [({'CRVAL1': 4000., 'CDELT1': 2.5}, lambda x: 4000. + 2.5 * x),
+               ({'CRVAL1': 4000., 'CRPIX1': 10., 'CD1_1': 2.5}, lambda x: 4000. + 2.5 * (x - 9.)),
+               ({'CRVAL1': np.log10(4000.), 'CDELT1': 1e-4, 'DC-FLAG': 1}, lambda x: 10.**(np.log10(4000.) + 1e-4 * x)),
+               ({'CRVAL1': 4000., 'CDELT1': 0.9, 'CTYPE1': 'WAVE-LOG'}, lambda x: 4000. * np.exp(0.9 * x / 4000.))]
+
+@pytest.mark.parametrize('dispersion', range(len(DISPERSIONS)))
+def test_read_fits_obs(tmp_path, dispersion):
+    fits = pytest.importorskip('astropy.io.fits')
+    cards, wavelengths = DISPERSIONS[dispersion]
+    filename = str(tmp_path / 'obs.fits')
+    write_fits(filename, cards)
+    w, f, var, mask = spectrum_module.read_fits_obs(filename, var_ext='VAR', mask_ext=3)
+    np.testing.assert_array_equal(f, fits.getdata(filename, 1))
+    np.testing.assert_array_equal(var, fits.getdata(filename, 'VAR'))
+    np.testing.assert_array_equal(mask, fits.getdata(filename, 'MASK'))
+    np.testing.assert_allclose(w, wavelengths(np.arange(len(f))), rtol=1e-12)
+    # Section covering w_lims, with one more pixel at each side
+    w_lims = (w[50] + 0.1 * (w[51] - w[50]), w[120] - 0.1 * (w[120] - w[119]))
+    w_s, f_s, var_s, mask_s = spectrum_module.read_fits_obs(filename, w_lims=w_lims, var_ext='VAR', mask_ext=3)
+    np.testing.assert_array_equal(w_s, w[49:122])
+    np.testing.assert_array_equal(f_s, f[49:122])
+    np.testing.assert_array_equal(var_s, var[49:122])
+    np.testing.assert_array_equal(mask_s, mask[49:122])
+    w_s, f_s, var_s, mask_s = spectrum_module.read_fits_obs(filename, w_lims=(w[150], 1e5), flux_ext='FLUX')
+    np.testing.assert_array_equal(f_s, f[149:])
+    assert var_s is None and mask_s is None
+
+def test_spectrum_fits_obs(data_dir):
+    fits = pytest.importorskip('astropy.io.fits')
+    obs = np.loadtxt('obs.spr')
+    hdu = fits.PrimaryHDU(obs[:, 1])
+    hdu.header['CRVAL1'] = obs[0, 0]
+    hdu.header['CDELT1'] = obs[1, 0] - obs[0, 0]
+    fits.HDUList([hdu, fits.ImageHDU(obs[:, 1] / 10., name='VAR')]).writeto('obs_fits.fits')
+    add_conf(data_dir, "limit_sp = [4500., 5500.]\n")
+    sp = spectrum(config_file='init.py')
+    add_conf(data_dir, "spectr_obs = 'obs_fits'\nfits_var_ext = 'VAR'\n")
+    sp_fits = spectrum(config_file='init.py')
+    assert sp_fits.read_obs_error == ''
+    assert len(sp_fits.obs_var) < len(obs) / 2
+    for key in ('w', 'f', 'sp_synth_lr'):
+        np.testing.assert_allclose(getattr(sp_fits, key), getattr(sp, key), rtol=1e-12, err_msg=key)
@@ -0,0 +1,102 @@
+import os
+import numpy as np
+import pytest
+from pyssn.core.spectrum import spectrum
+from conftest import add_conf
+
+def save_lines_loop(self):
+    # save_lines before the bulk formatting (k//2 and the decoding of the bytes fields for Python 3)
+    if self.get_conf('show_selected_intensities_only'):
+        cut = self.get_conf('cut_plot2')
+    else:
+        cut = 0.0
+    ref_list = self.get_ref_list(self.get_conf('selected_ions'))        
+    sort_list = [ 'lambda', 'i_rel', 'id' ]
+    k = self.get_conf('line_saved_ordered_by')
+    sort = sort_list[k//2]
+    filename = self.get_conf('line_saved_filename')
+    extension = os.path.splitext(filename)[1][1:].lower()
+    sep = ' '
+    end = '\n'
+    if extension == 'tex':
+        sep = ' & '
+        end = ' {0}{0}{1}'.format('\\', '\n')
+    elif extension == 'csv':
+        sep = ' ; '
+        end = '\n'
+    sorts = np.argsort(self.liste_raies[sort])
+    if k%2 == 1:
+        sorts = sorts[::-1]
+    with open(filename, 'w') as f:
+        field_print = self.get_conf('line_field_print')
+        n = len(field_print)
+        
+        if self.get_conf('line_saved_header'):
+            s = ''
+            for item in field_print:
+                f.write('{0:9s} : {1:>}\n'.format(item, self.field_tip[item]))
+              
+            for item in field_print:
+                width = self.field_width[item]
+                if ( item == field_print[n-1] ):
+                    add_s = end
+                else:
+                    add_s = sep
+                if ( item == field_print[0] ):
+                    align = ''
+                else:
+                    align = '>'
+                s = s + str('{:{a}{w}s}{}'.format(item, add_s, a=align, w=width))
+            f.write('\n'+s+'\n')
+        
+        for i_sort in sorts:
+            line = self.liste_raies[i_sort]
+            wl = line['lambda'] + line['l_shift'] + self.conf['lambda_shift']
+            i_rel = line['i_rel']
+            i_tot = line['i_rel'] * line['i_cor']
+            if (abs(i_tot) > cut) and ( not self.get_conf('show_selected_ions_only') or line['ref'] in ref_list):
+                s = ''
+                n = len(field_print)
+                for item in field_print:
+                    thisformat = self.field_format[item]
+                    if item == 'l_tot':
+                        r = wl
+                    elif item == 'i_tot':
+                        r = i_tot
+                    else:
+                        r = line[item]
+                    if isinstance(r, bytes):
+                        r = r.decode()
+                    if item == 'l_shift': 
+                        s = s + ' '
+                    s = s + str(thisformat.format(r))
+                    if ( item == field_print[n-1] ):
+                        s = s + end
+                    else:
+                        s = s + sep
+                f.write(s)
+
+FIELDS = ['num', 'id', 'lambda', 'l_shift', 'l_tot', 'i_rel', 'i_cor', 'i_tot', 'ref', 'profile', 'vitesse', 'comment']
+
+@pytest.mark.parametrize('extension', ['dat', 'tex', 'csv'])
+def test_save_lines(data_dir, extension):
+    add_conf(data_dir, "lambda_shift = 0.2\n")
+    sp = spectrum(config_file='init.py')
+    sp.liste_raies['i_cor'][::2] = -2.
+    for selected, header, k, fields in ((False, True, 0, FIELDS), (False, False, 3, FIELDS[::-1]), 
+                                        (True, True, 4, ['i_tot', 'comment', 'l_shift'])):
+        sp.set_conf('show_selected_ions_only', selected)
+        sp.set_conf('selected_ions', ['O_III'])
+        sp.set_conf('show_selected_intensities_only', True)
+        sp.set_conf('cut_plot2', 0.05)
+        sp.set_conf('line_saved_header', header)
+        sp.set_conf('line_saved_ordered_by', k)
+        sp.set_conf('line_field_print', fields)
+        contents = []
+        for save, name in ((sp.save_lines, 'lines'), (lambda: save_lines_loop(sp), 'lines_loop')):
+            sp.set_conf('line_saved_filename', '{0}.{1}'.format(name, extension))
+            save()
+            with open('{0}.{1}'.format(name, extension), 'r') as f:
+                contents.append(f.read())
+        assert contents[0] == contents[1]
+        assert len(contents[0].splitlines()) > 2 + header * (len(fields) + 2)
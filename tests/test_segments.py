@@ -0,0 +1,51 @@
+import numpy as np
+from pyssn import config
+from pyssn.core.spectrum import spectrum
+from conftest import add_conf
+
+SEGMENTS = "obs_segments = [{'spectr_obs': 'obs_b', 'limit_sp': [4000., 5200.]},\n" \
+           "                {'spectr_obs': 'obs_r', 'limit_sp': [5200., 6700.], 'sp_norm': 2.}]\n"
+
+def run_segments(use_multiprocs):
+    sp = spectrum(config_file='init.py')
+    if use_multiprocs:
+        config.use_multiprocs()
+    else:
+        config.unuse_multiprocs()
+    sp.run_segments()
+    return sp
+
+def test_segments_serial_parallel(data_dir, use_mp):
+    add_conf(data_dir, SEGMENTS + "cont_auto = True\ncont_auto_width = 200.\n")
+    serial = run_segments(False)
+    parallel = run_segments(True)
+    assert len(serial.segments) == 2
+    for seg_s, seg_p in zip(serial.segments, parallel.segments):
+        assert seg_s.cont_auto is not None
+        for key in ('cont', 'cont_auto', 'cont_lr', 'sp_synth', 'sp_synth_lr', 'f'):
+            np.testing.assert_array_equal(getattr(seg_s, key), getattr(seg_p, key), err_msg=key)
+        assert sorted(seg_s.conts) == sorted(seg_p.conts)
+        for key in seg_s.conts:
+            np.testing.assert_array_equal(seg_s.conts[key], seg_p.conts[key], err_msg=key)
+        assert seg_s.line_db is None and seg_p.line_db is None
+
+def test_segments_own_caches(data_dir):
+    add_conf(data_dir, SEGMENTS)
+    sp = spectrum(config_file='init.py')
+    sp.init_segments()
+    for seg in sp.segments:
+        for key in ('cont_cache', 'red_corr_cache', 'line_indexes', 'comment_tables', 'line_files'):
+            assert getattr(seg, key) is not getattr(sp, key)
+    w = sp.merge_segments()[0]
+    assert np.all(np.diff(w) >= 0)
+
+def test_segments_phyat_lazy_load(data_dir):
+    # The atomic data read for limit_sp (red part) do not cover the blue segment
+    add_conf(data_dir, SEGMENTS + "limit_sp = [5200., 6700.]\n")
+    sp = run_segments(False)
+    add_conf(data_dir, "phyat_lazy_load = True\n")
+    sp_lazy = run_segments(False)
+    for seg, seg_lazy in zip(sp.segments, sp_lazy.segments):
+        np.testing.assert_array_equal(seg_lazy.liste_raies['num'], seg.liste_raies['num'])
+        np.testing.assert_allclose(seg_lazy.sp_synth_lr, seg.sp_synth_lr)
+    assert 101000000002 in sp_lazy.segments[0].liste_raies['num']
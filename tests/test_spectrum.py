@@ -0,0 +1,96 @@
+import numpy as np
+from pyssn.core.spectrum import spectrum
+from pyssn.utils.misc import grid_hash
+from conftest import add_conf, format_line
+
+def test_change_velo_outside_obs(data_dir):
+    # The observations cover exactly limit_sp: once shifted they do not cover w_ori anymore
+    sp = spectrum(config_file='init.py')
+    sp.change_velo(50.)
+    add_conf(data_dir, "obj_velo = 50.\n")
+    sp_direct = spectrum(config_file='init.py')
+    np.testing.assert_array_equal(sp.w_ori, sp_direct.w_ori)
+    np.testing.assert_array_equal(sp.f_ori, sp_direct.f_ori)
+    np.testing.assert_allclose(sp.sp_synth_lr, sp_direct.sp_synth_lr)
+
+def test_change_velo_cont_auto(data_dir):
+    add_conf(data_dir, "limit_sp = [4100., 6600.]\ncont_auto = True\ncont_auto_width = 200.\n")
+    sp = spectrum(config_file='init.py')
+    w_ori = sp.w_ori.copy()
+    cont_lr = sp.cont_lr.copy()
+    sp.change_velo(50.)
+    np.testing.assert_array_equal(sp.w_ori, w_ori)
+    w = np.loadtxt('obs.spr')[:, 0] * (1 - 50. / 299792.458)
+    f = np.loadtxt('obs.spr')[:, 1]
+    np.testing.assert_allclose(sp.f_ori, np.interp(w_ori, w, f))
+    assert sp.cont_auto_state['key'][1] == grid_hash(sp.f_ori)
+    assert not np.array_equal(sp.cont_lr, cont_lr)
+
+def test_change_ebv_adaptive_grid(data_dir):
+    add_conf(data_dir, "resol = 5\nadaptive_grid = True\n")
+    sp = spectrum(config_file='init.py')
+    assert sp.synth_starts is not None
+    sp.change_ebv(0.3)
+    add_conf(data_dir, "e_bv = 0.3\n")
+    sp_direct = spectrum(config_file='init.py')
+    np.testing.assert_allclose(sp.sp_synth_lr, sp_direct.sp_synth_lr)
+
+def write_cosmetik(l_shift, i_cor):
+    with open('liste_cosmetik.dat', 'w') as f:
+        f.write(format_line(803000000004, 'O_III', 5007.10, 0.2, 803000000000, l_shift=l_shift, i_cor=i_cor))
+
+def test_adjust_blends(data_dir):
+    # 803000000001 and 803000000004 are merged into one blend
+    add_conf(data_dir, "blend_tolerance = 1.\nfic_cosmetik = 'liste_cosmetik.dat'\ndo_cosmetik = True\n")
+    write_cosmetik(0., 1.)
+    sp = spectrum(config_file='init.py')
+    assert sp.get_blend(803000000004) is not None
+    # Change of the intensity in the blend, then of the wavelength, out of the blend
+    for l_shift, i_cor in ((0., 2.5), (5., 2.5)):
+        write_cosmetik(l_shift, i_cor)
+        assert sp.adjust()[0] == 1
+        sp_direct = spectrum(config_file='init.py')
+        np.testing.assert_allclose(sp.sp_synth_lr, sp_direct.sp_synth_lr, rtol=1e-10, atol=1e-10)
+        assert sp.blend_map == sp_direct.blend_map
+
+def test_phyat_lazy_load(data_dir, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(data_dir / 'cache'))
+    # 803000000002 (4958.91) is shifted into the synthesis range by the cosmetik file
+    add_conf(data_dir, "limit_sp = [4000., 4955.]\nfic_cosmetik = 'liste_cosmetik.dat'\ndo_cosmetik = True\n")
+    with open('liste_cosmetik.dat', 'w') as f:
+        f.write(format_line(803000000002, 'O_III', 4958.91, 0.335, 803000000000, l_shift=-9.))
+    sp = spectrum(config_file='init.py')
+    add_conf(data_dir, "phyat_lazy_load = True\nphyat_lazy_margin = 0.\n")
+    sp_lazy = spectrum(config_file='init.py')
+    assert len(sp_lazy.phyat_arr) < len(sp.phyat_arr)
+    assert 803000000002 in sp_lazy.liste_raies['num']
+    np.testing.assert_array_equal(sp_lazy.liste_raies['num'], sp.liste_raies['num'])
+    np.testing.assert_allclose(sp_lazy.sp_synth_lr, sp.sp_synth_lr)
+    # Without data_cache, the index of the atomic database is not saved
+    assert not (data_dir / 'cache').exists()
+
+# Continuum parameters changed one at a time (cont_heii_i first: the free-free continuum needs the three ions)
+CONT_CHANGES = [('cont_heii_i', 100.), ('cont_bb_i', 1e3), ('cont_bb_t', 8000.), ('cont_pl_i', 5.),
+                ('cont_pl_alpha', -1.), ('cont_hi_i', 2e4), ('cont_hi_t', 12000.), ('cont_hei_i', 500.),
+                ('cont_hei_t', 8000.), ('cont_heii_t', 15000.), ('cont_edens', 1e5), ('cont_lambda', [3900., 6800.]),
+                ('cont_intens', [1., 3.]), ('cont_in_lambda', True), ('cont_hi_i', 0.)]
+
+def test_continuum_cache(data_dir):
+    from pyssn.utils import physics
+    sp = spectrum(config_file='init.py')
+    for par, value in CONT_CHANGES:
+        sp.conf[par] = value
+        cached = dict(sp.cont_cache)
+        sp.make_continuum()
+        cont, conts = sp.cont.copy(), sp.conts
+        # Only the components depending on par are computed again
+        for name in cached:
+            assert (sp.cont_cache[name] is cached[name]) == (cached[name][0] == sp.cont_cache[name][0]), name
+        sp.cont_cache = {}
+        physics._ercolano_cache.clear()
+        physics._gff_cache.clear()
+        sp.make_continuum()
+        assert sorted(conts) == sorted(sp.conts)
+        for name in conts:
+            np.testing.assert_array_equal(conts[name], sp.conts[name], err_msg='{0} {1}'.format(par, name))
+        np.testing.assert_array_equal(cont, sp.cont, err_msg=par)